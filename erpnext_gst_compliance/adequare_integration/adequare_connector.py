@@ -1,22 +1,33 @@
 import re
 import os
-import io
 import base64
 import frappe
+import threading
 
 from frappe import _
-from json import dumps
-from pyqrcode import create as qrcreate
-from frappe.utils.data import get_link_to_form
-from erpnext_gst_compliance.utils import log_exception
-from frappe.integrations.utils import make_post_request, make_get_request
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from frappe.utils.data import get_link_to_form, format_date
+from erpnext_gst_compliance.utils import log_exception, log_error, safe_load_json, get_exception_messages
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log import log_request
+from erpnext_gst_compliance import http_pool, serializer
+from erpnext_gst_compliance.rate_limiter import RateLimiter
+from erpnext_gst_compliance.erpnext_gst_compliance import metrics
+from erpnext_gst_compliance.erpnext_gst_compliance.profiler import profiled
 from frappe.utils.data import add_to_date, time_diff_in_seconds, now_datetime
 
+AUTH_TOKEN_CACHE_KEY = 'adequare_auth_token'
+# seconds before expiry, within which the token is refreshed
+TOKEN_REFRESH_BUFFER = 150
+PROACTIVE_TOKEN_REFRESH_BUFFER = 2 * 60 * 60
+
 class AdequareConnector:
 	def __init__(self, gstin):
 
 		self.gstin = gstin
+		self.einvoice = None
 		self.settings = frappe.get_cached_doc("Adequare Settings")
+		self.rate_limiter = RateLimiter.from_settings(self.settings, gstin)
 		self.credentials = self.get_user_credentials()
 		self.host = self.get_host_url()
 		self.endpoints = self.get_endpoints()
@@ -27,17 +38,23 @@ class AdequareConnector:
 		return next(filter(lambda row: row.gstin == self.gstin, self.settings.credentials), frappe._dict())
 
 	def get_host_url(self):
+		# to point the requests to a local mock server, see mock_gsp_server.py
+		if frappe.conf.einvoice_gsp_host_override:
+			return frappe.conf.einvoice_gsp_host_override
+
 		if self.settings.sandbox_mode:
 			return "https://gsp.adaequare.com/test"
 		else:
 			return "https://gsp.adaequare.com"
 
 	def get_endpoints(self):
+		auth_host = frappe.conf.einvoice_gsp_host_override or 'https://gsp.adaequare.com'
 		return frappe._dict({
-			"authenticate": 'https://gsp.adaequare.com/gsp/authenticate?grant_type=token',
+			"authenticate": auth_host + '/gsp/authenticate?grant_type=token',
 			"generate_irn": self.host + '/enriched/ei/api/invoice',
 			"cancel_irn": self.host + '/enriched/ei/api/invoice/cancel',
 			"irn_details": self.host + '/enriched/ei/api/invoice/irn',
+			"irn_by_doc_details": self.host + '/enriched/ei/api/invoice/irnbydocdetails',
 			"gstin_details": self.host + '/enriched/ei/api/master/gstin',
 			"cancel_ewaybill": self.host + '/enriched/ei/api/ewayapi',
 			"generate_ewaybill": self.host + '/enriched/ei/api/ewaybill',
@@ -53,29 +70,28 @@ class AdequareConnector:
 				.format(self.gstin, settings_form))
 
 	@log_exception
-	def make_request(self, req_type, url, headers, payload):
-		if req_type == 'post':
-			response = make_post_request(url, headers=headers, data=payload)
-		else:
-			response = make_get_request(url, headers=headers, data=payload)
-			
+	def make_request(self, req_type, url, headers, payload, retry=False):
+		# only lookups & requests whose duplicates are handled are retried, e.g. a repeated cancellation fails
+		connection_settings = http_pool.get_connection_settings(self.settings, retry=retry or req_type == 'get')
+		# every attempt waits for its turn when other workers are sending requests for the same gstin
+		# including the retries & the wait for the rate limit
+		try:
+			with metrics.timer('http', provider=self.settings.doctype, gstin=self.gstin, endpoint=metrics.get_endpoint(url)):
+				response = http_pool.make_request(req_type.upper(), url, headers=headers, data=payload,
+					rate_limiter=self.rate_limiter, **connection_settings)
+		except Exception:
+			# logged without a response, so that the e-invoice is reconciled if the request went through
+			self.log_einvoice_request(url, headers, payload, None)
+			raise
+
 		self.log_einvoice_request(url, headers, payload, response)
 		
 		return response
 
 	def log_einvoice_request(self, url, headers, payload, response):
 		headers.update({ 'password': self.credentials.password })
-		request_log = frappe.get_doc({
-			"doctype": "E Invoice Request Log",
-			"user": frappe.session.user,
-			"reference_invoice": self.einvoice.name,
-			"url": url,
-			"headers": dumps(headers, indent=4) if headers else None,
-			"data": dumps(payload, indent=4) if isinstance(payload, dict) else payload,
-			"response": dumps(response, indent=4) if response else None
-		})
-		request_log.save(ignore_permissions=True)
-		frappe.db.commit()
+		reference_invoice = self.einvoice.name if self.einvoice else None
+		log_request(url, headers, payload, response, reference_invoice=reference_invoice)
 
 	@log_exception
 	def fetch_auth_token(self):
@@ -86,23 +102,54 @@ class AdequareConnector:
 			'gspappsecret': client_secret
 		}
 		url = self.endpoints.authenticate
-		res = self.make_request('post', url, headers, None)
+		res = self.make_request('post', url, headers, None, retry=True)
 		self.handle_successful_token_generation(res)
 
 	@log_exception
 	def handle_successful_token_generation(self, res):
 		self.settings.auth_token = "{} {}".format(res.get('token_type'), res.get('access_token'))
 		self.settings.token_expiry = add_to_date(None, seconds=res.get('expires_in'))
+
+		# shared with all workers, settings are only a fallback if the cache is cleared
+		frappe.cache().set_value(AUTH_TOKEN_CACHE_KEY, frappe._dict({
+			'auth_token': self.settings.auth_token,
+			'token_expiry': self.settings.token_expiry
+		}), expires_in_sec=res.get('expires_in'))
+
 		self.settings.save(ignore_permissions=True)
 		self.settings.reload()
 		frappe.db.commit()
 
 	@log_exception
-	def get_auth_token(self):
-		if time_diff_in_seconds(self.settings.token_expiry, now_datetime()) < 150.0:
-			self.fetch_auth_token()
-
-		return self.settings.auth_token
+	def get_auth_token(self, refresh_buffer=TOKEN_REFRESH_BUFFER):
+		auth_token = self.get_cached_auth_token(refresh_buffer)
+		if auth_token:
+			return auth_token
+
+		# only one worker refreshes the token, others wait for it & reuse the refreshed token
+		lock = frappe.cache().lock(frappe.cache().make_key(AUTH_TOKEN_CACHE_KEY + '_lock'),
+			timeout=60, blocking_timeout=30)
+		lock_acquired = lock.acquire()
+		try:
+			auth_token = self.get_cached_auth_token(refresh_buffer)
+			if not auth_token:
+				self.fetch_auth_token()
+				auth_token = self.settings.auth_token
+		finally:
+			if lock_acquired:
+				lock.release()
+
+		return auth_token
+
+	def get_cached_auth_token(self, refresh_buffer=TOKEN_REFRESH_BUFFER):
+		token = frappe.cache().get_value(AUTH_TOKEN_CACHE_KEY, expires=True)
+		if not token:
+			settings = frappe.db.get_value('Adequare Settings', None, ['auth_token', 'token_expiry'], as_dict=1)
+			token = settings or frappe._dict()
+
+		if token.auth_token and token.token_expiry and \
+			time_diff_in_seconds(token.token_expiry, now_datetime()) > refresh_buffer:
+			return token.auth_token
 
 	@log_exception
 	def get_headers(self):
@@ -121,14 +168,15 @@ class AdequareConnector:
 		url = self.endpoints.generate_irn
 
 		einvoice_json = self.einvoice.get_einvoice_json()
-		payload = dumps(einvoice_json, indent=4)
+		payload = serializer.dumps(einvoice_json)
 
-		response = self.make_request('post', url, headers, payload)
+		response = self.make_request('post', url, headers, payload, retry=True)
 
 		sucess, errors = self.handle_irn_generation_response(response)
 		return sucess, errors
 
 	@staticmethod
+	@profiled
 	@log_exception
 	def generate_irn(einvoice):
 		gstin = einvoice.seller_gstin
@@ -143,9 +191,10 @@ class AdequareConnector:
 		if response.get('success'):
 			govt_response = response.get('result')
 			self.handle_successful_irn_generation(govt_response)
-		elif '2150' in response.get('message'):
+		elif '2150' in (response.get('message') or ''):
+			# irn was generated by an earlier attempt, e.g. one that timed out before the response
 			govt_response = response.get('result')
-			self.handle_irn_already_generated(govt_response)
+			return self.handle_irn_already_generated(govt_response)
 		else:
 			errors = response.get('message')
 			errors = self.sanitize_error_message(errors)
@@ -160,7 +209,7 @@ class AdequareConnector:
 		ack_date = response.get('AckDt')
 		ewaybill = response.get('EwbNo')
 		ewaybill_validity = response.get('EwbValidTill')
-		qrcode = self.generate_qrcode(response.get('SignedQRCode'))
+		signed_qr_code = response.get('SignedQRCode')
 
 		self.einvoice.update({
 			'irn': irn,
@@ -168,39 +217,24 @@ class AdequareConnector:
 			'ack_no': ack_no,
 			'ack_date': ack_date,
 			'ewaybill': ewaybill,
-			'qrcode_path': qrcode,
+			'signed_qr_code': signed_qr_code,
 			'ewaybill_validity': ewaybill_validity
 		})
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.submit()
-
-	def generate_qrcode(self, signed_qrcode):
-		doctype = self.einvoice.doctype
-		docname = self.einvoice.name
-		filename = '{} - QRCode.png'.format(docname).replace(os.path.sep, "__")
-
-		qr_image = io.BytesIO()
-		url = qrcreate(signed_qrcode, error='L')
-		url.png(qr_image, scale=2, quiet_zone=1)
-		_file = frappe.get_doc({
-			'doctype': 'File',
-			'file_name': filename,
-			'attached_to_doctype': doctype,
-			'attached_to_name': docname,
-			'attached_to_field': 'qrcode_path',
-			'is_private': 0,
-			'content': qr_image.getvalue()
-		})
-		_file.save()
-		return _file.file_url
+		with metrics.timer('einvoice_submit'):
+			self.einvoice.submit()
 
 	def handle_irn_already_generated(self, response):
 		# IRN already generated but not updated in invoice
 		# Extract the IRN from the response description and fetch irn details
 		irn = response[0].get('Desc').get('Irn')
 		success, irn_details = self.make_get_irn_details_request(irn)
-		if success:
-			self.handle_successful_irn_generation(irn_details)
+		if not success:
+			# e-invoice stays IRN Pending, to be updated by the reconciliation job
+			return False, irn_details
+
+		self.handle_successful_irn_generation(irn_details)
+		return True, []
 
 	def sanitize_error_message(self, message):
 		'''
@@ -246,13 +280,79 @@ class AdequareConnector:
 			errors = self.sanitize_error_message(errors)
 			return False, errors
 
+	def get_irn_lookup_url(self, einvoice):
+		'''Returns the url to fetch the IRN details of an e-invoice, by IRN if it was received earlier or by document details'''
+		irn = get_irn_from_request_logs(einvoice.name)
+		if irn:
+			return self.endpoints.irn_details + '?' + urlencode({'irn': irn})
+
+		return self.endpoints.irn_by_doc_details + '?' + urlencode({
+			'doctype': einvoice.invoice_type,
+			'docnum': einvoice.invoice,
+			'docdate': format_date(einvoice.invoice_date, 'dd/mm/yyyy')
+		})
+
+	@staticmethod
+	def reconcile_irns(einvoices, max_concurrent_requests=4):
+		'''Updates the e-invoices whose IRN is generated on the portal but not received, e.g. due to a timeout
+
+		Requests are made concurrently, with at most `max_concurrent_requests` in flight per GSTIN.
+		Returns a dict of e-invoice name -> success'''
+		connectors = {}
+		irn_requests = []
+		for einvoice in einvoices:
+			gstin = einvoice.seller_gstin
+			try:
+				if gstin not in connectors:
+					connectors[gstin] = AdequareConnector(gstin)
+				connector = connectors[gstin]
+				irn_requests.append(frappe._dict({
+					'connector': connector,
+					'einvoice': einvoice,
+					'method': 'GET',
+					'url': connector.get_irn_lookup_url(einvoice),
+					'headers': connector.get_headers()
+				}))
+			except frappe.ValidationError:
+				# gstin without credentials or auth token couldn't be fetched, already logged
+				frappe.clear_messages()
+
+		responses = make_concurrent_requests(irn_requests, max_concurrent_requests)
+
+		results = {}
+		for irn_request, response in zip(irn_requests, responses):
+			results[irn_request.einvoice.name] = irn_request.connector.handle_irn_reconciliation_response(
+				irn_request, response)
+
+		return results
+
+	def handle_irn_reconciliation_response(self, irn_request, response):
+		self.einvoice = irn_request.einvoice
+		if isinstance(response, Exception):
+			# portal is unreachable, reconciled in the next run
+			return False
+
+		self.log_einvoice_request(irn_request.url, irn_request.headers, None, response)
+		if not response.get('success') or not (response.get('result') or {}).get('Irn'):
+			# irn isn't generated on the portal
+			return False
+
+		try:
+			self.handle_successful_irn_generation(response.get('result'))
+			frappe.db.commit()
+		except Exception:
+			log_error()
+			return False
+
+		return True
+
 	@log_exception
 	def make_cancel_irn_request(self, reason, remark):
 		headers = self.get_headers()
 		irn = self.einvoice.irn
 
 		payload = {'Irn': irn, 'Cnlrsn': reason, 'Cnlrem': remark}
-		payload = dumps(payload, indent=4)
+		payload = serializer.dumps(payload)
 
 		url = self.endpoints.cancel_irn
 		response = self.make_request('post', url, headers, payload)
@@ -279,9 +379,11 @@ class AdequareConnector:
 		self.einvoice.status = 'IRN Cancelled'
 		self.einvoice.flags.ignore_validate_update_after_submit = 1
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.save()
+		with metrics.timer('einvoice_save'):
+			self.einvoice.save()
 
 	@staticmethod
+	@profiled
 	@log_exception
 	def cancel_irn(einvoice, reason, remark):
 		gstin = einvoice.seller_gstin
@@ -297,7 +399,7 @@ class AdequareConnector:
 		url = self.endpoints.generate_ewaybill
 
 		eway_bill_json = self.einvoice.get_eway_bill_json()
-		payload = dumps(eway_bill_json, indent=4)
+		payload = serializer.dumps(eway_bill_json)
 
 		response = self.make_request('post', url, headers, payload)
 
@@ -317,9 +419,11 @@ class AdequareConnector:
 		self.einvoice.status = 'E-Way Bill Generated'
 		self.einvoice.flags.ignore_validate_update_after_submit = 1
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.save()
+		with metrics.timer('einvoice_save'):
+			self.einvoice.save()
 
 	@staticmethod
+	@profiled
 	@log_exception
 	def generate_eway_bill(einvoice):
 		gstin = einvoice.seller_gstin
@@ -329,6 +433,60 @@ class AdequareConnector:
 
 		return success, errors
 
+	@staticmethod
+	@profiled
+	def bulk_generate_eway_bill(einvoices, max_concurrent_requests=4):
+		'''Generates e-way bills for multiple e-invoices with the transport details already set
+
+		Requests are made concurrently, with at most `max_concurrent_requests` in flight per GSTIN.
+		Returns a dict of sales invoice name -> (success, errors)'''
+		results = {}
+		connectors = {}
+		eway_bill_requests = []
+		for einvoice in einvoices:
+			gstin = einvoice.seller_gstin
+			try:
+				if gstin not in connectors:
+					connectors[gstin] = AdequareConnector(gstin)
+				connector = connectors[gstin]
+				eway_bill_requests.append(frappe._dict({
+					'connector': connector,
+					'einvoice': einvoice,
+					'method': 'POST',
+					'url': connector.endpoints.generate_ewaybill,
+					'headers': connector.get_headers(),
+					'payload': serializer.dumps(einvoice.get_eway_bill_json())
+				}))
+			except frappe.ValidationError as e:
+				results[einvoice.invoice] = (False, get_exception_messages(e))
+
+		responses = make_concurrent_requests(eway_bill_requests, max_concurrent_requests)
+
+		for eway_bill_request, response in zip(eway_bill_requests, responses):
+			results[eway_bill_request.einvoice.invoice] = eway_bill_request.connector.handle_bulk_eway_bill_response(
+				eway_bill_request, response)
+
+		return results
+
+	def handle_bulk_eway_bill_response(self, eway_bill_request, response):
+		self.einvoice = eway_bill_request.einvoice
+		if isinstance(response, Exception):
+			frappe.log_error(title=_('E-Invoicing Exception'), message=repr(response))
+			return False, [_('There was an error while making the request. Please try again after some time.')]
+
+		self.log_einvoice_request(eway_bill_request.url, eway_bill_request.headers, eway_bill_request.payload, response)
+		if not response.get('success'):
+			return False, self.sanitize_error_message(response.get('message'))
+
+		try:
+			self.handle_successful_ewaybill_generation(response.get('result'))
+			frappe.db.commit()
+		except Exception as e:
+			log_error()
+			return False, get_exception_messages(e)
+
+		return True, []
+
 	@log_exception
 	def make_cancel_ewaybill_request(self, reason, remark):
 		headers = self.get_headers()
@@ -337,7 +495,7 @@ class AdequareConnector:
 		ewaybill = self.einvoice.ewaybill
 
 		payload = {'ewbNo': ewaybill, 'cancelRsnCode': reason, 'cancelRmrk': remark}
-		payload = dumps(payload, indent=4)
+		payload = serializer.dumps(payload)
 
 		response = self.make_request('post', url, headers, payload)
 
@@ -356,9 +514,11 @@ class AdequareConnector:
 		self.einvoice.status = 'E-Way Bill Cancelled'
 		self.einvoice.flags.ignore_validate_update_after_submit = 1
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.save()
+		with metrics.timer('einvoice_save'):
+			self.einvoice.save()
 
 	@staticmethod
+	@profiled
 	@log_exception
 	def cancel_ewaybill(einvoice, reason, remark):
 		gstin = einvoice.seller_gstin
@@ -367,3 +527,60 @@ class AdequareConnector:
 		success, errors = connector.make_cancel_ewaybill_request(reason, remark)
 
 		return success, errors
+
+def refresh_auth_token():
+	'''Refreshes the auth token ahead of its expiry, so that no e-invoicing request waits for authentication'''
+	settings = frappe.get_cached_doc('Adequare Settings')
+	if not settings.enabled or not settings.credentials:
+		return
+
+	connector = AdequareConnector(settings.credentials[0].gstin)
+	connector.get_auth_token(refresh_buffer=PROACTIVE_TOKEN_REFRESH_BUFFER)
+
+def make_concurrent_requests(requests, max_concurrent_requests=4):
+	'''Makes the requests in threads, with at most `max_concurrent_requests` in flight per GSTIN
+
+	Only the http requests run in threads, since documents & db connection are bound to the calling thread.
+	Returns the parsed responses in order, or the exception if a request failed'''
+	if not requests:
+		return []
+
+	connectors = {request.connector.gstin: request.connector for request in requests}
+	semaphores = {gstin: threading.BoundedSemaphore(max_concurrent_requests) for gstin in connectors}
+	connection_settings = {gstin: http_pool.get_connection_settings(c.settings) for gstin, c in connectors.items()}
+
+	def make_request(request):
+		gstin = request.connector.gstin
+		settings = connection_settings[gstin]
+		if request.method != 'GET' and not request.get('retry'):
+			settings = dict(settings, max_retries=0)
+
+		with semaphores[gstin]:
+			try:
+				return http_pool.make_request(request.method, request.url, headers=request.headers,
+					data=request.get('payload'), rate_limiter=request.connector.rate_limiter, **settings)
+			except Exception as e:
+				return e
+
+	max_workers = min(len(requests), max_concurrent_requests * len(connectors))
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		return list(executor.map(make_request, requests))
+
+def get_irn_from_request_logs(einvoice_name):
+	'''Returns the IRN from the last IRN generation response logged for the e-invoice, if any'''
+	responses = frappe.get_all('E Invoice Request Log', filters={
+		'reference_invoice': einvoice_name,
+		'url': ['like', '%/enriched/ei/api/invoice'],
+		'response': ['is', 'set']
+	}, pluck='response', order_by='creation desc', limit=1)
+
+	response = safe_load_json(serializer.decompress(responses[0])) if responses else None
+	if not isinstance(response, dict):
+		return
+
+	result = response.get('result')
+	if isinstance(result, dict):
+		return result.get('Irn')
+	if isinstance(result, list) and result:
+		# duplicate irn response has the irn in description
+		return (result[0].get('Desc') or {}).get('Irn')
@@ -8,6 +8,7 @@ import frappe
 from frappe import _
 from frappe.model.document import Document
 from frappe.utils.data import get_link_to_form
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoicing_settings.e_invoicing_settings import clear_einvoicing_rules_cache
 from erpnext_gst_compliance.adequare_integration.adequare_connector import AdequareConnector
 
 class AdequareSettings(Document):
@@ -23,6 +24,8 @@ class AdequareSettings(Document):
 				frappe.throw(msg, title=_('Invalid GSTIN'))
 	
 	def on_update(self):
+		clear_einvoicing_rules_cache()
+
 		current_service_provider = frappe.db.get_single_value('E Invoicing Settings', 'service_provider')
 		if self.enabled and current_service_provider != self.name:
 			link_to_settings = get_link_to_form('E Invoicing Settings', 'E Invoicing Settings')
@@ -1,9 +1,13 @@
 # Copyright (c) 2021, Frappe Technologied Pvt. Ltd. and Contributors
 # See license.txt
 
+import time
 import frappe
 import unittest
-from erpnext_gst_compliance.adequare_integration.adequare_connector import AdequareConnector
+from contextlib import contextmanager
+from erpnext_gst_compliance.mock_gsp_server import running_server
+from erpnext_gst_compliance.rate_limiter import RateLimiter, RateLimitExceeded
+from erpnext_gst_compliance.adequare_integration.adequare_connector import AdequareConnector, AUTH_TOKEN_CACHE_KEY
 from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice.test_e_invoice import make_e_invoice
 
 class TestAdequareSettings(unittest.TestCase):
@@ -77,6 +81,9 @@ class TestAdequareConnector(unittest.TestCase):
 		self.connector.handle_successful_token_generation(response)
 		self.assertTrue(self.connector.settings.auth_token)
 		self.assertTrue(self.connector.settings.token_expiry)
+
+		# token is shared with other workers through cache
+		self.assertEqual(self.connector.get_cached_auth_token(), self.connector.settings.auth_token)
 	
 	def test_irn_generation(self):
 		# with successful response
@@ -109,7 +116,140 @@ class TestAdequareConnector(unittest.TestCase):
 		self.assertFalse(success)
 		self.assertEqual(len(errors), 1)
 
+	def test_requests_with_mock_server(self):
+		with self.mock_server() as server:
+			connector = AdequareConnector('27AAECE4835E1ZR')
+			connector.einvoice = self.connector.einvoice
+
+			success, errors = connector.make_irn_request()
+			self.assertTrue(success)
+			self.assertEqual(connector.einvoice.status, 'IRN Generated')
+			self.assertTrue(connector.einvoice.signed_qr_code)
+
+			success, errors = connector.make_cancel_irn_request('1', 'Data Entry Mistake')
+			self.assertTrue(success)
+			self.assertEqual(connector.einvoice.status, 'IRN Cancelled')
+
+			# already cancelled irn (9999) is handled as a successful cancellation
+			success, errors = connector.make_cancel_irn_request('1', 'Data Entry Mistake')
+			self.assertTrue(success)
+
+			stats = server.gsp.get_stats()
+			self.assertEqual(stats['paths'].get('/gsp/authenticate'), 1)
+			self.assertEqual(stats['requests'], 4)
+
+	def test_retries_with_mock_server(self):
+		with self.mock_server(max_retries=3) as server:
+			connector = AdequareConnector('27AAECE4835E1ZR')
+			connector.einvoice = self.connector.einvoice
+			connector.get_auth_token()
+
+			# 502 & 503 from the gateway are retried
+			server.gsp.fail_next_requests(2)
+			success, errors = connector.make_irn_request()
+			self.assertTrue(success)
+			self.assertEqual(connector.einvoice.status, 'IRN Generated')
+
+			# every attempt is made with the same request id & only one irn is generated
+			request_ids = [d[1] for d in server.gsp.request_ids if d[0] == '/enriched/ei/api/invoice']
+			self.assertEqual(len(request_ids), 3)
+			self.assertEqual(len(set(request_ids)), 1)
+			self.assertEqual(len(server.gsp.irns), 1)
+
+			# cancellation is sent only once, a repeated one would fail even if the first one went through
+			server.gsp.fail_next_requests(1)
+			self.assertRaises(frappe.ValidationError, connector.make_cancel_irn_request, '1', 'Data Entry Mistake')
+			self.assertEqual(server.gsp.get_stats()['paths'].get('/enriched/ei/api/invoice/cancel'), 1)
+
+	def test_duplicate_irn_with_mock_server(self):
+		with self.mock_server() as server:
+			connector = AdequareConnector('27AAECE4835E1ZR')
+			connector.einvoice = self.connector.einvoice
+
+			# irn generated by an earlier attempt, but its details can't be fetched anymore
+			details, is_duplicate = server.gsp.generate_irn('27AAECE4835E1ZR', connector.einvoice.get_einvoice_json())
+			server.gsp.expire_irn_details(details['Irn'])
+
+			success, errors = connector.make_irn_request()
+			self.assertFalse(success)
+			self.assertTrue(errors)
+			self.assertEqual(connector.einvoice.status, 'IRN Pending')
+			self.assertFalse(connector.einvoice.irn)
+
+	def test_bulk_eway_bill_with_mock_server(self):
+		with self.mock_server() as server:
+			connector = AdequareConnector('27AAECE4835E1ZR')
+			connector.einvoice = self.connector.einvoice
+			success, errors = connector.make_irn_request()
+			self.assertTrue(success)
+
+			einvoice = connector.einvoice
+			einvoice.set_eway_bill_details(frappe._dict({
+				'mode_of_transport': 'Road',
+				'vehicle_no': 'MH01AB1234',
+				'distance': 10
+			}))
+			results = AdequareConnector.bulk_generate_eway_bill([einvoice], max_concurrent_requests=2)
+			self.assertEqual(results[einvoice.invoice], (True, []))
+
+			einvoice.reload()
+			self.assertEqual(einvoice.status, 'E-Way Bill Generated')
+			self.assertTrue(einvoice.ewaybill)
+
+			# e-way bill is already generated for the irn
+			results = AdequareConnector.bulk_generate_eway_bill([einvoice])
+			self.assertFalse(results[einvoice.invoice][0])
+
+	def test_irn_reconciliation_with_mock_server(self):
+		with self.mock_server() as server:
+			einvoice = self.connector.einvoice
+			# irn generated on the portal, but the response never reached the e-invoice
+			server.gsp.generate_irn('27AAECE4835E1ZR', einvoice.get_einvoice_json())
+
+			results = AdequareConnector.reconcile_irns([einvoice], max_concurrent_requests=2)
+			self.assertTrue(results[einvoice.name])
+
+			einvoice.reload()
+			self.assertEqual(einvoice.status, 'IRN Generated')
+			self.assertTrue(einvoice.irn)
+
+			stats = server.gsp.get_stats()
+			self.assertEqual(stats['paths'].get('/enriched/ei/api/invoice/irnbydocdetails'), 1)
+
+	def test_rate_limiter(self):
+		rate_limiter = RateLimiter('Adequare Settings', '_Test GSTIN', requests_per_second=10, burst_size=2, max_wait=0.5)
+		frappe.cache().delete(rate_limiter.key)
+
+		start = time.monotonic()
+		for i in range(4):
+			rate_limiter.acquire()
+
+		# 2 requests are made at once, the next 2 wait for a token each
+		self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+		# waiting beyond the maximum wait fails instead of queueing
+		rate_limiter.max_wait = 0
+		self.assertRaises(RateLimitExceeded, rate_limiter.acquire)
+		frappe.cache().delete(rate_limiter.key)
+
+	@contextmanager
+	def mock_server(self, **settings):
+		'''Points the connector to a mock server, running for the duration of the block'''
+		adequare_settings = frappe.get_single('Adequare Settings')
+		adequare_settings.update(dict(client_id='test_client_id', client_secret='test_client_secret', **settings))
+		adequare_settings.flags.ignore_validate = True
+		adequare_settings.save()
+
+		with running_server() as server:
+			frappe.conf.einvoice_gsp_host_override = server.url
+			try:
+				yield server
+			finally:
+				frappe.conf.pop('einvoice_gsp_host_override')
+
 	def tearDown(self):
+		# tokens are cached for all workers, a token of the mock server must not be used by the next test
+		frappe.cache().delete_value(AUTH_TOKEN_CACHE_KEY)
 		adequare_settings = frappe.get_single('Adequare Settings')
 		adequare_settings.enabled = 0
 		adequare_settings.auth_token = None
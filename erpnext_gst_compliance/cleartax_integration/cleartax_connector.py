@@ -1,18 +1,21 @@
-import os
-import io
 import frappe
 
 from frappe import _
-from json import dumps
-from pyqrcode import create as qrcreate
-from erpnext_gst_compliance.utils import log_exception
-from frappe.integrations.utils import make_post_request, make_get_request, make_put_request
+from urllib.parse import urlencode
+from frappe.utils.data import cint
+from erpnext_gst_compliance.utils import log_exception, log_error, get_exception_messages
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log import log_request
+from erpnext_gst_compliance import http_pool, serializer
+from erpnext_gst_compliance.rate_limiter import RateLimiter
+from erpnext_gst_compliance.erpnext_gst_compliance import metrics
+from erpnext_gst_compliance.erpnext_gst_compliance.profiler import profiled
 
 class CleartaxConnector:
 	def __init__(self, gstin):
 
 		self.gstin = gstin
 		self.settings = frappe.get_cached_doc("Cleartax Settings")
+		self.rate_limiter = RateLimiter.from_settings(self.settings, gstin)
 		self.business = self.get_business_settings()
 		self.auth_token = self.settings.auth_token
 		self.host = self.get_host_url()
@@ -27,6 +30,10 @@ class CleartaxConnector:
 		)
 
 	def get_host_url(self):
+		# to point the requests to a local mock server, see mock_gsp_server.py
+		if frappe.conf.einvoice_gsp_host_override:
+			return frappe.conf.einvoice_gsp_host_override
+
 		if self.settings.sandbox_mode:
 			return "https://einvoicing.internal.cleartax.co"
 		else:
@@ -36,6 +43,7 @@ class CleartaxConnector:
 		base_url = self.host + "/v2/eInvoice"
 		return frappe._dict({
 			"generate_irn": base_url + "/generate",
+			"irn_details": base_url + "/get",
 			"cancel_irn": base_url + "/cancel",
 			"generate_ewaybill": base_url + "/ewaybill",
 			"cancel_ewaybill": base_url + "/ewaybill/cancel"
@@ -65,28 +73,26 @@ class CleartaxConnector:
 			"x-cleartax-auth-token": self.auth_token,
 			"owner_id": self.business.owner_id
 		})
-		request_log = frappe.get_doc({
-			"doctype": "E Invoice Request Log",
-			"user": frappe.session.user,
-			"reference_invoice": self.einvoice.name,
-			"url": url,
-			"headers": dumps(headers, indent=4) if headers else None,
-			"data": dumps(payload, indent=4) if isinstance(payload, dict) else payload,
-			"response": dumps(response, indent=4) if response else None
-		})
-		request_log.save(ignore_permissions=True)
-		frappe.db.commit()
+		log_request(url, headers, payload, response, reference_invoice=self.einvoice.name)
 
 	@log_exception
-	def make_request(self, req_type, url, headers, payload):
-		if req_type == 'post':
-			response = make_post_request(url, headers=headers, data=payload)
-		elif req_type == 'put':
-			response = make_put_request(url, headers=headers, data=payload)
-		else:
-			response = make_get_request(url, headers=headers, data=payload)
-			
-		self.log_einvoice_request(url, headers, payload, response)
+	def make_request(self, req_type, url, headers, payload, log=True, retry=False):
+		# only lookups & requests whose duplicates are handled are retried, e.g. a repeated cancellation fails
+		connection_settings = http_pool.get_connection_settings(self.settings, retry=retry or req_type == 'get')
+		# every attempt waits for its turn when other workers are sending requests for the same gstin
+		# including the retries & the wait for the rate limit
+		try:
+			with metrics.timer('http', provider=self.settings.doctype, gstin=self.gstin, endpoint=metrics.get_endpoint(url)):
+				response = http_pool.make_request(req_type.upper(), url, headers=headers, data=payload,
+					rate_limiter=self.rate_limiter, **connection_settings)
+		except Exception:
+			if log:
+				# logged without a response, so that the e-invoice is reconciled if the request went through
+				self.log_einvoice_request(url, headers, payload, None)
+			raise
+
+		if log:
+			self.log_einvoice_request(url, headers, payload, response)
 		
 		return response
 
@@ -98,18 +104,19 @@ class CleartaxConnector:
 		einvoice_json = self.einvoice.get_einvoice_json()
 
 		payload = [{"transaction": einvoice_json}]
-		payload = dumps(payload, indent=4)
+		payload = serializer.dumps(payload)
 
-		response = self.make_request('put', url, headers, payload)
+		response = self.make_request('put', url, headers, payload, retry=True)
 		# Sample Response -> https://docs.cleartax.in/cleartax-for-developers/e-invoicing-api/e-invoicing-api-reference/cleartax-e-invoicing-apis-xml-schema#sample-response
 
 		response = self.sanitize_response(response)
 		if response.get('Success'):
-			self.handle_successful_irn_generation(response)
+			response = self.handle_irn_generation_response(response)
 
 		return response
 
 	@staticmethod
+	@profiled
 	def generate_irn(einvoice):
 		business_gstin = einvoice.seller_gstin
 		connector = CleartaxConnector(business_gstin)
@@ -119,6 +126,80 @@ class CleartaxConnector:
 
 		return success, errors
 
+	@log_exception
+	def make_bulk_irn_request(self, einvoices):
+		headers = self.get_headers()
+		url = self.endpoints.generate_irn
+
+		einvoice_jsons = [einvoice.get_einvoice_json() for einvoice in einvoices]
+		# each transaction is serialized once, for the request body & its own request log
+		transactions = [serializer.dumps({"transaction": einvoice_json}) for einvoice_json in einvoice_jsons]
+		payload = b'[' + b','.join(transactions) + b']'
+
+		# responses are logged per e-invoice below, so that each invoice has its own request log
+		response = self.make_request('put', url, headers, payload, log=False, retry=True)
+		entries = get_bulk_response_entries(response, get_transaction_document_no)
+
+		results = {}
+		for idx, einvoice in enumerate(einvoices):
+			self.einvoice = einvoice
+			entry = entries.get(einvoice_jsons[idx]['DocDtls']['No'])
+			self.log_einvoice_request(url, headers.copy(), transactions[idx], [entry] if entry else None)
+
+			if not entry:
+				results[einvoice.invoice] = (False, [_('No response received for this invoice.')])
+				continue
+
+			results[einvoice.invoice] = self.handle_bulk_irn_response(entry)
+
+		return results
+
+	def handle_bulk_irn_response(self, entry):
+		response = self.sanitize_response([entry])
+		if not response.get('Success'):
+			return False, response.get('Errors')
+
+		try:
+			response = self.handle_irn_generation_response(response)
+			if not response.get('Success'):
+				return False, response.get('Errors')
+			frappe.db.commit()
+		except Exception as e:
+			# IRN is generated on the portal, the e-invoice will be updated on the next request
+			log_error()
+			return False, get_exception_messages(e)
+
+		return True, []
+
+	@staticmethod
+	def bulk_generate_irn(einvoices):
+		'''Generates IRNs for multiple e-invoices, sending `Bulk Request Size` invoices per request.
+
+		Returns a dict of sales invoice name -> (success, errors)'''
+		einvoices_by_gstin = {}
+		for einvoice in einvoices:
+			einvoices_by_gstin.setdefault(einvoice.seller_gstin, []).append(einvoice)
+
+		results = {}
+		for gstin, gstin_einvoices in einvoices_by_gstin.items():
+			try:
+				connector = CleartaxConnector(gstin)
+			except frappe.ValidationError as e:
+				errors = get_exception_messages(e)
+				results.update({einvoice.invoice: (False, errors) for einvoice in gstin_einvoices})
+				continue
+
+			chunk_size = cint(connector.settings.bulk_request_size) or 25
+			for i in range(0, len(gstin_einvoices), chunk_size):
+				chunk = gstin_einvoices[i:i + chunk_size]
+				try:
+					results.update(connector.make_bulk_irn_request(chunk))
+				except frappe.ValidationError as e:
+					errors = get_exception_messages(e)
+					results.update({einvoice.invoice: (False, errors) for einvoice in chunk})
+
+		return results
+
 	def sanitize_response(self, response):
 		sanitized_response = []
 		for entry in response:
@@ -129,6 +210,11 @@ class CleartaxConnector:
 				# return irn & other info
 				govt_response.update({'Success': True})
 				sanitized_response.append(govt_response)
+			elif self.is_duplicate_irn_response(govt_response):
+				# irn was generated by an earlier attempt, e.g. one that timed out before the response
+				irn_details = frappe._dict(govt_response.get('InfoDtls')[0].get('Desc'))
+				irn_details.update({'Success': True, 'IrnAlreadyGenerated': True})
+				sanitized_response.append(irn_details)
 			else:
 				# return error message list
 				error_details = govt_response.get('ErrorDetails', [])
@@ -148,6 +234,41 @@ class CleartaxConnector:
 
 		return sanitized_response[0] if len(sanitized_response) == 1 else sanitized_response
 
+	def is_duplicate_irn_response(self, govt_response):
+		error_codes = [d.get('error_code') for d in govt_response.get('ErrorDetails') or []]
+		info_details = govt_response.get('InfoDtls') or [{}]
+
+		return '2150' in error_codes and info_details[0].get('InfCd') == 'DUPIRN' \
+			and (info_details[0].get('Desc') or {}).get('Irn')
+
+	def handle_irn_generation_response(self, response):
+		if response.get('IrnAlreadyGenerated'):
+			# duplicate irn response only has the irn & ack details, signed qr code & e-way bill are fetched by irn
+			response = self.make_get_irn_details_request(response.get('Irn'))
+			if not response.get('Success'):
+				return response
+
+		self.handle_successful_irn_generation(response)
+		return response
+
+	def make_get_irn_details_request(self, irn):
+		headers = self.get_headers()
+		url = self.endpoints.irn_details + '?' + urlencode({'irn': irn})
+
+		response = self.make_request('get', url, headers, None)
+		if not isinstance(response, list):
+			response = [response]
+
+		response = self.sanitize_response(response)
+		if response.get('Success') and not response.get('SignedQRCode'):
+			return frappe._dict({
+				'Success': False,
+				'Errors': [_('IRN {} is already generated, but its details could not be fetched. Please try again after some time.')
+					.format(irn)]
+			})
+
+		return response
+
 	def handle_successful_irn_generation(self, response):
 		status = 'IRN Generated'
 		irn = response.get('Irn')
@@ -155,7 +276,7 @@ class CleartaxConnector:
 		ack_date = response.get('AckDt')
 		ewaybill = response.get('EwbNo')
 		ewaybill_validity = response.get('EwbValidTill')
-		qrcode = self.generate_qrcode(response.get('SignedQRCode'))
+		signed_qr_code = response.get('SignedQRCode')
 
 		self.einvoice.update({
 			'irn': irn,
@@ -163,31 +284,12 @@ class CleartaxConnector:
 			'ack_no': ack_no,
 			'ack_date': ack_date,
 			'ewaybill': ewaybill,
-			'qrcode_path': qrcode,
+			'signed_qr_code': signed_qr_code,
 			'ewaybill_validity': ewaybill_validity
 		})
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.submit()
-
-	def generate_qrcode(self, signed_qrcode):
-		doctype = self.einvoice.doctype
-		docname = self.einvoice.name
-		filename = '{} - QRCode.png'.format(docname).replace(os.path.sep, "__")
-
-		qr_image = io.BytesIO()
-		url = qrcreate(signed_qrcode, error='L')
-		url.png(qr_image, scale=2, quiet_zone=1)
-		_file = frappe.get_doc({
-			'doctype': 'File',
-			'file_name': filename,
-			'attached_to_doctype': doctype,
-			'attached_to_name': docname,
-			'attached_to_field': 'qrcode_path',
-			'is_private': 1,
-			'content': qr_image.getvalue()
-		})
-		_file.save()
-		return _file.file_url
+		with metrics.timer('einvoice_submit'):
+			self.einvoice.submit()
 
 	@log_exception
 	def make_cancel_irn_request(self, reason, remark):
@@ -197,7 +299,7 @@ class CleartaxConnector:
 		irn = self.einvoice.irn
 
 		payload = [{'irn': irn, 'CnlRsn': reason, 'CnlRem': remark}]
-		payload = dumps(payload, indent=4)
+		payload = serializer.dumps(payload)
 
 		response = self.make_request('put', url, headers, payload)
 		# Sample Response -> https://docs.cleartax.in/cleartax-for-developers/e-invoicing-api/e-invoicing-api-reference/cleartax-e-invoicing-apis-xml-schema#sample-response-1
@@ -214,9 +316,11 @@ class CleartaxConnector:
 		self.einvoice.status = 'IRN Cancelled'
 		self.einvoice.flags.ignore_validate_update_after_submit = 1
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.save()
+		with metrics.timer('einvoice_save'):
+			self.einvoice.save()
 
 	@staticmethod
+	@profiled
 	def cancel_irn(einvoice, reason, remark):
 		business_gstin = einvoice.seller_gstin
 		connector = CleartaxConnector(business_gstin)
@@ -234,7 +338,7 @@ class CleartaxConnector:
 		eway_bill_json = self.einvoice.get_eway_bill_json()
 
 		payload = [eway_bill_json]
-		payload = dumps(payload, indent=4)
+		payload = serializer.dumps(payload)
 
 		response = self.make_request('post', url, headers, payload)
 		# Sample Response -> https://docs.cleartax.in/cleartax-for-developers/e-invoicing-api/e-invoicing-api-reference/cleartax-e-invoicing-apis-xml-schema#sample-response-3
@@ -251,9 +355,11 @@ class CleartaxConnector:
 		self.einvoice.status = 'E-Way Bill Generated'
 		self.einvoice.flags.ignore_validate_update_after_submit = 1
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.save()
+		with metrics.timer('einvoice_save'):
+			self.einvoice.save()
 
 	@staticmethod
+	@profiled
 	def generate_eway_bill(einvoice):
 		business_gstin = einvoice.seller_gstin
 		connector = CleartaxConnector(business_gstin)
@@ -263,6 +369,78 @@ class CleartaxConnector:
 
 		return success, errors
 
+	@log_exception
+	def make_bulk_eway_bill_request(self, einvoices):
+		headers = self.get_headers()
+		url = self.endpoints.generate_ewaybill
+
+		# e-way bill endpoint takes a list, so the e-way bills of all the e-invoices are sent in one request
+		eway_bills = [serializer.dumps(einvoice.get_eway_bill_json()) for einvoice in einvoices]
+		payload = b'[' + b','.join(eway_bills) + b']'
+
+		# responses are logged per e-invoice below, so that each invoice has its own request log
+		response = self.make_request('post', url, headers, payload, log=False)
+		entries = get_bulk_response_entries(response, get_ewaybill_irn)
+
+		results = {}
+		for idx, einvoice in enumerate(einvoices):
+			self.einvoice = einvoice
+			entry = entries.get(einvoice.irn)
+			self.log_einvoice_request(url, headers.copy(), eway_bills[idx], [entry] if entry else None)
+
+			if not entry:
+				results[einvoice.invoice] = (False, [_('No response received for this invoice.')])
+				continue
+
+			results[einvoice.invoice] = self.handle_bulk_eway_bill_response(entry)
+
+		return results
+
+	def handle_bulk_eway_bill_response(self, entry):
+		response = self.sanitize_response([entry])
+		if not response.get('Success'):
+			return False, response.get('Errors')
+
+		try:
+			self.handle_successful_ewaybill_generation(response)
+			frappe.db.commit()
+		except Exception as e:
+			log_error()
+			return False, get_exception_messages(e)
+
+		return True, []
+
+	@staticmethod
+	@profiled
+	def bulk_generate_eway_bill(einvoices, max_concurrent_requests=None):
+		'''Generates e-way bills for multiple e-invoices with the transport details already set,
+		sending `Bulk Request Size` e-way bills per request.
+
+		Returns a dict of sales invoice name -> (success, errors)'''
+		einvoices_by_gstin = {}
+		for einvoice in einvoices:
+			einvoices_by_gstin.setdefault(einvoice.seller_gstin, []).append(einvoice)
+
+		results = {}
+		for gstin, gstin_einvoices in einvoices_by_gstin.items():
+			try:
+				connector = CleartaxConnector(gstin)
+			except frappe.ValidationError as e:
+				errors = get_exception_messages(e)
+				results.update({einvoice.invoice: (False, errors) for einvoice in gstin_einvoices})
+				continue
+
+			chunk_size = cint(connector.settings.bulk_request_size) or 25
+			for i in range(0, len(gstin_einvoices), chunk_size):
+				chunk = gstin_einvoices[i:i + chunk_size]
+				try:
+					results.update(connector.make_bulk_eway_bill_request(chunk))
+				except frappe.ValidationError as e:
+					errors = get_exception_messages(e)
+					results.update({einvoice.invoice: (False, errors) for einvoice in chunk})
+
+		return results
+
 	@log_exception
 	def make_cancel_ewaybill_request(self, reason, remark):
 		headers = self.get_headers()
@@ -271,7 +449,7 @@ class CleartaxConnector:
 		ewaybill = self.einvoice.ewaybill
 
 		payload = {'ewbNo': ewaybill, 'cancelRsnCode': reason, 'cancelRmrk': remark}
-		payload = dumps(payload, indent=4)
+		payload = serializer.dumps(payload)
 
 		response = self.make_request('post', url, headers, payload)
 		# Sample Response -> https://docs.cleartax.in/cleartax-for-developers/e-invoicing-api/e-invoicing-api-reference/cleartax-e-invoicing-apis-xml-schema#sample-response-4
@@ -287,9 +465,11 @@ class CleartaxConnector:
 		self.einvoice.status = 'E-Way Bill Cancelled'
 		self.einvoice.flags.ignore_validate_update_after_submit = 1
 		self.einvoice.flags.ignore_permissions = 1
-		self.einvoice.save()
+		with metrics.timer('einvoice_save'):
+			self.einvoice.save()
 
 	@staticmethod
+	@profiled
 	def cancel_ewaybill(einvoice, reason, remark):
 		business_gstin = einvoice.seller_gstin
 		connector = CleartaxConnector(business_gstin)
@@ -297,4 +477,27 @@ class CleartaxConnector:
 		response = connector.make_cancel_ewaybill_request(reason, remark)
 		success, errors = response.get('Success'), response.get('Errors')
 
-		return success, errors
\ No newline at end of file
+		return success, errors
+
+def get_bulk_response_entries(response, get_key):
+	'''Returns the entries of a bulk response keyed on the document they are for
+
+	Entries are matched on the document, since the service provider may drop or reorder them'''
+	if not isinstance(response, list):
+		return {}
+
+	entries = {}
+	for entry in response:
+		key = get_key(entry) if isinstance(entry, dict) else None
+		if key:
+			entries.setdefault(key, entry)
+
+	return entries
+
+def get_transaction_document_no(entry):
+	# the e-invoice sent is returned with its irn generation response
+	transaction = entry.get('transaction') or {}
+	return (transaction.get('DocDtls') or {}).get('No')
+
+def get_ewaybill_irn(entry):
+	return entry.get('irn') or (entry.get('ewb_request') or {}).get('Irn')
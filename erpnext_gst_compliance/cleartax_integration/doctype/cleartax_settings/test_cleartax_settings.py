@@ -5,7 +5,11 @@ from __future__ import unicode_literals
 
 import frappe
 import unittest
-from erpnext_gst_compliance.cleartax_integration.cleartax_connector import CleartaxConnector
+from contextlib import contextmanager
+from erpnext_gst_compliance.mock_gsp_server import running_server
+from erpnext_gst_compliance.cleartax_integration.cleartax_connector import CleartaxConnector, get_bulk_response_entries, \
+	get_transaction_document_no
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice.e_invoice import get_einvoice_qrcode
 from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice.test_e_invoice import make_e_invoice
 
 class TestCleartaxSettings(unittest.TestCase):
@@ -104,6 +108,33 @@ class TestCleartaxConnector(unittest.TestCase):
 		self.assertFalse(response.get('Success'))
 		self.assertEqual(len(errors), 2)
 	
+	def test_bulk_irn_response(self):
+		# with error response, e-invoice remains untouched
+		success, errors = self.connector.handle_bulk_irn_response(self.invalid_irn_response[0])
+		self.assertFalse(success)
+		self.assertEqual(len(errors), 2)
+		self.assertFalse(self.connector.einvoice.irn)
+
+		# with successful response
+		success, errors = self.connector.handle_bulk_irn_response(self.valid_irn_response[0])
+		self.assertTrue(success)
+		self.assertFalse(errors)
+		self.assertEqual(self.connector.einvoice.status, 'IRN Generated')
+
+	def test_bulk_response_entries(self):
+		# entries are matched on the document no. of the transaction, irrespective of their order
+		response = [
+			dict(self.invalid_irn_response[0], transaction={'DocDtls': {'No': '_Test Invoice 2'}}),
+			dict(self.valid_irn_response[0], transaction={'DocDtls': {'No': '_Test Invoice 1'}})
+		]
+		entries = get_bulk_response_entries(response, get_transaction_document_no)
+		self.assertIs(entries['_Test Invoice 1'], response[1])
+		self.assertIs(entries['_Test Invoice 2'], response[0])
+		# dropped entries have no response
+		self.assertIsNone(entries.get('_Test Invoice 3'))
+
+		self.assertEqual(get_bulk_response_entries({'error_message': 'Internal Server Error'}, get_transaction_document_no), {})
+
 	def test_irn_cancellation(self):
 		# with successful response
 		response = self.valid_irn_cancel_response
@@ -114,6 +145,61 @@ class TestCleartaxConnector(unittest.TestCase):
 		self.assertEqual(self.connector.einvoice.irn_cancel_date, response.get('CancelDate'))
 		self.assertEqual(self.connector.einvoice.status, 'IRN Cancelled')
 
+	def test_requests_with_mock_server(self):
+		with self.mock_server() as server:
+			connector = CleartaxConnector('27AAECE4835E1ZR')
+			connector.einvoice = self.connector.einvoice
+
+			response = connector.make_irn_request()
+			self.assertTrue(response.get('Success'))
+			self.assertEqual(connector.einvoice.status, 'IRN Generated')
+
+			response = connector.make_cancel_irn_request('1', 'Data Entry Mistake')
+			self.assertTrue(response.get('Success'))
+			self.assertEqual(connector.einvoice.status, 'IRN Cancelled')
+
+			# irn is already cancelled on the portal
+			response = connector.make_cancel_irn_request('1', 'Data Entry Mistake')
+			self.assertFalse(response.get('Success'))
+			self.assertEqual(server.gsp.get_stats()['requests'], 3)
+
+	def test_duplicate_irn_with_mock_server(self):
+		with self.mock_server() as server:
+			connector = CleartaxConnector('27AAECE4835E1ZR')
+			connector.einvoice = self.connector.einvoice
+
+			# irn generated by an earlier attempt whose response was lost
+			details, is_duplicate = server.gsp.generate_irn('27AAECE4835E1ZR', connector.einvoice.get_einvoice_json())
+
+			response = connector.make_irn_request()
+			self.assertTrue(response.get('Success'))
+			self.assertEqual(connector.einvoice.status, 'IRN Generated')
+			self.assertEqual(connector.einvoice.irn, details['Irn'])
+			# full irn details are fetched, since the duplicate irn response has no signed qr code
+			self.assertEqual(connector.einvoice.signed_qr_code, details['SignedQRCode'])
+			# qrcode image isn't rendered on IRN generation, only when it is printed or viewed
+			self.assertFalse(connector.einvoice.qrcode_path)
+			self.assertTrue(get_einvoice_qrcode(connector.einvoice.name).startswith('data:image/'))
+			qrcode_path = connector.einvoice.render_qrcode()
+			self.assertTrue(qrcode_path)
+			self.assertEqual(frappe.db.get_value('Sales Invoice', connector.einvoice.invoice, 'qrcode_image'), qrcode_path)
+			self.assertEqual(len(server.gsp.irns), 1)
+
+	@contextmanager
+	def mock_server(self, **settings):
+		'''Points the connector to a mock server, running for the duration of the block'''
+		cleartax_settings = frappe.get_single('Cleartax Settings')
+		cleartax_settings.update(dict(auth_token='test_auth_token', **settings))
+		cleartax_settings.flags.ignore_validate = True
+		cleartax_settings.save()
+
+		with running_server() as server:
+			frappe.conf.einvoice_gsp_host_override = server.url
+			try:
+				yield server
+			finally:
+				frappe.conf.pop('einvoice_gsp_host_override')
+
 	def tearDown(self):
 		cleartax_settings = frappe.get_single('Cleartax Settings')
 		cleartax_settings.enabled = 0
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Frappe and contributors
+# For license information, please see license.txt
+
+'''Benchmarks for building e-invoice payloads from sales invoices of realistic sizes
+
+Run on a test site with:
+
+	bench --site test_site execute erpnext_gst_compliance.erpnext_gst_compliance.benchmarks.einvoice.run
+	bench --site test_site execute erpnext_gst_compliance.erpnext_gst_compliance.benchmarks.einvoice.run --kwargs "{'update_baselines': 1}"
+
+Every scenario builds a synthetic sales invoice, then builds the e-invoice from it a few times
+timing each phase, counting the DB queries & tracing the peak memory. The results are compared
+against baselines.json & regressions beyond the tolerance are reported. Scenarios without a baseline
+fail the run, so baselines must be saved first on the same machine. All the documents created
+are rolled back once the benchmarks are run.
+'''
+
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import frappe
+import tracemalloc
+from frappe import _
+from contextlib import contextmanager
+
+from erpnext_gst_compliance.utils import get_gst_account_types
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+ITEM_POOL_SIZE = 25
+HSN_CODES = ['990002', '890002']
+
+# e-invoice methods timed individually, in the order they are called while building the e-invoice
+PHASES = [
+	'set_sales_invoice', 'set_gst_tax_rows', 'set_addresses', 'set_invoice_type', 'set_supply_type',
+	'set_seller_details', 'set_buyer_details', 'set_shipping_details', 'set_dispatch_details',
+	'set_item_details', 'set_value_details', 'set_payment_details', 'set_return_doc_reference',
+	'set_invoice_fingerprint', 'set_items', 'validate_uom', 'validate_items', 'get_einvoice_json'
+]
+
+# (gst tax type or None for a non-gst charge, charge type, rate)
+TAX_STRUCTURES = {
+	'none': [],
+	'cgst_sgst': [('cgst', 'On Net Total', 9), ('sgst', 'On Net Total', 9)],
+	'cgst_sgst_cess': [('cgst', 'On Net Total', 9), ('sgst', 'On Net Total', 9), ('cess', 'On Net Total', 1)],
+	'igst': [('igst', 'On Net Total', 18)],
+	'igst_previous_row': [('igst', 'On Net Total', 18), (None, 'On Previous Row Total', 1)]
+}
+
+SCENARIOS = [
+	frappe._dict(name='b2b-cgst-sgst-1', items=1, taxes='cgst_sgst'),
+	frappe._dict(name='b2b-cgst-sgst-cess-50', items=50, taxes='cgst_sgst_cess'),
+	frappe._dict(name='b2b-igst-previous-row-500', items=500, taxes='igst_previous_row'),
+	frappe._dict(name='b2b-cgst-sgst-cess-1000', items=1000, taxes='cgst_sgst_cess'),
+	frappe._dict(name='b2b-igst-1000', items=1000, taxes='igst'),
+	frappe._dict(name='export-500', items=500, taxes='none', export=1),
+	frappe._dict(name='credit-note-500', items=500, taxes='cgst_sgst', credit_note=1)
+]
+
+def run(scenarios=None, repeat=3, tolerance=0.25, update_baselines=False):
+	'''Runs the benchmark scenarios & compares the results against the saved baselines
+
+	:param scenarios: names of the scenarios to run, all by default
+	:param repeat: number of timed runs per scenario, the fastest one is reported
+	:param tolerance: allowed slowdown & memory growth as a fraction of the baseline
+	:param update_baselines: save the results as the new baselines instead of comparing'''
+	scenarios = [s for s in SCENARIOS if not scenarios or s.name in scenarios]
+	baselines = load_baselines()
+
+	results = {}
+	try:
+		for scenario in scenarios:
+			results[scenario.name] = run_scenario(scenario, repeat=repeat)
+	finally:
+		frappe.db.rollback()
+
+	if update_baselines:
+		baselines.update(results)
+		save_baselines(baselines)
+		print_results(results, {})
+		return results
+
+	regressions = get_regressions(results, baselines, tolerance)
+	print_results(results, baselines)
+
+	missing_baselines = [scenario for scenario in results if not baselines.get(scenario)]
+	if missing_baselines:
+		# without baselines nothing is compared, so the run must not pass as free of regressions
+		frappe.throw(_('No baselines saved in {} for the scenarios: {}. Run with update_baselines to save them.')
+			.format(BASELINES_PATH, ', '.join(missing_baselines)), title=_('Benchmark Baselines Missing'))
+
+	if regressions:
+		frappe.throw(regressions, title=_('Benchmark Regressions'), as_list=1)
+
+	return results
+
+def run_scenario(scenario, repeat=3):
+	sales_invoice = make_sales_invoice(
+		scenario.items, scenario.taxes,
+		export=scenario.get('export'), credit_note=scenario.get('credit_note')
+	)
+
+	# first run warms up the caches, so it is used only to count queries & trace memory
+	with count_queries() as counter:
+		tracemalloc.start()
+		try:
+			build_einvoice(sales_invoice.name)
+			current_memory, peak_memory = tracemalloc.get_traced_memory()
+		finally:
+			tracemalloc.stop()
+
+	best_run = None
+	for _i in range(repeat):
+		timings = {}
+		start = time.perf_counter()
+		build_einvoice(sales_invoice.name, timings)
+		timings['total'] = time.perf_counter() - start
+
+		if not best_run or timings['total'] < best_run['total']:
+			best_run = timings
+
+	return {
+		'items': scenario.items,
+		'total': round(best_run.pop('total'), 6),
+		'queries': counter.count,
+		'peak_memory': peak_memory,
+		'phases': {phase: round(best_run.get(phase, 0), 6) for phase in PHASES}
+	}
+
+def build_einvoice(sales_invoice_name, timings=None):
+	einvoice = frappe.new_doc('E Invoice')
+	einvoice.invoice = sales_invoice_name
+
+	if timings is not None:
+		for phase in PHASES:
+			setattr(einvoice, phase, timed(getattr(einvoice, phase), phase, timings))
+
+	einvoice.sync_with_sales_invoice()
+	# child rows are created once before saving
+	einvoice.set_items()
+	einvoice.validate_uom()
+	einvoice.validate_items()
+	einvoice.get_einvoice_json()
+
+	return einvoice
+
+def timed(fn, phase, timings):
+	def wrapper(*args, **kwargs):
+		start = time.perf_counter()
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+	return wrapper
+
+@contextmanager
+def count_queries():
+	counter = frappe._dict(count=0)
+	sql = frappe.db.sql
+
+	def counted_sql(*args, **kwargs):
+		counter.count += 1
+		return sql(*args, **kwargs)
+
+	frappe.db.sql = counted_sql
+	try:
+		yield counter
+	finally:
+		# removing the instance attribute restores the bound method
+		del frappe.db.sql
+
+def make_sales_invoice(item_count, tax_structure, export=False, credit_note=False):
+	'''Inserts a draft sales invoice with the given number of items & tax structure'''
+	from erpnext.accounts.doctype.sales_invoice.sales_invoice import make_sales_return
+	from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import get_sales_invoice_for_e_invoice
+
+	sales_invoice = get_sales_invoice_for_e_invoice()
+	template = sales_invoice.items[0]
+	item_codes = get_item_pool()
+
+	sales_invoice.set('items', [])
+	for i in range(item_count):
+		item_code = item_codes[i % len(item_codes)]
+		sales_invoice.append('items', {
+			'item_code': item_code,
+			'item_name': item_code,
+			'gst_hsn_code': HSN_CODES[i % len(HSN_CODES)],
+			'qty': (i % 7) + 1,
+			'rate': 100 + (i % 13) * 25.5,
+			'uom': 'Nos',
+			'conversion_factor': 1,
+			'income_account': template.income_account,
+			'expense_account': template.expense_account,
+			'cost_center': template.cost_center,
+			'warehouse': template.warehouse
+		})
+
+	sales_invoice.set('taxes', [])
+	for tax in get_tax_rows(sales_invoice.company, tax_structure, template.cost_center):
+		sales_invoice.append('taxes', tax)
+
+	if export:
+		sales_invoice.gst_category = 'Overseas'
+		sales_invoice.export_type = 'Without Payment of Tax'
+
+	sales_invoice.insert()
+
+	if credit_note:
+		# return against must be submitted, but submitting an eligible invoice needs an IRN
+		# since it is all rolled back, the original invoice is only marked as submitted
+		sales_invoice.db_set('docstatus', 1)
+		sales_invoice = make_sales_return(sales_invoice.name)
+		sales_invoice.insert()
+
+	return sales_invoice
+
+def get_item_pool():
+	from erpnext.stock.doctype.item.test_item import make_item
+
+	item_codes = []
+	for i in range(ITEM_POOL_SIZE):
+		item_code = '_Test E Invoice Benchmark Item {:02d}'.format(i + 1)
+		make_item(item_code, {
+			'is_stock_item': 0,
+			'stock_uom': 'Nos',
+			'gst_hsn_code': HSN_CODES[i % len(HSN_CODES)]
+		})
+		item_codes.append(item_code)
+
+	return item_codes
+
+def get_tax_rows(company, tax_structure, cost_center):
+	gst_accounts = {}
+	for account, tax_type in get_gst_account_types(company).items():
+		gst_accounts.setdefault(tax_type, account)
+
+	gst_account_names = list(gst_accounts.values()) or ['']
+	other_charges_account = frappe.db.get_value('Account', {
+		'company': company,
+		'is_group': 0,
+		'account_type': 'Tax',
+		'name': ['not in', gst_account_names]
+	})
+
+	taxes = []
+	for tax_type, charge_type, rate in TAX_STRUCTURES[tax_structure]:
+		account_head = gst_accounts.get(tax_type) if tax_type else other_charges_account
+		if not account_head:
+			# cess account is not set in every test company
+			continue
+
+		tax = {
+			'charge_type': charge_type,
+			'account_head': account_head,
+			'description': account_head,
+			'rate': rate,
+			'cost_center': cost_center
+		}
+		if charge_type.startswith('On Previous Row'):
+			tax['row_id'] = len(taxes)
+
+		taxes.append(tax)
+
+	return taxes
+
+def get_regressions(results, baselines, tolerance):
+	regressions = []
+	for scenario, result in results.items():
+		baseline = baselines.get(scenario)
+		if not baseline:
+			continue
+
+		if result['total'] > baseline['total'] * (1 + tolerance):
+			regressions.append(_('{}: took {:.3f}s against a baseline of {:.3f}s')
+				.format(scenario, result['total'], baseline['total']))
+
+		if result['queries'] > baseline['queries']:
+			regressions.append(_('{}: made {} queries against a baseline of {}')
+				.format(scenario, result['queries'], baseline['queries']))
+
+		if result['peak_memory'] > baseline['peak_memory'] * (1 + tolerance):
+			regressions.append(_('{}: used {} KiB at peak against a baseline of {} KiB')
+				.format(scenario, result['peak_memory'] // 1024, baseline['peak_memory'] // 1024))
+
+	return regressions
+
+def print_results(results, baselines):
+	row_format = '{:<28} {:>6} {:>10} {:>10} {:>8} {:>12}'
+	print(row_format.format('Scenario', 'Items', 'Total (s)', 'Baseline', 'Queries', 'Peak (KiB)'))
+
+	for scenario, result in results.items():
+		baseline = baselines.get(scenario) or {}
+		print(row_format.format(
+			scenario, result['items'], '{:.4f}'.format(result['total']),
+			'{:.4f}'.format(baseline['total']) if baseline else '-',
+			result['queries'], result['peak_memory'] // 1024
+		))
+
+		slowest_phases = sorted(result['phases'].items(), key=lambda d: d[1], reverse=True)[:3]
+		print('    ' + ', '.join('{} {:.4f}s'.format(phase, duration) for phase, duration in slowest_phases))
+
+def load_baselines():
+	if not os.path.exists(BASELINES_PATH):
+		return {}
+
+	with open(BASELINES_PATH) as f:
+		return json.load(f)
+
+def save_baselines(baselines):
+	with open(BASELINES_PATH, 'w') as f:
+		json.dump(baselines, f, indent=1, sort_keys=True)
+		f.write('\n')
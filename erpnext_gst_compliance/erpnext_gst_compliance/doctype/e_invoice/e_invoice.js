@@ -3,6 +3,14 @@
 
 frappe.ui.form.on('E Invoice', {
 	refresh(frm) {
+		if (frm.doc.docstatus == 1 && frm.doc.signed_qr_code && !frm.doc.qrcode_path) {
+			// only the signed qr code is stored on IRN generation, the image is rendered when first viewed
+			frm.call({
+				'doc': frm.doc,
+				'method': 'render_qrcode',
+				'callback': () => frm.reload_doc()
+			});
+		}
 	},
 
 	invoice(frm) {
@@ -4,18 +4,52 @@
 
 from __future__ import unicode_literals
 
+import io
+import os
 import six
+import base64
 import frappe
+import hashlib
 from frappe import _
 from json import loads, dumps
 from frappe.model import default_fields
 from frappe.model.document import Document
 from frappe.utils.data import cint, format_date, getdate, flt
 from frappe.core.doctype.version.version import get_diff
-
-from erpnext.regional.india.utils import get_gst_accounts
+from pyqrcode import create as qrcreate
+
+from erpnext_gst_compliance.utils import get_gst_account_types
+from erpnext_gst_compliance.erpnext_gst_compliance import metrics
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice.item_table import ItemTable
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoicing_settings.e_invoicing_settings import get_einvoicing_rules
+
+ADDRESS_FIELDS = ['name', 'modified', 'address_title', 'gstin', 'address_line1', 'address_line2',
+	'city', 'pincode', 'gst_state_number']
+
+# rendered qrcode images of the prints are cached for a day
+QRCODE_CACHE_EXPIRY = 24 * 60 * 60
+
+# validated seller details keyed on (site, address name, address modified)
+seller_details_cache = {}
+
+# sales invoice fields used to build e-invoice, any change in these must be validated after IRN generation
+# fields fetched into the e-invoice with fetch_from are added to the invoice fields by get_fingerprint_fields
+FINGERPRINT_FIELDS = {
+	'invoice': ['company', 'customer', 'gst_category', 'is_return', 'return_against', 'posting_date',
+		'company_address', 'customer_address', 'shipping_address_name', 'dispatch_address_name',
+		'base_net_total', 'base_grand_total', 'base_rounded_total', 'grand_total', 'rounded_total',
+		'base_rounding_adjustment', 'is_pos', 'base_paid_amount', 'transporter'],
+	'items': ['name', 'item_code', 'item_name', 'gst_hsn_code', 'qty', 'uom', 'taxable_value'],
+	'taxes': ['account_head', 'charge_type', 'row_id', 'tax_amount', 'tax_amount_after_discount_amount',
+		'base_tax_amount_after_discount_amount', 'base_total', 'item_wise_tax_detail'],
+	'payments': ['mode_of_payment', 'amount']
+}
 
 class EInvoice(Document):
+	def before_validate(self):
+		# runs even if validations are ignored, e.g. while creating e-invoices of existing invoices
+		self.set_items()
+
 	def validate(self):
 		self.validate_uom()
 		self.validate_items()
@@ -26,6 +60,12 @@ class EInvoice(Document):
 			msg += _("You must generate IRN for the sales invoice to submit this e-invoice.")
 			frappe.throw(msg, title=_("Missing IRN"))
 
+	def load_from_db(self):
+		super(EInvoice, self).load_from_db()
+		# rows are the source of truth of a loaded e-invoice
+		self.item_table = None
+		self.flags.items_pending = False
+
 	def on_update(self):
 		self.update_sales_invoice()
 
@@ -48,9 +88,31 @@ class EInvoice(Document):
 	def on_cancel(self):
 		frappe.db.set_value('Sales Invoice', self.invoice, 'e_invoice', self.name, update_modified=False)
 
+	@frappe.whitelist()
+	def render_qrcode(self):
+		'''Renders the QR code image when the submitted e-invoice is first viewed & returns its file url
+
+		Only the signed QR code is stored on IRN generation, so that it doesn't wait on rendering the image'''
+		if self.qrcode_path or not self.signed_qr_code:
+			return self.qrcode_path
+
+		file_url = get_qrcode_file(self.signed_qr_code, self.doctype, self.name)
+		self.db_set('qrcode_path', file_url, update_modified=False)
+		frappe.db.set_value('Sales Invoice', self.invoice, 'qrcode_image', file_url, update_modified=False)
+
+		return file_url
+
 	@frappe.whitelist()
 	def fetch_invoice_details(self):
+		self.set_invoice_details()
+		# child rows are shown in the form
+		self.set_items()
+
+	@metrics.timed('fetch_invoice_details')
+	def set_invoice_details(self):
 		self.set_sales_invoice()
+		self.set_gst_tax_rows()
+		self.set_addresses()
 		self.set_invoice_type()
 		self.set_supply_type()
 		self.set_seller_details()
@@ -61,10 +123,52 @@ class EInvoice(Document):
 		self.set_value_details()
 		self.set_payment_details()
 		self.set_return_doc_reference()
+		self.set_invoice_fingerprint()
 
+	@metrics.timed('sales_invoice_load')
 	def set_sales_invoice(self):
 		self.sales_invoice = frappe.get_doc('Sales Invoice', self.invoice)
 
+	def set_gst_tax_rows(self):
+		'''Classifies the tax rows of the sales invoice & parses their item wise tax details once per invoice'''
+		gst_account_types = get_gst_account_types(self.company)
+
+		self.gst_tax_rows = []
+		for t in self.sales_invoice.taxes:
+			# igst, cgst, sgst, cess or None for non-gst accounts
+			tax_type = gst_account_types.get(t.account_head)
+
+			# this contains item wise tax rate & tax amount (incl. discount)
+			item_wise_tax_detail = {}
+			if tax_type and t.tax_amount:
+				item_wise_tax_detail = loads(t.item_wise_tax_detail)
+
+			self.gst_tax_rows.append(frappe._dict({
+				'tax': t,
+				'tax_type': tax_type,
+				'item_wise_tax_detail': item_wise_tax_detail
+			}))
+
+	def set_addresses(self):
+		'''Fetches all the addresses referenced in the sales invoice with a single query'''
+		address_names = {
+			self.sales_invoice.get(fieldname) for fieldname in
+			['company_address', 'customer_address', 'shipping_address_name', 'dispatch_address_name']
+		}
+		address_names = [d for d in address_names if d]
+
+		self.addresses = {}
+		if address_names:
+			addresses = frappe.get_all('Address', filters={'name': ['in', address_names]}, fields=ADDRESS_FIELDS)
+			self.addresses = {d.name: d for d in addresses}
+
+	def get_address(self, address_name):
+		address = self.addresses.get(address_name)
+		if not address:
+			frappe.throw(_('Address {} not found.').format(address_name), title=_('Missing Address'))
+
+		return address
+
 	def set_invoice_type(self):
 		self.invoice_type = 'CRN' if self.sales_invoice.is_return else 'INV'
 
@@ -81,26 +185,9 @@ class EInvoice(Document):
 		if not company_address:
 			frappe.throw(_('Company address must be set to be able to generate e-invoice.'))
 
-		seller_address = frappe.get_all('Address', {'name': company_address}, ['*'])[0]
-		mandatory_field_label_map = {
-			'gstin': 'GSTIN',
-			'address_line1': 'Address Lines',
-			'city': 'City',
-			'pincode': 'Pincode',
-			'gst_state_number': 'State Code'
-		}
-		for field, field_label in mandatory_field_label_map.items():
-			if not seller_address[field]:
-				frappe.throw(_('Company address {} must have {} set to be able to generate e-invoice.')
-					.format(company_address, field_label))
-
+		seller_address = self.get_address(company_address)
 		self.seller_legal_name = self.company
-		self.seller_gstin = seller_address.gstin
-		self.seller_location = seller_address.city
-		self.seller_pincode = seller_address.pincode
-		self.seller_address_line_1 = seller_address.address_line1
-		self.seller_address_line_2 = seller_address.address_line2
-		self.seller_state_code = seller_address.gst_state_number
+		self.update(get_seller_details(seller_address))
 
 	def set_buyer_details(self):
 		customer_address = self.sales_invoice.customer_address
@@ -108,7 +195,7 @@ class EInvoice(Document):
 			frappe.throw(_('Customer address must be set to be able to generate e-invoice.'))
 
 		is_export = self.supply_type == 'EXPWOP'
-		buyer_address = frappe.get_all('Address', {'name': customer_address}, ['*'])[0]
+		buyer_address = self.get_address(customer_address)
 		mandatory_field_label_map = {
 			'gstin': 'GSTIN',
 			'address_line1': 'Address Lines',
@@ -146,7 +233,7 @@ class EInvoice(Document):
 		shipping_address_name = self.sales_invoice.shipping_address_name
 		if shipping_address_name:
 			is_export = self.supply_type == 'EXPWOP'
-			shipping_address = frappe.get_all('Address', {'name': shipping_address_name}, ['*'])[0]
+			shipping_address = self.get_address(shipping_address_name)
 
 			self.shipping_legal_name = shipping_address.address_title
 			self.shipping_gstin = shipping_address.gstin
@@ -165,7 +252,7 @@ class EInvoice(Document):
 	def set_dispatch_details(self):
 		dispatch_address_name = self.sales_invoice.dispatch_address_name
 		if dispatch_address_name:
-			dispatch_address = frappe.get_all('Address', {'name': dispatch_address_name}, ['*'])[0]
+			dispatch_address = self.get_address(dispatch_address_name)
 
 			self.dispatch_legal_name = dispatch_address.address_title
 			self.dispatch_location = dispatch_address.city
@@ -175,143 +262,128 @@ class EInvoice(Document):
 			self.dispatch_state_code = dispatch_address.gst_state_number
 
 	def set_item_details(self):
-		sales_invoice_item_names = [d.name for d in self.sales_invoice.items]
+		# all the calculations use the table, child rows are created from it only once before saving
+		self.item_table = self.get_item_table_from_invoice()
+		self.flags.items_pending = True
+		self.set_calculated_item_totals()
+
+	def set_items(self):
+		'''Creates or updates the child rows from the item table built from the sales invoice'''
+		if not self.flags.items_pending:
+			return
+
+		sales_invoice_item_names = self.item_table['si_item_ref']
 		e_invoice_item_names = [d.si_item_ref for d in self.items]
 		item_added_or_removed = sales_invoice_item_names != e_invoice_item_names
 
 		if self.items and not item_added_or_removed:
-			self.update_items_from_invoice()
+			for idx, einvoice_item in enumerate(self.items):
+				einvoice_item.update(self.item_table.get_row(idx))
 		else:
-			self.fetch_items_from_invoice()
+			self.set('items', self.item_table.get_rows())
+
+		self.flags.items_pending = False
 
-	def fetch_items_from_invoice(self):
+	def get_item_table_from_invoice(self):
+		item_table = ItemTable()
 		for item in self.sales_invoice.items:
 			if not item.gst_hsn_code:
 				frappe.throw(_('Row #{}: Item {} must have HSN code set to be able to generate e-invoice.')
 					.format(item.idx, item.item_code))
 
-			is_service_item = item.gst_hsn_code[:2] == "99"
-
+			taxable_value = abs(item.taxable_value)
 			if flt(item.qty) == 0.0:
-				rate = abs(item.taxable_value)
+				rate = taxable_value
 			else:
-				rate = abs((abs(item.taxable_value)) / item.qty)
+				rate = abs(taxable_value / item.qty)
 
-			einvoice_item = frappe._dict({
+			gst_rate, cgst_amount, sgst_amount, igst_amount, cess_rate, cess_amount, cess_nadv_amount = \
+				self.get_item_tax_details(item.item_code or item.item_name, taxable_value)
+			other_charges = 0
+
+			item_table.append({
 				'si_item_ref': item.name,
 				'item_code': item.item_code,
 				'item_name': item.item_name,
-				'is_service_item': is_service_item,
+				'is_service_item': item.gst_hsn_code[:2] == "99",
 				'hsn_code': item.gst_hsn_code,
 				'quantity': abs(item.qty),
 				'discount': 0,
 				'unit': item.uom,
 				'rate': rate,
-				'amount': abs(item.taxable_value),
-				'taxable_value': abs(item.taxable_value)
-			})
-
-			self.set_item_tax_details(einvoice_item)
-
-			einvoice_item.total_item_value = abs(
-				einvoice_item.taxable_value + einvoice_item.igst_amount +
-				einvoice_item.sgst_amount + einvoice_item.cgst_amount + 
-				einvoice_item.cess_amount + einvoice_item.cess_nadv_amount +
-				einvoice_item.other_charges
-			)
-			self.append('items', einvoice_item)
-
-		self.set_calculated_item_totals()
-
-	def update_items_from_invoice(self):
-		for i, einvoice_item in enumerate(self.items):
-			item = self.sales_invoice.items[i]
-
-			if not item.gst_hsn_code:
-				frappe.throw(_('Row #{}: Item {} must have HSN code set to be able to generate e-invoice.')
-					.format(item.idx, item.item_code))
-
-			is_service_item = item.gst_hsn_code[:2] == "99"
-
-			einvoice_item.update({
-				'item_code': item.item_code,
-				'item_name': item.item_name,
-				'is_service_item': is_service_item,
-				'hsn_code': item.gst_hsn_code,
-				'quantity': abs(item.qty),
-				'discount': 0,
-				'unit': item.uom,
-				'rate': abs((abs(item.taxable_value)) / item.qty),
-				'amount': abs(item.taxable_value),
-				'taxable_value': abs(item.taxable_value)
+				'amount': taxable_value,
+				'taxable_value': taxable_value,
+				'gst_rate': gst_rate,
+				'cgst_amount': cgst_amount,
+				'sgst_amount': sgst_amount,
+				'igst_amount': igst_amount,
+				'cess_rate': cess_rate,
+				'cess_amount': cess_amount,
+				'cess_nadv_amount': cess_nadv_amount,
+				'other_charges': other_charges,
+				'total_item_value': abs(
+					taxable_value + igst_amount + sgst_amount + cgst_amount +
+					cess_amount + cess_nadv_amount + other_charges
+				)
 			})
 
-			self.set_item_tax_details(einvoice_item)
+		return item_table
 
-			einvoice_item.total_item_value = abs(
-				einvoice_item.taxable_value + einvoice_item.igst_amount +
-				einvoice_item.sgst_amount + einvoice_item.cgst_amount + 
-				einvoice_item.cess_amount + einvoice_item.cess_nadv_amount +
-				einvoice_item.other_charges
-			)
+	def get_item_table(self):
+		'''Returns the column wise items, built from the child rows if the e-invoice was not fetched from the sales invoice'''
+		item_table = getattr(self, 'item_table', None)
+		if item_table is None:
+			# not cached, since rows of a loaded e-invoice may be edited
+			item_table = ItemTable.from_rows(self.items)
 
-		self.set_calculated_item_totals()
+		return item_table
 
 	def set_calculated_item_totals(self):
-		item_total_fields = ['items_ass_value', 'items_igst', 'items_sgst', 'items_cgst',
-			'items_cess', 'items_cess_nadv', 'items_other_charges', 'items_total_value']
-
-		for field in item_total_fields:
-			self.set(field, 0)
-
-		for item in self.items:
-			self.items_ass_value += item.taxable_value
-			self.items_igst += item.igst_amount
-			self.items_sgst += item.sgst_amount
-			self.items_cess += item.cess_amount
-			self.items_cess_nadv += item.cess_nadv_amount
-			self.items_other_charges += item.other_charges
-			self.items_total_value += item.total_item_value
-
-	def set_item_tax_details(self, item):
-		gst_accounts = get_gst_accounts(self.company)
-		gst_accounts_list = [d for accounts in gst_accounts.values() for d in accounts if d]
-
-		for attr in ['gst_rate', 'cgst_amount',  'sgst_amount', 'igst_amount',
-			'cess_rate', 'cess_amount', 'cess_nadv_amount', 'other_charges']:
-			item.update({ attr: 0 })
-
-		for t in self.sales_invoice.taxes:
-			is_applicable = t.tax_amount and t.account_head in gst_accounts_list
+		item_table = self.item_table
+
+		self.items_ass_value = item_table.get_total('taxable_value')
+		self.items_igst = item_table.get_total('igst_amount')
+		self.items_sgst = item_table.get_total('sgst_amount')
+		self.items_cgst = item_table.get_total('cgst_amount')
+		self.items_cess = item_table.get_total('cess_amount')
+		self.items_cess_nadv = item_table.get_total('cess_nadv_amount')
+		self.items_other_charges = item_table.get_total('other_charges')
+		self.items_total_value = item_table.get_total('total_item_value')
+
+	def get_item_tax_details(self, item_key, taxable_value):
+		'''Returns (gst rate, cgst, sgst, igst, cess rate, cess & cess non advol amount) of an item'''
+		gst_rate = cess_rate = cess_amount = cess_nadv_amount = 0
+		gst_amounts = {'cgst': 0, 'sgst': 0, 'igst': 0}
+
+		for tax_row in self.gst_tax_rows:
+			t = tax_row.tax
+			is_applicable = t.tax_amount and tax_row.tax_type
 			if is_applicable:
-				# this contains item wise tax rate & tax amount (incl. discount)
-				item_tax_detail = loads(t.item_wise_tax_detail).get(item.item_code or item.item_name)
+				item_tax_detail = tax_row.item_wise_tax_detail.get(item_key)
 
 				item_tax_rate = item_tax_detail[0]
 				# item tax amount excluding discount amount
-				item_tax_amount = (item_tax_rate / 100) * item.taxable_value
+				item_tax_amount = (item_tax_rate / 100) * taxable_value
 
-				if t.account_head in gst_accounts.cess_account:
+				if tax_row.tax_type == 'cess':
 					item_tax_amount_after_discount = item_tax_detail[1]
 					if t.charge_type == 'On Item Quantity':
-						item.cess_nadv_amount += abs(item_tax_amount_after_discount)
+						cess_nadv_amount += abs(item_tax_amount_after_discount)
 					else:
-						item.cess_rate += item_tax_rate
-						item.cess_amount += abs(item_tax_amount_after_discount)
-
-				for tax_type in ['igst', 'cgst', 'sgst']:
-					if t.account_head in gst_accounts[f'{tax_type}_account']:
-						item.gst_rate += item_tax_rate
-						amt_fieldname = f'{tax_type}_amount'
-						item.update({
-							amt_fieldname: item.get(amt_fieldname, 0) + abs(item_tax_amount)
-						})
+						cess_rate += item_tax_rate
+						cess_amount += abs(item_tax_amount_after_discount)
+				else:
+					gst_rate += item_tax_rate
+					gst_amounts[tax_row.tax_type] += abs(item_tax_amount)
 			else:
 				# TODO: other charges per item
 				pass
 
+		return (gst_rate, gst_amounts['cgst'], gst_amounts['sgst'], gst_amounts['igst'],
+			cess_rate, cess_amount, cess_nadv_amount)
+
 	def set_value_details(self):
-		self.ass_value = abs(sum([i.taxable_value for i in self.get('items')]))
+		self.ass_value = abs(self.item_table.get_total('taxable_value'))
 		self.invoice_discount = 0
 		self.round_off_amount = self.sales_invoice.base_rounding_adjustment
 		self.base_invoice_value = abs(self.sales_invoice.base_rounded_total) or abs(self.sales_invoice.base_grand_total)
@@ -320,9 +392,6 @@ class EInvoice(Document):
 		self.set_invoice_tax_details()
 
 	def set_invoice_tax_details(self):
-		gst_accounts = get_gst_accounts(self.company)
-		gst_accounts_list = [d for accounts in gst_accounts.values() for d in accounts if d]
-
 		self.cgst_value = 0
 		self.sgst_value = 0
 		self.igst_value = 0
@@ -330,28 +399,27 @@ class EInvoice(Document):
 		self.other_charges = 0
 		considered_rows = []
 
-		for t in self.sales_invoice.taxes:
+		for tax_row in self.gst_tax_rows:
+			t = tax_row.tax
 			tax_amount = t.base_tax_amount_after_discount_amount
 
-			if t.account_head in gst_accounts_list:
-				if t.account_head in gst_accounts.cess_account:
+			if tax_row.tax_type:
+				if tax_row.tax_type == 'cess':
 					# using after discount amt since item also uses after discount amt for cess calc
 					self.cess_value += abs(t.base_tax_amount_after_discount_amount)
+				else:
+					new_value = self.get(f'{tax_row.tax_type}_value') + abs(tax_amount)
+					self.set(f'{tax_row.tax_type}_value', new_value)
 
-				for tax in ['igst', 'cgst', 'sgst']:
-					if t.account_head in gst_accounts[f'{tax}_account']:
-						new_value = self.get(f'{tax}_value') + abs(tax_amount)
-						self.set(f'{tax}_value', new_value)
-
-					self.update_other_charges(t, gst_accounts_list, considered_rows)
+				self.update_other_charges(t, considered_rows)
 			else:
 				self.other_charges += abs(tax_amount)
 	
-	def update_other_charges(self, tax_row, gst_accounts_list, considered_rows):
+	def update_other_charges(self, tax_row, considered_rows):
 		taxes = self.sales_invoice.get('taxes')
 		prev_row_id = cint(tax_row.row_id) - 1
 
-		if tax_row.account_head in gst_accounts_list and prev_row_id not in considered_rows:
+		if prev_row_id not in considered_rows:
 			if tax_row.charge_type == 'On Previous Row Amount':
 				amount = taxes[prev_row_id].tax_amount_after_discount_amount
 				self.other_charges -= abs(amount)
@@ -378,6 +446,10 @@ class EInvoice(Document):
 			original_invoice_date = frappe.db.get_value('Sales Invoice', self.sales_invoice.return_against, 'posting_date')
 			self.previous_document_date = format_date(original_invoice_date, 'dd/mm/yyyy')
 
+	def set_invoice_fingerprint(self):
+		self.invoice_fingerprint = get_invoice_fingerprint(self.sales_invoice)
+
+	@metrics.timed('json_build')
 	def get_einvoice_json(self):
 		einvoice_json = {
 			"Version": str(self.version),
@@ -468,28 +540,40 @@ class EInvoice(Document):
 		return addresses
 
 	def get_item_list_json(self):
+		item_table = self.get_item_table()
+		columns = zip(
+			item_table['item_name'], item_table['is_service_item'], item_table['hsn_code'],
+			item_table['quantity'], item_table['unit'], item_table['rate'], item_table['amount'],
+			item_table['discount'], item_table['taxable_value'], item_table['gst_rate'],
+			item_table['igst_amount'], item_table['cgst_amount'], item_table['sgst_amount'],
+			item_table['cess_rate'], item_table['cess_amount'], item_table['cess_nadv_amount'],
+			item_table['other_charges'], item_table['total_item_value']
+		)
+
 		item_list = []
-		for row in self.items:
+		for idx, (item_name, is_service_item, hsn_code, quantity, unit, rate, amount, discount, taxable_value,
+			gst_rate, igst_amount, cgst_amount, sgst_amount, cess_rate, cess_amount, cess_nadv_amount,
+			other_charges, total_item_value) in enumerate(columns, 1):
 			item = {
-				"SlNo": str(row.idx),
-				"PrdDesc": row.item_name,
-				"IsServc": "Y" if row.is_service_item else "N",
-				"HsnCd": row.hsn_code,
-				"Qty": row.quantity,
-				"Unit": row.unit,
-				"UnitPrice": row.rate,
-				"TotAmt": row.amount,
-				"Discount": row.discount,
-				"AssAmt": row.taxable_value,
-				"GstRt": row.gst_rate,
-				"IgstAmt": row.igst_amount,
-				"CgstAmt": row.cgst_amount,
-				"SgstAmt": row.sgst_amount,
-				"CesRt": row.cess_rate,
-				"CesAmt": row.cess_amount,
-				"CesNonAdvlAmt": row.cess_nadv_amount,
-				"OthChrg": row.other_charges,
-				"TotItemVal": row.total_item_value
+				"SlNo": str(idx),
+				"PrdDesc": item_name,
+				"IsServc": "Y" if is_service_item else "N",
+				"HsnCd": hsn_code,
+				"Qty": quantity,
+				"Unit": unit,
+				"UnitPrice": rate,
+				"TotAmt": amount,
+				"Discount": discount,
+				"AssAmt": taxable_value,
+				"GstRt": gst_rate,
+				"IgstAmt": igst_amount,
+				"CgstAmt": cgst_amount,
+				"SgstAmt": sgst_amount,
+				"CesRt": cess_rate,
+				"CesAmt": cess_amount,
+				"CesNonAdvlAmt": cess_nadv_amount,
+				"OthChrg": other_charges,
+				"TotItemVal": total_item_value
 			}
 			item_list.append(item)
 		return {
@@ -587,27 +671,24 @@ class EInvoice(Document):
 		# to fetch details from 'fetch_from' fields
 		self._action = 'save'
 		self._validate_links()
-		self.fetch_invoice_details()
+		self.set_invoice_details()
 
 	def validate_items(self):
 		error_list = []
-		for item in self.items:
-			if (item.cgst_amount or item.sgst_amount) and item.igst_amount:
-				error_list.append(_('Row #{}: Invalid value of Tax Amount, provide either IGST or both SGST and CGST.')
-					.format(item.idx))
-			
-			if item.gst_rate not in [0.000, 0.100, 0.250, 0.500, 1.000, 1.500, 3.000, 5.000, 7.500, 12.000, 18.000, 28.000]:
-				error_list.append(_('Row #{}: Invalid GST Tax rate. Please correct the Tax Rate Values and try again.')
-					.format(item.idx))
-
-			total_gst_amount = item.cgst_amount + item.sgst_amount + item.igst_amount
-			if abs((item.taxable_value * item.gst_rate / 100) - total_gst_amount) > 1:
-				error_list.append(_('Row #{}: Invalid GST Tax rate. Please correct the Tax Rate Values and try again.')
-					.format(item.idx))
-
-			if not item.hsn_code:
-				error_list.append(_('Row #{}: HSN Code is mandatory for e-invoice generation.')
-					.format(item.idx))
+		item_table = self.get_item_table()
+
+		for idx in item_table.get_mixed_tax_rows():
+			error_list.append(_('Row #{}: Invalid value of Tax Amount, provide either IGST or both SGST and CGST.')
+				.format(idx + 1))
+
+		invalid_gst_rate_rows = set(item_table.get_invalid_gst_rate_rows() + item_table.get_tax_mismatch_rows())
+		for idx in sorted(invalid_gst_rate_rows):
+			error_list.append(_('Row #{}: Invalid GST Tax rate. Please correct the Tax Rate Values and try again.')
+				.format(idx + 1))
+
+		for idx in item_table.get_missing_hsn_code_rows():
+			error_list.append(_('Row #{}: HSN Code is mandatory for e-invoice generation.')
+				.format(idx + 1))
 
 		if abs(self.base_invoice_value - (self.items_total_value - self.invoice_discount + self.other_charges + self.round_off_amount)) > 1:
 			msg = _('Invalid Total Invoice Value.') + ' '
@@ -619,10 +700,11 @@ class EInvoice(Document):
 			frappe.throw(error_list, title=_('E Invoice Validation Failed'), as_list=1)
 
 	def validate_uom(self):
+		item_table = self.get_item_table()
 		valid_uoms = ['BAG', 'BAL', 'BDL', 'BKL', 'BOU', 'BOX', 'BTL', 'BUN', 'CAN', 'CCM', 'CMS', 'CBM', 'CTN', 'DOZ', 'DRM', 'GGK', 'GMS', 'GRS', 'GYD', 'KGS', 'KLR', 'KME', 'LTR', 'MLS', 'MLT', 'MTR', 'MTS', 'NOS', 'OTH', 'PAC', 'PCS', 'PRS', 'QTL', 'ROL', 'SET', 'SQF', 'SQM', 'SQY', 'TBS', 'TGM', 'THD', 'TON', 'TUB', 'UGS', 'UNT', 'YD']
-		for item in self.items:
-			if item.unit and item.unit.upper() not in valid_uoms:
-				msg = _('Row #{}: {} has invalid UOM set.').format(item.idx, item.item_name) + ' '
+		for idx, (unit, item_name) in enumerate(zip(item_table['unit'], item_table['item_name']), 1):
+			if unit and unit.upper() not in valid_uoms:
+				msg = _('Row #{}: {} has invalid UOM set.').format(idx, item_name) + ' '
 				msg += _('Please set proper UOM as defined by e-invoice portal.')
 				msg += '<br><br>'
 				uom_list_link = '<a href="https://einvoice1.gst.gov.in/Others/MasterCodes" target="_blank">this</a>'
@@ -647,6 +729,99 @@ class EInvoice(Document):
 
 		return eway_bill_details
 
+def get_seller_details(seller_address):
+	'''Returns validated seller details of the company address, cached until the address is modified'''
+	cache_key = (frappe.local.site, seller_address.name, str(seller_address.modified))
+	seller_details = seller_details_cache.get(cache_key)
+	if seller_details:
+		return seller_details
+
+	mandatory_field_label_map = {
+		'gstin': 'GSTIN',
+		'address_line1': 'Address Lines',
+		'city': 'City',
+		'pincode': 'Pincode',
+		'gst_state_number': 'State Code'
+	}
+	for field, field_label in mandatory_field_label_map.items():
+		if not seller_address[field]:
+			frappe.throw(_('Company address {} must have {} set to be able to generate e-invoice.')
+				.format(seller_address.name, field_label))
+
+	seller_details = {
+		'seller_gstin': seller_address.gstin,
+		'seller_location': seller_address.city,
+		'seller_pincode': seller_address.pincode,
+		'seller_address_line_1': seller_address.address_line1,
+		'seller_address_line_2': seller_address.address_line2,
+		'seller_state_code': seller_address.gst_state_number
+	}
+
+	if len(seller_details_cache) > 1000:
+		seller_details_cache.clear()
+	seller_details_cache[cache_key] = seller_details
+
+	return seller_details
+
+@metrics.timed('qrcode_render')
+def get_qrcode_file(signed_qr_code, doctype, docname):
+	'''Saves the QR code image as a private file attached to the e-invoice & returns its url'''
+	qrcode_format = get_qrcode_format()
+	filename = '{} - QRCode.{}'.format(docname, qrcode_format.lower()).replace(os.path.sep, '__')
+
+	_file = frappe.get_doc({
+		'doctype': 'File',
+		'file_name': filename,
+		'attached_to_doctype': doctype,
+		'attached_to_name': docname,
+		'attached_to_field': 'qrcode_path',
+		'is_private': 1,
+		'content': get_qrcode_image(signed_qr_code, qrcode_format)
+	})
+	_file.flags.ignore_permissions = 1
+	_file.save()
+
+	return _file.file_url
+
+def get_qrcode_format():
+	return frappe.db.get_single_value('E Invoicing Settings', 'qrcode_format') or 'PNG'
+
+def get_qrcode_image(signed_qr_code, qrcode_format):
+	qr_image = io.BytesIO()
+	qrcode = qrcreate(signed_qr_code, error='L')
+	if qrcode_format == 'SVG':
+		qrcode.svg(qr_image, scale=2, quiet_zone=1, xmldecl=False)
+	else:
+		qrcode.png(qr_image, scale=2, quiet_zone=1)
+
+	return qr_image.getvalue()
+
+def get_einvoice_qrcode(einvoice_name):
+	'''Jinja method to show the QR code of an e-invoice in print formats, if the sales invoice has no QR code image
+
+	Prints are not committed, so the QR code is rendered inline instead of saving a file.
+	Rendered images are cached on their content, so that reprints don't render them again'''
+	if not einvoice_name:
+		return
+
+	qrcode_path, signed_qr_code = frappe.db.get_value('E Invoice', einvoice_name,
+		['qrcode_path', 'signed_qr_code']) or (None, None)
+	if qrcode_path or not signed_qr_code:
+		return qrcode_path
+
+	qrcode_format = get_qrcode_format()
+	content_hash = hashlib.sha256(signed_qr_code.encode()).hexdigest()
+	cache_key = 'einvoice_qrcode|{}|{}'.format(qrcode_format, content_hash)
+
+	data_uri = frappe.cache().get_value(cache_key)
+	if not data_uri:
+		mime_type = 'image/svg+xml' if qrcode_format == 'SVG' else 'image/png'
+		qr_image = base64.b64encode(get_qrcode_image(signed_qr_code, qrcode_format)).decode()
+		data_uri = 'data:{};base64,{}'.format(mime_type, qr_image)
+		frappe.cache().set_value(cache_key, data_uri, expires_in_sec=QRCODE_CACHE_EXPIRY)
+
+	return data_uri
+
 def create_einvoice(sales_invoice):
 	if frappe.db.exists('E Invoice', sales_invoice):
 		einvoice = frappe.get_doc('E Invoice', sales_invoice)
@@ -656,7 +831,8 @@ def create_einvoice(sales_invoice):
 
 	einvoice.sync_with_sales_invoice()
 	einvoice.flags.ignore_permissions = 1
-	einvoice.save()
+	with metrics.timer('einvoice_save'):
+		einvoice.save()
 	frappe.db.commit()
 
 	return einvoice
@@ -674,13 +850,23 @@ def validate_sales_invoice_change(doc, method=""):
 		return
 
 	if doc.docstatus == 0 and doc._action == 'save':
+		invoice_fingerprint = frappe.db.get_value('E Invoice', doc.e_invoice, 'invoice_fingerprint')
+		if invoice_fingerprint and invoice_fingerprint == get_invoice_fingerprint(doc):
+			# none of the fields used to build the e-invoice are changed
+			return
+
+		# build the full diff to validate & log the changes
 		einvoice = get_einvoice(doc.e_invoice)
 		einvoice_copy = get_einvoice(doc.e_invoice)
 		einvoice_copy.sync_with_sales_invoice()
+		einvoice_copy.set_items()
 
 		# to ignore changes in default fields
 		einvoice = remove_default_fields(einvoice)
 		einvoice_copy = remove_default_fields(einvoice_copy)
+		# fingerprint differs here, the diff must only contain the changes in e-invoice values
+		einvoice.set('invoice_fingerprint', None)
+		einvoice_copy.set('invoice_fingerprint', None)
 		diff = get_diff(einvoice, einvoice_copy)
 
 		if diff:
@@ -690,6 +876,38 @@ def validate_sales_invoice_change(doc, method=""):
 			)
 			frappe.throw(_('You cannot edit the invoice after generating IRN'), title=_('Edit Not Allowed'))
 
+def get_invoice_fingerprint(sales_invoice):
+	'''Returns a hash of the sales invoice fields used to build the e-invoice'''
+	def get_values(doc, fields):
+		values = []
+		for fieldname in fields:
+			value = doc.get(fieldname)
+			if isinstance(value, (int, float)):
+				value = flt(value, 6)
+			values.append(value if value is not None else '')
+		return values
+
+	fingerprint_fields = get_fingerprint_fields()
+	fingerprint = [get_values(sales_invoice, fingerprint_fields['invoice'])]
+	for table in ['items', 'taxes', 'payments']:
+		fingerprint.append([get_values(d, fingerprint_fields[table]) for d in sales_invoice.get(table) or []])
+
+	fingerprint = dumps(fingerprint, separators=(',', ':'), default=str)
+	return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+def get_fingerprint_fields():
+	'''Returns FINGERPRINT_FIELDS with the sales invoice fields fetched into the e-invoice added to the invoice fields'''
+	invoice_fields = list(FINGERPRINT_FIELDS['invoice'])
+	for df in frappe.get_meta('E Invoice').fields:
+		if not (df.fetch_from or '').startswith('invoice.'):
+			continue
+
+		fieldname = df.fetch_from.split('.', 1)[1]
+		if fieldname not in invoice_fields:
+			invoice_fields.append(fieldname)
+
+	return dict(FINGERPRINT_FIELDS, invoice=invoice_fields)
+
 def remove_default_fields(doc):
 	clone = frappe.copy_doc(doc)
 	for fieldname in clone.as_dict():
@@ -714,20 +932,15 @@ def validate_einvoice_eligibility(doc):
 	if isinstance(doc, six.string_types):
 		doc = loads(doc)
 
-	service_provider = frappe.db.get_single_value('E Invoicing Settings', 'service_provider')
-	if not service_provider:
-		return False
-	
-	einvoicing_enabled = cint(frappe.db.get_single_value(service_provider, 'enabled'))
-	if not einvoicing_enabled:
+	einvoicing_rules = get_einvoicing_rules()
+	if not einvoicing_rules.enabled:
 		return False
 
 	einvoicing_eligible_from = '2021-04-01'
 	if getdate(doc.get('posting_date')) < getdate(einvoicing_eligible_from):
 		return False
 
-	eligible_companies = frappe.db.get_single_value('E Invoicing Settings', 'companies')
-	invalid_company = doc.get('company') not in eligible_companies
+	invalid_company = doc.get('company') not in einvoicing_rules.companies
 	invalid_supply_type = doc.get('gst_category') not in ['Registered Regular', 'SEZ', 'Overseas', 'Deemed Export']
 	inter_company_transaction = doc.get('billing_address_gstin') == doc.get('company_gstin')
 	has_non_gst_item = any(d for d in doc.get('items', []) if d.get('is_non_gst'))
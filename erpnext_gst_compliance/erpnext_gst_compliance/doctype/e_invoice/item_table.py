@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2021, Frappe and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+
+from math import fsum
+from array import array
+
+NUMERIC_FIELDS = ['quantity', 'rate', 'amount', 'discount', 'taxable_value', 'gst_rate',
+	'cgst_amount', 'sgst_amount', 'igst_amount', 'cess_rate', 'cess_amount', 'cess_nadv_amount',
+	'other_charges', 'total_item_value']
+TEXT_FIELDS = ['si_item_ref', 'item_code', 'item_name', 'hsn_code', 'unit']
+
+VALID_GST_RATES = frozenset([0.000, 0.100, 0.250, 0.500, 1.000, 1.500, 3.000, 5.000, 7.500, 12.000, 18.000, 28.000])
+
+class ItemTable:
+	'''Column wise store of e-invoice items, one array per numeric field
+
+	Totals & validations are computed over the columns instead of the child rows,
+	which are created only once from the table to be saved'''
+
+	def __init__(self):
+		self.columns = {fieldname: array('d') for fieldname in NUMERIC_FIELDS}
+		self.columns.update({fieldname: [] for fieldname in TEXT_FIELDS})
+		self.columns['is_service_item'] = array('b')
+
+	@classmethod
+	def from_rows(cls, rows):
+		table = cls()
+		for row in rows:
+			table.append(row)
+
+		return table
+
+	def __len__(self):
+		return len(self.columns['si_item_ref'])
+
+	def __getitem__(self, fieldname):
+		return self.columns[fieldname]
+
+	def append(self, values):
+		for fieldname in NUMERIC_FIELDS:
+			self.columns[fieldname].append(values.get(fieldname) or 0)
+
+		for fieldname in TEXT_FIELDS:
+			self.columns[fieldname].append(values.get(fieldname))
+
+		self.columns['is_service_item'].append(1 if values.get('is_service_item') else 0)
+
+	def get_row(self, idx):
+		return {fieldname: column[idx] for fieldname, column in self.columns.items()}
+
+	def get_rows(self):
+		return [self.get_row(idx) for idx in range(len(self))]
+
+	def get_total(self, fieldname):
+		return fsum(self.columns[fieldname])
+
+	def get_missing_hsn_code_rows(self):
+		return [idx for idx, hsn_code in enumerate(self.columns['hsn_code']) if not hsn_code]
+
+	def get_invalid_gst_rate_rows(self):
+		'''Returns the indexes of the items with a GST rate not allowed by the e-invoice portal'''
+		return [idx for idx, rate in enumerate(self.columns['gst_rate']) if rate not in VALID_GST_RATES]
+
+	def get_mixed_tax_rows(self):
+		'''Returns the indexes of the items with both IGST & CGST / SGST amounts'''
+		columns = zip(self.columns['cgst_amount'], self.columns['sgst_amount'], self.columns['igst_amount'])
+		return [idx for idx, (cgst, sgst, igst) in enumerate(columns) if (cgst or sgst) and igst]
+
+	def get_tax_mismatch_rows(self, tolerance=1):
+		'''Returns the indexes of the items whose GST amount is not taxable value * GST rate'''
+		columns = zip(self.columns['taxable_value'], self.columns['gst_rate'],
+			self.columns['cgst_amount'], self.columns['sgst_amount'], self.columns['igst_amount'])
+
+		return [
+			idx for idx, (taxable_value, gst_rate, cgst, sgst, igst) in enumerate(columns)
+			if abs((taxable_value * gst_rate / 100) - (cgst + sgst + igst)) > tolerance
+		]
@@ -5,6 +5,13 @@ from __future__ import unicode_literals
 
 import frappe
 import unittest
+from frappe.utils import add_to_date, now_datetime
+from erpnext_gst_compliance.erpnext_gst_compliance import metrics
+from erpnext_gst_compliance.erpnext_gst_compliance.e_invoicing_controller import get_pending_einvoices, validate_eway_bill_generation
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log import log_request, insert_request_logs
+from erpnext_gst_compliance.utils import get_gst_account_types, clear_gst_account_types_cache
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice.e_invoice import get_invoice_fingerprint
+from erpnext_gst_compliance.erpnext_gst_compliance.benchmarks.einvoice import run_scenario, PHASES
 from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import get_sales_invoice_for_e_invoice
 
 class TestEInvoice(unittest.TestCase):
@@ -85,6 +92,37 @@ class TestEInvoice(unittest.TestCase):
 		self.assertRaises(frappe.ValidationError, self.e_invoice.validate_items)
 		self.e_invoice.items[0].gst_rate = gst_rate_copy
 
+	def test_item_table(self):
+		item_table = self.e_invoice.get_item_table()
+		self.assertEqual(len(item_table), len(self.e_invoice.items))
+		self.assertEqual(list(item_table['si_item_ref']), [d.si_item_ref for d in self.e_invoice.items])
+		self.assertAlmostEqual(item_table.get_total('total_item_value'), self.e_invoice.items_total_value)
+		self.assertAlmostEqual(item_table.get_total('taxable_value'), self.e_invoice.ass_value)
+
+		item_list = self.e_invoice.get_item_list_json()['ItemList']
+		self.assertEqual(item_list[1]['SlNo'], '2')
+		self.assertEqual(item_list[1]['HsnCd'], '890002')
+		self.assertEqual(item_list[1]['IsServc'], 'N')
+
+		self.e_invoice.items[1].igst_amount = 10
+		self.assertEqual(self.e_invoice.get_item_table().get_mixed_tax_rows(), [1])
+
+	def test_item_table_reuse(self):
+		e_invoice = frappe.get_doc('E Invoice', self.e_invoice.name)
+		e_invoice.sync_with_sales_invoice()
+		# child rows are created only once before saving, the table is used for validations & json
+		self.assertTrue(e_invoice.flags.items_pending)
+		self.assertIs(e_invoice.get_item_table(), e_invoice.item_table)
+
+		e_invoice.save()
+		self.assertFalse(e_invoice.flags.items_pending)
+		self.assertEqual([d.si_item_ref for d in e_invoice.items], list(e_invoice.item_table['si_item_ref']))
+		self.assertIs(e_invoice.get_item_table(), e_invoice.item_table)
+		self.assertEqual(len(e_invoice.get_item_list_json()['ItemList']), len(e_invoice.items))
+
+		e_invoice.reload()
+		self.assertIsNone(e_invoice.item_table)
+
 	def test_invalid_uom(self):
 		item = self.e_invoice.items[0]
 		item.unit = 'BAGS'
@@ -95,6 +133,117 @@ class TestEInvoice(unittest.TestCase):
 		item.unit = 'BAG'
 		self.e_invoice.save()
 
+	def test_gst_account_types(self):
+		account_types = get_gst_account_types(self.sales_invoice.company)
+		self.assertTrue(account_types)
+		for tax_type in account_types.values():
+			self.assertIn(tax_type, ['igst', 'cgst', 'sgst', 'cess'])
+
+		# cached map must not be modified by callers
+		self.assertRaises(TypeError, account_types.__setitem__, '_Test Account', 'igst')
+
+		clear_gst_account_types_cache()
+		self.assertIsNone(frappe.cache().hget('gst_account_types', self.sales_invoice.company))
+
+	def test_invoice_fingerprint(self):
+		self.assertEqual(self.e_invoice.invoice_fingerprint, get_invoice_fingerprint(self.sales_invoice))
+
+		# changes in fields that are not part of e-invoice doesn't change the fingerprint
+		self.sales_invoice.remarks = '_Test Remarks'
+		self.sales_invoice.outstanding_amount = 0
+		self.assertEqual(self.e_invoice.invoice_fingerprint, get_invoice_fingerprint(self.sales_invoice))
+
+		# fields fetched into the e-invoice are part of the fingerprint
+		vehicle_no = self.sales_invoice.vehicle_no
+		self.sales_invoice.vehicle_no = '_TEST1234'
+		self.assertNotEqual(self.e_invoice.invoice_fingerprint, get_invoice_fingerprint(self.sales_invoice))
+		self.sales_invoice.vehicle_no = vehicle_no
+
+		self.sales_invoice.items[0].qty += 1
+		self.assertNotEqual(self.e_invoice.invoice_fingerprint, get_invoice_fingerprint(self.sales_invoice))
+
+	def test_pending_einvoices(self):
+		settings = frappe._dict(reconcile_after_minutes=15)
+		get_pending = lambda: [d.name for d in get_pending_einvoices(settings, batch_size=10000)]
+		url = 'https://_test_gsp/api/invoice'
+
+		def log_past_request(einvoice_name, minutes_ago, response=None):
+			insert_request_logs([{
+				'timestamp': str(add_to_date(now_datetime(), minutes=-minutes_ago)),
+				'reference_invoice': einvoice_name,
+				'url': url,
+				'response': response
+			}])
+
+		# never sent to the portal
+		self.assertNotIn(self.e_invoice.name, get_pending())
+
+		# rejected by the portal
+		log_past_request(self.e_invoice.name, 60, response='{"success":false,"message":"2258 : Invalid GSTIN"}')
+		self.assertNotIn(self.e_invoice.name, get_pending())
+
+		# retried, but the request timed out without a response
+		log_past_request(self.e_invoice.name, 30)
+		self.assertIn(self.e_invoice.name, get_pending())
+
+		# a later request is taken into account, even when its log is still queued in redis
+		log_request(url, None, None, None, reference_invoice=self.e_invoice.name)
+		self.assertNotIn(self.e_invoice.name, get_pending())
+
+		# IRN details are not available on the portal after 2 days
+		old_einvoice, _ = make_e_invoice()
+		log_past_request(old_einvoice.name, 3 * 24 * 60)
+		self.assertNotIn(old_einvoice.name, get_pending())
+
+	def test_eway_bill_generation_validation(self):
+		self.assertRaises(frappe.ValidationError, validate_eway_bill_generation, self.e_invoice)
+
+		self.e_invoice.irn = '_test_irn'
+		self.e_invoice.status = 'IRN Generated'
+		validate_eway_bill_generation(self.e_invoice)
+
+		# generated along with the IRN
+		self.e_invoice.ewaybill = '_test_ewaybill'
+		self.e_invoice.ewaybill_validity = str(add_to_date(now_datetime(), days=1))
+		self.assertRaises(frappe.ValidationError, validate_eway_bill_generation, self.e_invoice)
+
+		self.e_invoice.ewaybill_validity = None
+		self.assertRaises(frappe.ValidationError, validate_eway_bill_generation, self.e_invoice)
+
+		self.e_invoice.ewaybill_validity = str(add_to_date(now_datetime(), days=-1))
+		validate_eway_bill_generation(self.e_invoice)
+
+		self.e_invoice.ewaybill = ''
+		self.e_invoice.status = 'E-Way Bill Cancelled'
+		validate_eway_bill_generation(self.e_invoice)
+
+	def test_payload_benchmark(self):
+		scenario = frappe._dict(name='_Test Benchmark', items=5, taxes='cgst_sgst_cess')
+		result = run_scenario(scenario, repeat=1)
+
+		self.assertTrue(result['queries'])
+		self.assertTrue(result['peak_memory'])
+		self.assertEqual(list(result['phases']), PHASES)
+		self.assertTrue(result['phases']['set_item_details'])
+
+	def test_phase_metrics(self):
+		metrics.reset_metrics()
+		with metrics.trace('_test_action', provider='_Test Provider'):
+			self.e_invoice.fetch_invoice_details()
+			self.e_invoice.get_einvoice_json()
+
+		summary = {(d['phase'], d['action']): d for d in metrics.get_metrics_summary()}
+		for phase in ['total', 'fetch_invoice_details', 'sales_invoice_load', 'json_build']:
+			self.assertEqual(summary[(phase, '_test_action')]['count'], 1)
+			self.assertEqual(summary[(phase, '_test_action')]['outcome'], 'success')
+
+		metrics.get_metrics()
+		self.assertIn('einvoicing_phase_duration_seconds_bucket{phase="json_build",action="_test_action"',
+			frappe.response['result'])
+		self.assertIn('einvoicing_requests_total{action="_test_action",provider="_Test Provider",gstin="",outcome="success"} 1',
+			frappe.response['result'])
+		metrics.reset_metrics()
+
 def make_e_invoice():
 	sales_invoice = get_sales_invoice_for_e_invoice()
 	sales_invoice.items[0].gst_hsn_code = '990002'
@@ -105,5 +254,7 @@ def make_e_invoice():
 	e_invoice.invoice = sales_invoice.name
 	e_invoice.sync_with_sales_invoice()
 	e_invoice.save()
+	# as loaded in the requests after it is created, with the child rows as the source of truth
+	e_invoice.reload()
 
 	return e_invoice, sales_invoice
\ No newline at end of file
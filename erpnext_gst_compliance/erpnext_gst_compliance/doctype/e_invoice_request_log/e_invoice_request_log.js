@@ -2,7 +2,17 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('E Invoice Request Log', {
-	// refresh: function(frm) {
+	refresh(frm) {
+		// logs are stored as compact json, formatted only for viewing
+		['headers', 'data', 'response'].forEach(field => {
+			if (!frm.doc[field]) return;
 
-	// }
+			try {
+				frm.doc[field] = JSON.stringify(JSON.parse(frm.doc[field]), null, 4);
+				frm.refresh_field(field);
+			} catch (e) {
+				// not json, shown as is
+			}
+		});
+	}
 });
@@ -1,8 +1,279 @@
 # Copyright (c) 2021, Frappe Technologied Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
-# import frappe
+import os
+import gzip
+import frappe
+from frappe import _
+from frappe.utils import cint, now, add_days, nowdate, getdate
 from frappe.model.document import Document
+from erpnext_gst_compliance import serializer
+
+REQUEST_LOG_QUEUE = 'einvoice_request_log_queue'
+# logs that failed to insert, kept aside so that they don't block the queue
+REQUEST_LOG_DEAD_LETTER_QUEUE = 'einvoice_request_log_dead_letter_queue'
+REQUEST_LOG_FLUSH_SCHEDULED = 'einvoice_request_log_flush_scheduled'
+REQUEST_LOG_FLUSH_LOCK = 'einvoice_request_log_flush_lock'
+# seconds, the lock is released if the flushing worker dies
+FLUSH_LOCK_TIMEOUT = 300
+REQUEST_LOG_SERIES = 'EINV-REQ-'
+FLUSH_BATCH_SIZE = 500
+ARCHIVE_BATCH_SIZE = 1000
+# monthly archives of the logs older than the retention days, <site>/private/einvoice_request_logs/YYYY-MM.jsonl.gz
+ARCHIVE_FOLDER = 'einvoice_request_logs'
+ARCHIVE_FIELDS = ['name', 'user', 'timestamp', 'reference_invoice', 'url', 'headers', 'data', 'response',
+	'duration', 'profile']
+# most of their size is repeated json keys & signed tokens
+COMPRESSED_FIELDS = ['data', 'response']
 
 class EInvoiceRequestLog(Document):
-	pass
+	def load_from_db(self):
+		super(EInvoiceRequestLog, self).load_from_db()
+		decompress_fields(self)
+
+def compress_fields(request_log):
+	for fieldname in COMPRESSED_FIELDS:
+		request_log[fieldname] = serializer.compress(request_log.get(fieldname))
+
+def decompress_fields(request_log):
+	'''Restores the compressed fields of a request log doc or dict, as stored before compression'''
+	for fieldname in COMPRESSED_FIELDS:
+		value = request_log.get(fieldname)
+		if serializer.is_compressed(value):
+			request_log.update({fieldname: serializer.decompress(value)})
+
+def on_doctype_update():
+	frappe.db.add_index('E Invoice Request Log', ['reference_invoice', 'timestamp'])
+	frappe.db.add_index('E Invoice Request Log', ['timestamp'])
+
+def log_request(url, headers, payload, response, reference_invoice=None):
+	'''Queues an e-invoicing request log in redis
+
+	Logs are inserted in bulk by a background job, so that logging doesn't commit the current transaction'''
+	request_log = {
+		'user': frappe.session.user,
+		'timestamp': now(),
+		'reference_invoice': reference_invoice,
+		'url': url,
+		'headers': to_json(headers) if headers else None,
+		'data': to_json(payload) if payload else None,
+		'response': to_json(response) if response else None
+	}
+
+	# logs of a profiled call are queued once it completes, see profiler.py
+	buffered_logs = frappe.flags.einvoice_request_logs_buffer
+	if buffered_logs is not None:
+		buffered_logs.append(request_log)
+		return
+
+	queue_request_logs([request_log])
+
+def queue_request_logs(request_logs):
+	try:
+		cache = frappe.cache()
+		# raw list commands, since the cache wrapper pushes a single value & prefixes the key again
+		pipeline = cache.pipeline()
+		pipeline.rpush(cache.make_key(REQUEST_LOG_QUEUE), *[serializer.dumps(d) for d in request_logs])
+		pipeline.execute()
+		schedule_flush()
+	except Exception:
+		# redis is unavailable, insert the logs with the current transaction
+		insert_request_logs(request_logs)
+
+def to_json(value):
+	'''Returns compact json, payloads already serialized for the request are stored as is'''
+	if isinstance(value, bytes):
+		return value.decode('utf-8')
+	if isinstance(value, str):
+		return value
+
+	return serializer.dumps_str(value)
+
+def schedule_flush():
+	cache = frappe.cache()
+	# enqueue atmost one flush job every 10 seconds
+	if cache.set(cache.make_key(REQUEST_LOG_FLUSH_SCHEDULED), 1, nx=True, ex=10):
+		frappe.enqueue(
+			'erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log.flush_request_logs',
+			queue='short',
+			job_name='Flush E Invoice Request Logs'
+		)
+
+def flush_request_logs():
+	'''Inserts queued request logs in batches, runs in background jobs & scheduler'''
+	cache = frappe.cache()
+	queue = cache.make_key(REQUEST_LOG_QUEUE)
+	lock = cache.make_key(REQUEST_LOG_FLUSH_LOCK)
+
+	# one flush at a time, since the batch is read before it is removed from the queue
+	if not cache.set(lock, 1, nx=True, ex=FLUSH_LOCK_TIMEOUT):
+		return
+
+	try:
+		while True:
+			pipeline = cache.pipeline()
+			pipeline.lrange(queue, 0, FLUSH_BATCH_SIZE - 1)
+			request_logs = pipeline.execute()[0]
+			if not request_logs:
+				break
+
+			try:
+				insert_request_logs([serializer.loads(d) for d in request_logs])
+				frappe.db.commit()
+			except Exception:
+				frappe.db.rollback()
+				insert_request_logs_individually(request_logs)
+
+			# removed only once inserted or moved to the dead letter queue, so that the logs are kept if the database is unavailable
+			pipeline = cache.pipeline()
+			pipeline.ltrim(queue, len(request_logs), -1)
+			pipeline.execute()
+	finally:
+		pipeline = cache.pipeline()
+		pipeline.delete(lock)
+		pipeline.execute()
+
+def insert_request_logs_individually(request_logs):
+	'''Inserts the queued logs one at a time & moves the ones that fail to the dead letter queue'''
+	cache = frappe.cache()
+	# raises if the database is unavailable, so that the logs are kept in the queue
+	frappe.db.sql('select 1')
+
+	failed_logs = []
+	traceback = None
+	for request_log in request_logs:
+		try:
+			insert_request_logs([serializer.loads(request_log)])
+			frappe.db.commit()
+		except Exception:
+			frappe.db.rollback()
+			failed_logs.append(request_log)
+			traceback = frappe.get_traceback()
+
+	if failed_logs:
+		pipeline = cache.pipeline()
+		pipeline.rpush(cache.make_key(REQUEST_LOG_DEAD_LETTER_QUEUE), *failed_logs)
+		pipeline.execute()
+		frappe.log_error(title=_('E Invoice Request Logs Not Inserted'),
+			message=_('{} request logs failed to insert and were moved to the {} redis list.\n\n{}')
+				.format(len(failed_logs), REQUEST_LOG_DEAD_LETTER_QUEUE, traceback))
+		frappe.db.commit()
+
+def get_queued_reference_invoices():
+	'''Returns the e-invoices with request logs queued in redis, that are not inserted yet'''
+	try:
+		cache = frappe.cache()
+		pipeline = cache.pipeline()
+		pipeline.lrange(cache.make_key(REQUEST_LOG_QUEUE), 0, -1)
+		request_logs = pipeline.execute()[0]
+	except Exception:
+		# redis is unavailable, logs are inserted with the transaction of the request
+		return set()
+
+	return {serializer.loads(d).get('reference_invoice') for d in request_logs}
+
+def insert_request_logs(request_logs):
+	fields = ['name', 'owner', 'creation', 'modified', 'modified_by', 'docstatus', 'idx',
+		'user', 'timestamp', 'reference_invoice', 'url', 'headers', 'data', 'response', 'duration', 'profile']
+
+	timestamp = now()
+	names = get_request_log_names(len(request_logs))
+	values = []
+	for name, log in zip(names, request_logs):
+		compress_fields(log)
+		values.append([
+			name, log.get('user'), timestamp, timestamp, log.get('user'), 0, 0,
+			log.get('user'), log.get('timestamp'), log.get('reference_invoice'),
+			log.get('url'), log.get('headers'), log.get('data'), log.get('response'),
+			log.get('duration') or 0, log.get('profile')
+		])
+
+	frappe.db.bulk_insert('E Invoice Request Log', fields=fields, values=values)
+
+def get_request_log_names(count):
+	'''Reserves `count` names from the naming series (EINV-REQ-.#####) with a single update'''
+	current = frappe.db.sql("select `current` from `tabSeries` where `name`=%s for update", REQUEST_LOG_SERIES)
+	if current:
+		current = cint(current[0][0])
+		frappe.db.sql("update `tabSeries` set `current` = `current` + %s where `name`=%s", (count, REQUEST_LOG_SERIES))
+	else:
+		current = 0
+		frappe.db.sql("insert into `tabSeries` (`name`, `current`) values (%s, %s)", (REQUEST_LOG_SERIES, count))
+
+	return ['{}{:05d}'.format(REQUEST_LOG_SERIES, current + i) for i in range(1, count + 1)]
+
+def archive_request_logs():
+	'''Moves the logs older than the retention days to monthly archives & deletes them in batches, runs daily'''
+	retention_days = cint(frappe.db.get_single_value('E Invoicing Settings', 'log_retention_days'))
+	if not retention_days:
+		return
+
+	cutoff = add_days(nowdate(), -retention_days)
+	while True:
+		request_logs = frappe.get_all('E Invoice Request Log', filters={'timestamp': ['<', cutoff]},
+			fields=ARCHIVE_FIELDS, order_by='timestamp asc', limit=ARCHIVE_BATCH_SIZE)
+		if not request_logs:
+			break
+
+		logs_by_month = {}
+		for log in request_logs:
+			logs_by_month.setdefault(get_archive_month(log.timestamp), []).append(log)
+			# archives are compressed as a whole
+			decompress_fields(log)
+			log.timestamp = str(log.timestamp) if log.timestamp else None
+
+		# archived before deleting, so that a failed run only archives a batch twice
+		for month, logs in logs_by_month.items():
+			write_archive(month, logs)
+
+		frappe.db.delete('E Invoice Request Log', {'name': ['in', [log.name for log in request_logs]]})
+		frappe.db.commit()
+
+def get_archive_month(timestamp):
+	return getdate(timestamp).strftime('%Y-%m') if timestamp else 'undated'
+
+def get_archive_folder():
+	return frappe.get_site_path('private', ARCHIVE_FOLDER)
+
+def write_archive(month, request_logs):
+	folder = get_archive_folder()
+	os.makedirs(folder, exist_ok=True)
+
+	lines = b''.join(serializer.dumps(log) + b'\n' for log in request_logs)
+	# each run appends a gzip member, read back as one stream
+	with gzip.open(os.path.join(folder, month + '.jsonl.gz'), 'ab') as f:
+		f.write(lines)
+
+@frappe.whitelist()
+def search_archived_logs(reference_invoice, from_date=None, to_date=None):
+	'''Returns the archived logs of an invoice, optionally only from the monthly archives between the dates'''
+	frappe.has_permission('E Invoice Request Log', 'read', throw=True)
+	if not reference_invoice:
+		frappe.throw(_('Reference Invoice is required to search the archived logs.'))
+
+	folder = get_archive_folder()
+	if not os.path.exists(folder):
+		return []
+
+	from_month = get_archive_month(from_date) if from_date else None
+	to_month = get_archive_month(to_date) if to_date else None
+	# the invoice name is matched in the raw line before parsing it
+	needle = serializer.dumps(reference_invoice)
+
+	request_logs = {}
+	for filename in sorted(os.listdir(folder)):
+		month = filename.split('.', 1)[0]
+		if (from_month and month < from_month) or (to_month and month > to_month):
+			continue
+
+		with gzip.open(os.path.join(folder, filename), 'rb') as f:
+			for line in f:
+				if needle not in line:
+					continue
+
+				log = serializer.loads(line)
+				if log.get('reference_invoice') == reference_invoice:
+					# a batch may be archived twice if a run failed before deleting it
+					request_logs[log.get('name')] = log
+
+	return sorted(request_logs.values(), key=lambda log: log.get('timestamp') or '')
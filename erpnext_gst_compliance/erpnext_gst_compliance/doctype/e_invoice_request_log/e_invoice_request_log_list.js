@@ -0,0 +1,54 @@
+// Copyright (c) 2021, Frappe Technologied Pvt. Ltd. and contributors
+// For license information, please see license.txt
+
+frappe.listview_settings['E Invoice Request Log'] = {
+	onload(listview) {
+		listview.page.add_menu_item(__('Search Archived Logs'), () => {
+			frappe.prompt([
+				{ fieldname: 'reference_invoice', fieldtype: 'Data', label: __('Reference Invoice'), reqd: 1 },
+				{ fieldname: 'from_date', fieldtype: 'Date', label: __('From Date') },
+				{ fieldname: 'to_date', fieldtype: 'Date', label: __('To Date') }
+			], (values) => {
+				frappe.call({
+					method: 'erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log.search_archived_logs',
+					args: values,
+					freeze: true,
+					freeze_message: __('Searching Archived Logs'),
+					callback: (r) => show_archived_logs(values.reference_invoice, r.message || [])
+				});
+			}, __('Search Archived Logs'), __('Search'));
+		});
+	}
+};
+
+function show_archived_logs(reference_invoice, logs) {
+	if (!logs.length) {
+		frappe.msgprint(__('No archived logs found for {0}.', [reference_invoice.bold()]));
+		return;
+	}
+
+	const format = (value) => {
+		if (!value) return '';
+		try {
+			return JSON.stringify(JSON.parse(value), null, 4);
+		} catch (e) {
+			return value;
+		}
+	};
+
+	const html = logs.map(log => `
+		<details style="margin-bottom: 10px">
+			<summary>${frappe.utils.escape_html(log.name)} · ${frappe.datetime.str_to_user(log.timestamp)} · ${frappe.utils.escape_html(log.url || '')}</summary>
+			${['headers', 'data', 'response', 'profile'].filter(field => log[field]).map(field => `
+				<div class="text-muted" style="margin-top: 8px">${__(frappe.model.unscrub(field))}</div>
+				<pre>${frappe.utils.escape_html(format(log[field]))}</pre>
+			`).join('')}
+		</details>
+	`).join('');
+
+	frappe.msgprint({
+		title: __('Archived Logs of {0}', [reference_invoice]),
+		message: html,
+		wide: true
+	});
+}
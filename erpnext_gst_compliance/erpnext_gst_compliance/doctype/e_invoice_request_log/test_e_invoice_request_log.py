@@ -1,8 +1,130 @@
 # Copyright (c) 2021, Frappe Technologied Pvt. Ltd. and Contributors
 # See license.txt
 
-# import frappe
+import os
+import frappe
 import unittest
+from erpnext_gst_compliance import serializer
+from erpnext_gst_compliance.erpnext_gst_compliance.profiler import profiled
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log import log_request, flush_request_logs, \
+	insert_request_logs, queue_request_logs, REQUEST_LOG_QUEUE, REQUEST_LOG_DEAD_LETTER_QUEUE, archive_request_logs, search_archived_logs, get_archive_folder
 
 class TestEInvoiceRequestLog(unittest.TestCase):
-	pass
+	def test_buffered_logging(self):
+		url = 'https://_test_gsp/api/invoice'
+		log_request(url, {'gstin': '27AAECE4835E1ZR'}, {'Irn': '_test_irn'}, {'success': True},
+			reference_invoice='_Test Sales Invoice')
+		flush_request_logs()
+
+		request_log = frappe.get_last_doc('E Invoice Request Log', filters={'url': url})
+		self.assertEqual(request_log.reference_invoice, '_Test Sales Invoice')
+		# logs are stored as compact json
+		self.assertEqual(request_log.data, '{"Irn":"_test_irn"}')
+		self.assertEqual(request_log.user, frappe.session.user)
+
+	def test_failed_log_insert(self):
+		url = 'https://_test_gsp/api/invoice'
+		cache = frappe.cache()
+		dead_letter_queue = cache.make_key(REQUEST_LOG_DEAD_LETTER_QUEUE)
+
+		pipeline = cache.pipeline()
+		pipeline.rpush(cache.make_key(REQUEST_LOG_QUEUE), b'{"url": "https://_test_gsp/api/invoice",')
+		pipeline.execute()
+		queue_request_logs([{'url': url, 'reference_invoice': '_Test Sales Invoice'}])
+
+		try:
+			flush_request_logs()
+
+			# the bad log doesn't block the ones queued after it
+			self.assertTrue(frappe.db.exists('E Invoice Request Log', {'url': url, 'reference_invoice': '_Test Sales Invoice'}))
+			pipeline = cache.pipeline()
+			pipeline.llen(cache.make_key(REQUEST_LOG_QUEUE))
+			pipeline.lrange(dead_letter_queue, 0, -1)
+			queued_logs, failed_logs = pipeline.execute()
+			self.assertEqual(queued_logs, 0)
+			self.assertEqual(failed_logs, [b'{"url": "https://_test_gsp/api/invoice",'])
+		finally:
+			pipeline = cache.pipeline()
+			pipeline.delete(dead_letter_queue)
+			pipeline.execute()
+
+	def test_serialized_payload_logging(self):
+		url = 'https://_test_gsp/api/invoice'
+		payload = serializer.dumps({'Irn': '_test_irn', 'ItemList': [{'SlNo': '1', 'PrdDesc': '_Test Item ₹'}]})
+		log_request(url, None, payload, None)
+		flush_request_logs()
+
+		# payload serialized for the request is logged as is
+		request_log = frappe.get_last_doc('E Invoice Request Log', filters={'url': url})
+		self.assertEqual(request_log.data, payload.decode('utf-8'))
+		self.assertEqual(serializer.loads(request_log.data)['ItemList'][0]['PrdDesc'], '_Test Item ₹')
+		self.assertIsNone(request_log.headers)
+
+	def test_compressed_payload_logging(self):
+		url = 'https://_test_gsp/api/invoice'
+		payload = {'ItemList': [{'SlNo': str(i), 'PrdDesc': '_Test Item', 'HsnCd': '990002'} for i in range(50)]}
+		log_request(url, None, payload, None)
+		flush_request_logs()
+
+		request_log = frappe.get_last_doc('E Invoice Request Log', filters={'url': url})
+		stored_data = frappe.db.get_value('E Invoice Request Log', request_log.name, 'data')
+		self.assertTrue(stored_data.startswith(serializer.COMPRESSION_MARKER))
+		self.assertLess(len(stored_data), len(serializer.dumps(payload)))
+
+		# decompressed transparently when the log is loaded
+		self.assertEqual(serializer.loads(request_log.data), payload)
+
+	def test_slow_request_profile(self):
+		url = 'https://_test_gsp/api/invoice'
+
+		@profiled
+		def make_slow_request():
+			frappe.db.sql('select name from `tabE Invoice Request Log` limit 1')
+			log_request(url, None, {'Irn': '_test_irn'}, {'success': True})
+
+		settings = frappe.get_single('E Invoicing Settings')
+		settings.update({'profile_slow_requests': 1, 'profiling_threshold': 0.000001, 'profiling_sample_rate': 100})
+		settings.flags.ignore_validate = True
+		settings.save()
+		try:
+			make_slow_request()
+		finally:
+			settings.profile_slow_requests = 0
+			settings.save()
+		flush_request_logs()
+
+		request_log = frappe.get_last_doc('E Invoice Request Log', filters={'url': url})
+		self.assertTrue(request_log.duration)
+		self.assertIn('SQL: 1 queries', request_log.profile)
+		self.assertIn('make_slow_request', request_log.profile)
+
+	def test_log_archival(self):
+		url = 'https://_test_gsp/api/invoice'
+		insert_request_logs([{
+			'timestamp': '2000-01-15 10:00:00',
+			'reference_invoice': '_Test Archived Invoice',
+			'url': url,
+			'response': '{"success":true}'
+		}])
+
+		frappe.db.set_value('E Invoicing Settings', None, 'log_retention_days', 30)
+		archive_path = os.path.join(get_archive_folder(), '2000-01.jsonl.gz')
+		try:
+			archive_request_logs()
+		finally:
+			frappe.db.set_value('E Invoicing Settings', None, 'log_retention_days', 0)
+
+		try:
+			self.assertFalse(frappe.db.exists('E Invoice Request Log', {'reference_invoice': '_Test Archived Invoice'}))
+
+			archived_logs = search_archived_logs('_Test Archived Invoice', from_date='2000-01-01', to_date='2000-01-31')
+			self.assertEqual(len(archived_logs), 1)
+			self.assertEqual(archived_logs[0]['response'], '{"success":true}')
+			self.assertEqual(archived_logs[0]['timestamp'], '2000-01-15 10:00:00')
+
+			self.assertEqual(search_archived_logs('_Test Archived Invoice', from_date='2000-02-01'), [])
+		finally:
+			os.remove(archive_path)
+
+	def tearDown(self):
+		frappe.db.delete('E Invoice Request Log', {'url': 'https://_test_gsp/api/invoice'})
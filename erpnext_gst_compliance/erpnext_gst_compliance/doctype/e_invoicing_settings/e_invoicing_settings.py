@@ -4,7 +4,7 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils.data import get_link_to_form
+from frappe.utils.data import cint, get_link_to_form
 
 class EInvoicingSettings(Document):
 	def validate(self):
@@ -20,3 +20,32 @@ class EInvoicingSettings(Document):
 				msg += _("Please add atleast one credential to enable e-invoicing.")
 				frappe.throw(msg)
 			self.companies = ', '.join((d.company for d in service_provider_doc.credentials))
+
+	def on_update(self):
+		clear_einvoicing_rules_cache()
+
+def get_einvoicing_rules():
+	'''Returns e-invoicing settings compiled for eligibility checks, cached until any of the settings is updated'''
+	rules = frappe.cache().get_value('einvoicing_rules')
+	if rules is not None:
+		return rules
+
+	service_provider = frappe.db.get_single_value('E Invoicing Settings', 'service_provider')
+	enabled = service_provider and cint(frappe.db.get_single_value(service_provider, 'enabled'))
+
+	companies = []
+	if enabled:
+		credential_doctype = frappe.get_meta(service_provider).get_field('credentials').options
+		companies = frappe.get_all(credential_doctype, filters={'parent': service_provider}, pluck='company')
+
+	rules = frappe._dict({
+		'service_provider': service_provider,
+		'enabled': bool(enabled),
+		'companies': frozenset(companies)
+	})
+	frappe.cache().set_value('einvoicing_rules', rules)
+
+	return rules
+
+def clear_einvoicing_rules_cache():
+	frappe.cache().delete_value('einvoicing_rules')
@@ -3,6 +3,7 @@
 
 import frappe
 import unittest
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoicing_settings.e_invoicing_settings import get_einvoicing_rules
 
 class TestEInvoicingSettings(unittest.TestCase):
 	def test_service_provider_is_disabled(self):
@@ -19,11 +20,18 @@ class TestEInvoicingSettings(unittest.TestCase):
 		e_invoicing_settings.service_provider = 'Adequare Settings'
 		e_invoicing_settings.save()
 
+		rules = get_einvoicing_rules()
+		self.assertEqual(rules.service_provider, 'Adequare Settings')
+		self.assertTrue(rules.enabled)
+
 		adequare_settings.reload()
 		adequare_settings.enabled = 0
 		adequare_settings.flags.ignore_validate = True
 		adequare_settings.save()
 
+		# rules are recompiled when service provider settings are updated
+		self.assertFalse(get_einvoicing_rules().enabled)
+
 		e_invoicing_settings.reload()
 		e_invoicing_settings.service_provider = None
 		e_invoicing_settings.flags.ignore_mandatory = True
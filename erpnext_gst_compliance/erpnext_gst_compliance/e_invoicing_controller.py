@@ -4,9 +4,22 @@
 import six
 import frappe
 from frappe import _
-from erpnext_gst_compliance.utils import safe_load_json
-from frappe.utils.data import now_datetime, get_link_to_form, time_diff_in_hours
+from erpnext_gst_compliance.utils import safe_load_json, get_exception_messages
+from erpnext_gst_compliance.erpnext_gst_compliance import metrics
+from frappe.utils.data import cint, add_to_date, get_datetime, now_datetime, get_link_to_form, time_diff_in_hours, time_diff_in_seconds
 from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice.e_invoice import create_einvoice, get_einvoice
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoicing_settings.e_invoicing_settings import get_einvoicing_rules
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log import flush_request_logs, get_queued_reference_invoices
+
+# pending e-invoices reconciled per scheduled run
+RECONCILIATION_BATCH_SIZE = 500
+# the portal returns the details of an IRN only for 2 days after it is generated
+RECONCILIATION_MAX_AGE_DAYS = 2
+# seconds, queued requests not updated within this are considered stale, e.g. if the worker died
+EINVOICING_REQUEST_TIMEOUT = 600
+BULK_REQUEST_TIMEOUT = 3600
+# bulk requests for more invoices are always run in background, to finish within the web request timeout
+BULK_REQUEST_BACKGROUND_THRESHOLD = 20
 
 def parse_sales_invoice(sales_invoice):
 	if isinstance(sales_invoice, six.string_types):
@@ -18,27 +31,93 @@ def parse_sales_invoice(sales_invoice):
 	return sales_invoice
 
 def get_service_provider_connector():
-	service_provider = frappe.db.get_single_value('E Invoicing Settings', 'service_provider')
+	service_provider = get_einvoicing_rules().service_provider
 	controller = frappe.get_doc(service_provider)
 	connector = controller.get_connector()
 
 	return connector
 
 @frappe.whitelist()
-def generate_irn(sales_invoice):
+def generate_irn(sales_invoice, queued=None):
 	sales_invoice = parse_sales_invoice(sales_invoice)
 	validate_irn_generation(sales_invoice)
+
+	if should_run_in_background(queued):
+		return enqueue_einvoicing_request('generate_irn', sales_invoice.name)
+
+	with metrics.trace('generate_irn', provider=get_einvoicing_rules().service_provider):
+		connector = get_service_provider_connector()
+
+		publish_request_progress(_('Fetching Invoice Details'))
+		einvoice = create_einvoice(sales_invoice.name)
+		metrics.set_labels(gstin=einvoice.seller_gstin)
+
+		publish_request_progress(_('Requesting IRN'))
+		success, errors = connector.generate_irn(einvoice)
+
+		if not success:
+			frappe.throw(errors, title=_('IRN Generation Failed'), as_list=1)
+		else:
+			frappe.msgprint(_("IRN Generated Successfully."), alert=1)
+
+	return success
+
+@frappe.whitelist()
+def generate_irn_bulk(sales_invoices, queued=None):
+	'''Generates IRNs for multiple sales invoices.
+
+	Each invoice is handled on its own, so an invalid or rejected invoice does not fail the others.
+	Returns a dict of sales invoice name -> {success, errors}, or the queued request for large batches
+	& if requests are run in background, with the results set on completion'''
+	sales_invoices = parse_sales_invoice_names(sales_invoices)
+
+	if should_run_in_background(queued, bulk_request_size=len(sales_invoices)):
+		return enqueue_bulk_einvoicing_request('generate_irn_bulk', sales_invoices)
+
 	connector = get_service_provider_connector()
+	publish_request_progress(_('Requesting IRNs'))
+
+	results = {}
+	einvoices = []
+	for sales_invoice_name in sales_invoices:
+		try:
+			sales_invoice = frappe.db.get_value('Sales Invoice', sales_invoice_name, ['name', 'e_invoice'], as_dict=1)
+			if not sales_invoice:
+				frappe.throw(_('Sales Invoice {} not found.').format(sales_invoice_name))
 
-	einvoice = create_einvoice(sales_invoice.name)
-	success, errors = connector.generate_irn(einvoice)
+			validate_irn_generation(sales_invoice)
+			einvoices.append(create_einvoice(sales_invoice.name))
+		except Exception as e:
+			frappe.db.rollback()
+			results[sales_invoice_name] = (False, get_exception_messages(e))
 
-	if not success:
-		frappe.throw(errors, title=_('IRN Generation Failed'), as_list=1)
+	if hasattr(connector, 'bulk_generate_irn'):
+		results.update(connector.bulk_generate_irn(einvoices))
 	else:
-		frappe.msgprint(_("IRN Generated Successfully."), alert=1)
+		for einvoice in einvoices:
+			try:
+				results[einvoice.invoice] = connector.generate_irn(einvoice)
+			except Exception as e:
+				results[einvoice.invoice] = (False, get_exception_messages(e))
 
-	return success
+	results = {
+		name: frappe._dict(success=bool(success), errors=errors or [])
+		for name, (success, errors) in results.items()
+	}
+	generated = len([d for d in results.values() if d.success])
+	frappe.msgprint(_("IRN Generated for {} of {} Sales Invoices.").format(generated, len(sales_invoices)), alert=1)
+
+	return results
+
+def parse_sales_invoice_names(sales_invoices):
+	if isinstance(sales_invoices, six.string_types):
+		sales_invoices = safe_load_json(sales_invoices)
+
+	if not isinstance(sales_invoices, list):
+		frappe.throw(_('Invalid Argument: Sales Invoices'))
+
+	# remove duplicates, preserving order
+	return list(dict.fromkeys(sales_invoices))
 
 def validate_irn_generation(sales_invoice):
 	if sales_invoice.e_invoice:
@@ -48,19 +127,88 @@ def validate_irn_generation(sales_invoice):
 			msg += _('Check E-Invoice {} for more details.').format(get_link_to_form('E Invoice', sales_invoice.e_invoice))
 			frappe.throw(msg=msg, title=_('Invalid Request'))
 
-@frappe.whitelist()
-def cancel_irn(sales_invoice, reason, remark):
-	sales_invoice = parse_sales_invoice(sales_invoice)
+def reconcile_pending_irns(batch_size=RECONCILIATION_BATCH_SIZE):
+	'''Scheduled job to update the e-invoices stuck in IRN Pending, whose IRN may have been generated on the portal
+
+	Only the e-invoices whose last request got no response, made more than the configured minutes ago are queried'''
+	rules = get_einvoicing_rules()
+	if not rules.enabled:
+		return
+
+	settings = frappe.get_cached_doc('E Invoicing Settings')
+	# settings saved before these fields were added have them unset
+	if settings.reconcile_pending_irns is not None and not cint(settings.reconcile_pending_irns):
+		return
+
 	connector = get_service_provider_connector()
+	if not hasattr(connector, 'reconcile_irns'):
+		# service provider doesn't support fetching IRN details
+		return
 
+	einvoices = get_pending_einvoices(settings, batch_size)
+	if not einvoices:
+		return
+
+	max_concurrent_requests = cint(settings.max_concurrent_requests_per_gstin) or 4
+	return connector.reconcile_irns(einvoices, max_concurrent_requests=max_concurrent_requests)
+
+def get_pending_einvoices(settings, batch_size=RECONCILIATION_BATCH_SIZE):
+	'''Returns the IRN pending e-invoices whose last request got no response, e.g. it timed out,
+	made more than the configured minutes & less than `RECONCILIATION_MAX_AGE_DAYS` ago
+
+	E-invoices rejected by the portal, or already looked up, have a response logged & are not queried again'''
+	reconcile_after_minutes = settings.reconcile_after_minutes
+	if reconcile_after_minutes is None:
+		reconcile_after_minutes = 15
+
+	requested_before = add_to_date(now_datetime(), minutes=-cint(reconcile_after_minutes))
+	requested_after = add_to_date(now_datetime(), days=-RECONCILIATION_MAX_AGE_DAYS)
+
+	# logs are queued in redis till a background job inserts them, so insert the queued logs first
+	flush_request_logs()
+	# logs still queued, e.g. while another flush is running, are of requests just made
+	queued_einvoices = get_queued_reference_invoices()
+
+	pending_einvoices = frappe.db.sql('''
+		select distinct log.reference_invoice, log.timestamp
+		from `tabE Invoice Request Log` log
+		inner join `tabE Invoice` einvoice on einvoice.name = log.reference_invoice
+		where einvoice.status = 'IRN Pending' and einvoice.docstatus = 0
+			and log.timestamp = (
+				select max(latest.timestamp) from `tabE Invoice Request Log` latest
+				where latest.reference_invoice = log.reference_invoice
+			)
+			and log.timestamp between %(requested_after)s and %(requested_before)s
+			and ifnull(log.response, '') = ''
+		order by log.timestamp asc
+		limit %(batch_size)s
+	''', {
+		'requested_after': requested_after,
+		'requested_before': requested_before,
+		'batch_size': cint(batch_size)
+	})
+
+	return [frappe.get_doc('E Invoice', name) for name, _timestamp in pending_einvoices if name not in queued_einvoices]
+
+@frappe.whitelist()
+def cancel_irn(sales_invoice, reason, remark, queued=None):
+	sales_invoice = parse_sales_invoice(sales_invoice)
 	einvoice = get_einvoice(sales_invoice.name)
 	validate_irn_cancellation(einvoice)
-	success, errors = connector.cancel_irn(einvoice, reason, remark)
 
-	if not success:
-		frappe.throw(errors, title=_('IRN Cancellation Failed'), as_list=1)
-	else:
-		frappe.msgprint(_("IRN Cancelled Successfully."), alert=1)
+	if should_run_in_background(queued):
+		return enqueue_einvoicing_request('cancel_irn', sales_invoice.name, reason=reason, remark=remark)
+
+	with metrics.trace('cancel_irn', provider=get_einvoicing_rules().service_provider, gstin=einvoice.seller_gstin):
+		connector = get_service_provider_connector()
+
+		publish_request_progress(_('Requesting IRN Cancellation'))
+		success, errors = connector.cancel_irn(einvoice, reason, remark)
+
+		if not success:
+			frappe.throw(errors, title=_('IRN Cancellation Failed'), as_list=1)
+		else:
+			frappe.msgprint(_("IRN Cancelled Successfully."), alert=1)
 
 	return success
 
@@ -77,22 +225,268 @@ def validate_irn_cancellation(einvoice):
 		frappe.throw(_('IRN is already cancelled. You cannot cancel e-invoice twice.'),
 			title=_('Invalid Request'))
 
+def should_run_in_background(queued=None, bulk_request_size=0):
+	if frappe.flags.einvoicing_request_id:
+		# already running as a background job
+		return False
+
+	if bulk_request_size > BULK_REQUEST_BACKGROUND_THRESHOLD:
+		return True
+
+	if queued is not None:
+		return cint(queued)
+
+	return cint(frappe.db.get_single_value('E Invoicing Settings', 'run_in_background'))
+
+def enqueue_einvoicing_request(action, sales_invoice_name, **kwargs):
+	current_request = frappe.cache().get_value(get_request_cache_key(sales_invoice_name))
+	if is_request_in_progress(current_request):
+		frappe.throw(_('An e-invoicing request is already in progress for the Sales Invoice. Please wait for it to complete.'),
+			title=_('Request In Progress'))
+
+	request_id = frappe.generate_hash(length=10)
+	# set before enqueueing, so that it doesn't overwrite the status set by a worker picking the job up immediately
+	set_request_status(request_id, sales_invoice_name, 'Queued', action=action)
+	try:
+		frappe.enqueue(
+			'erpnext_gst_compliance.erpnext_gst_compliance.e_invoicing_controller.execute_einvoicing_request',
+			queue='short',
+			timeout=EINVOICING_REQUEST_TIMEOUT,
+			job_name='E-Invoicing: {} {}'.format(action, sales_invoice_name),
+			action=action,
+			request_id=request_id,
+			sales_invoice_name=sales_invoice_name,
+			**kwargs
+		)
+	except Exception as e:
+		set_request_status(request_id, sales_invoice_name, 'Failed', action=action, errors=get_exception_messages(e))
+		raise
+
+	frappe.msgprint(_("Request Queued. The Sales Invoice will be updated once it is processed."), alert=1)
+
+	return frappe._dict(request_id=request_id, status='Queued')
+
+def execute_einvoicing_request(action, request_id, sales_invoice_name, **kwargs):
+	frappe.flags.einvoicing_request_id = request_id
+	set_request_status(request_id, sales_invoice_name, 'Processing', action=action)
+
+	try:
+		sales_invoice = frappe.db.get_value('Sales Invoice', sales_invoice_name, ['name', 'e_invoice'], as_dict=1)
+		if action == 'generate_irn':
+			generate_irn(sales_invoice)
+		elif action == 'cancel_irn':
+			cancel_irn(sales_invoice, kwargs.get('reason'), kwargs.get('remark'))
+		frappe.db.commit()
+
+	except Exception as e:
+		frappe.db.rollback()
+		set_request_status(request_id, sales_invoice_name, 'Failed', action=action, errors=get_exception_messages(e))
+
+	else:
+		set_request_status(request_id, sales_invoice_name, 'Completed', action=action)
+
+	finally:
+		frappe.flags.einvoicing_request_id = None
+
+def enqueue_bulk_einvoicing_request(action, sales_invoices, **kwargs):
+	request_id = frappe.generate_hash(length=10)
+	set_request_status(request_id, None, 'Queued', action=action, timeout=BULK_REQUEST_TIMEOUT)
+	try:
+		frappe.enqueue(
+			'erpnext_gst_compliance.erpnext_gst_compliance.e_invoicing_controller.execute_bulk_einvoicing_request',
+			queue='long',
+			timeout=BULK_REQUEST_TIMEOUT,
+			job_name='E-Invoicing: {} for {} Sales Invoices'.format(action, len(sales_invoices)),
+			action=action,
+			request_id=request_id,
+			sales_invoices=sales_invoices,
+			**kwargs
+		)
+	except Exception as e:
+		set_request_status(request_id, None, 'Failed', action=action, timeout=BULK_REQUEST_TIMEOUT,
+			errors=get_exception_messages(e))
+		raise
+
+	frappe.msgprint(_("Request Queued. You will be notified once it is processed."), alert=1)
+
+	return frappe._dict(request_id=request_id, status='Queued')
+
+def execute_bulk_einvoicing_request(action, request_id, sales_invoices, **kwargs):
+	frappe.flags.einvoicing_request_id = request_id
+	set_request_status(request_id, None, 'Processing', action=action, timeout=BULK_REQUEST_TIMEOUT)
+
+	try:
+		if action == 'generate_irn_bulk':
+			results = generate_irn_bulk(sales_invoices)
+		elif action == 'generate_eway_bill_bulk':
+			results = generate_eway_bill_bulk(sales_invoices, **kwargs)
+		frappe.db.commit()
+
+	except Exception as e:
+		frappe.db.rollback()
+		set_request_status(request_id, None, 'Failed', action=action, timeout=BULK_REQUEST_TIMEOUT,
+			errors=get_exception_messages(e))
+
+	else:
+		set_request_status(request_id, None, 'Completed', action=action, timeout=BULK_REQUEST_TIMEOUT,
+			results=results)
+
+	finally:
+		frappe.flags.einvoicing_request_id = None
+
+def publish_request_progress(progress):
+	'''Publishes the current step of a queued request, does nothing for requests made in the foreground'''
+	request_id = frappe.flags.einvoicing_request_id
+	if not request_id:
+		return
+
+	request = frappe.cache().get_value(get_request_cache_key(request_id))
+	if request:
+		set_request_status(request_id, request.sales_invoice, 'Processing', action=request.action,
+			timeout=request.timeout, progress=progress)
+
+def set_request_status(request_id, sales_invoice_name, status, **kwargs):
+	request = frappe._dict(kwargs)
+	request.update({
+		'request_id': request_id,
+		'sales_invoice': sales_invoice_name,
+		'user': frappe.session.user,
+		'status': status,
+		'timestamp': str(now_datetime())
+	})
+
+	# statuses are kept for a day for polling, bulk requests have no sales invoice
+	for key in [request_id, sales_invoice_name]:
+		if key:
+			frappe.cache().set_value(get_request_cache_key(key), request, expires_in_sec=86400)
+
+	if sales_invoice_name:
+		frappe.publish_realtime('einvoicing_request_progress', request,
+			doctype='Sales Invoice', docname=sales_invoice_name, after_commit=False)
+	else:
+		frappe.publish_realtime('einvoicing_request_progress', request, user=request.user, after_commit=False)
+
+def get_request_cache_key(key):
+	return 'einvoicing_request:{}'.format(key)
+
+def is_request_in_progress(request):
+	if not request or request.get('status') not in ['Queued', 'Processing']:
+		return False
+
+	return not is_request_stale(request)
+
+def is_request_stale(request):
+	'''Returns True if a queued or processing request is not updated within the job timeout'''
+	# requests queued before the timestamp was added have none
+	timestamp = request.get('timestamp')
+	timeout = request.get('timeout') or EINVOICING_REQUEST_TIMEOUT
+	return not timestamp or time_diff_in_seconds(now_datetime(), timestamp) > timeout
+
+@frappe.whitelist()
+def get_request_status(request_id=None, sales_invoice=None):
+	'''Returns the status of a queued request, by request id or by the latest request of a sales invoice'''
+	if not (request_id or sales_invoice):
+		frappe.throw(_('Request ID or Sales Invoice is required to get the request status.'))
+
+	request = frappe.cache().get_value(get_request_cache_key(request_id or sales_invoice))
+	if request:
+		if request.sales_invoice:
+			frappe.has_permission('Sales Invoice', 'read', request.sales_invoice, throw=True)
+		elif request.user != frappe.session.user:
+			# bulk requests are visible only to the user who made them
+			frappe.throw(_('Not permitted to view this request.'), frappe.PermissionError)
+
+		if request.status in ['Queued', 'Processing'] and is_request_stale(request):
+			# reported as failed, so that the form stops polling for it
+			request.update({
+				'status': 'Failed',
+				'errors': [_('The request did not complete in time. Please check the Sales Invoice and try again.')]
+			})
+
+	return request
+
 @frappe.whitelist()
 def generate_eway_bill(sales_invoice_name, **kwargs):
-	connector = get_service_provider_connector()
+	with metrics.trace('generate_eway_bill', provider=get_einvoicing_rules().service_provider):
+		connector = get_service_provider_connector()
 
-	eway_bill_details = frappe._dict(kwargs)
-	einvoice = get_einvoice(sales_invoice_name)
-	einvoice.set_eway_bill_details(eway_bill_details)
-	success, errors = connector.generate_eway_bill(einvoice)
+		eway_bill_details = frappe._dict(kwargs)
+		with metrics.timer('einvoice_load'):
+			einvoice = get_einvoice(sales_invoice_name)
+		metrics.set_labels(gstin=einvoice.seller_gstin)
 
-	if not success:
-		frappe.throw(errors, title=_('E-Way Bill Generation Failed'), as_list=1)
-	else:
-		frappe.msgprint(_("E-Way Bill Generated Successfully."), alert=1)
+		einvoice.set_eway_bill_details(eway_bill_details)
+		success, errors = connector.generate_eway_bill(einvoice)
+
+		if not success:
+			frappe.throw(errors, title=_('E-Way Bill Generation Failed'), as_list=1)
+		else:
+			frappe.msgprint(_("E-Way Bill Generated Successfully."), alert=1)
 
 	return success
 
+@frappe.whitelist()
+def generate_eway_bill_bulk(sales_invoices, queued=None, **kwargs):
+	'''Generates e-way bills for multiple sales invoices with the same transport details, e.g. dispatched in one vehicle.
+
+	Each invoice is handled on its own, so an invalid or rejected invoice does not fail the others.
+	Returns a dict of sales invoice name -> {success, errors}, or the queued request for large batches
+	& if requests are run in background, with the results set on completion'''
+	sales_invoices = parse_sales_invoice_names(sales_invoices)
+	kwargs.pop('cmd', None)
+
+	if should_run_in_background(queued, bulk_request_size=len(sales_invoices)):
+		return enqueue_bulk_einvoicing_request('generate_eway_bill_bulk', sales_invoices, **kwargs)
+
+	eway_bill_details = frappe._dict(kwargs)
+	with metrics.trace('generate_eway_bill_bulk', provider=get_einvoicing_rules().service_provider):
+		connector = get_service_provider_connector()
+		publish_request_progress(_('Generating E-Way Bills'))
+
+		results = {}
+		einvoices = []
+		for sales_invoice_name in sales_invoices:
+			try:
+				einvoice = get_einvoice(sales_invoice_name)
+				validate_eway_bill_generation(einvoice)
+				einvoice.set_eway_bill_details(eway_bill_details)
+				einvoices.append(einvoice)
+			except Exception as e:
+				results[sales_invoice_name] = (False, get_exception_messages(e))
+
+		if hasattr(connector, 'bulk_generate_eway_bill'):
+			max_concurrent_requests = cint(frappe.db.get_single_value('E Invoicing Settings',
+				'max_concurrent_requests_per_gstin')) or 4
+			results.update(connector.bulk_generate_eway_bill(einvoices, max_concurrent_requests=max_concurrent_requests))
+		else:
+			for einvoice in einvoices:
+				try:
+					results[einvoice.invoice] = connector.generate_eway_bill(einvoice)
+				except Exception as e:
+					results[einvoice.invoice] = (False, get_exception_messages(e))
+
+	results = {
+		name: frappe._dict(success=bool(success), errors=errors or [])
+		for name, (success, errors) in results.items()
+	}
+	generated = len([d for d in results.values() if d.success])
+	frappe.msgprint(_("E-Way Bill Generated for {} of {} Sales Invoices.").format(generated, len(sales_invoices)), alert=1)
+
+	return results
+
+def validate_eway_bill_generation(einvoice):
+	if not einvoice.irn or einvoice.status not in ['IRN Generated', 'E-Way Bill Cancelled'] \
+		or has_active_eway_bill(einvoice):
+		frappe.throw(_('E-Way Bill can be generated only for e-invoices with IRN generated and no active e-way bill.'),
+			title=_('Invalid Request'))
+
+def has_active_eway_bill(einvoice):
+	# e-way bills generated along with the IRN keep the e-invoice in IRN Generated status
+	if not einvoice.ewaybill:
+		return False
+
+	return not einvoice.ewaybill_validity or get_datetime(einvoice.ewaybill_validity) > now_datetime()
+
 # cancel ewaybill api is currently not supported by E-Invoice Portal
 
 # @frappe.whitelist()
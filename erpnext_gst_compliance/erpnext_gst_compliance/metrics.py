@@ -0,0 +1,196 @@
+'''Latency histograms of the e-invoicing phases, shared by all workers of the site through redis
+
+Every observation is labelled with the phase, action (generate_irn, cancel_irn, ...), service provider,
+GSTIN, endpoint (for http requests) & outcome. Counts are exported in Prometheus text format by `get_metrics`
+& summarized for the E-Invoicing Metrics page by `get_metrics_summary`.'''
+
+import time
+import frappe
+from functools import wraps
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+METRICS_KEY = 'einvoicing_metrics'
+LABELS = ('phase', 'action', 'provider', 'gstin', 'endpoint', 'outcome')
+# upper bounds in seconds, +Inf is implied
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+@contextmanager
+def trace(action, provider=None, gstin=None):
+	'''Labels the phases timed within it with the action & records its total duration'''
+	previous_labels = frappe.flags.einvoicing_metric_labels
+	frappe.flags.einvoicing_metric_labels = {
+		'action': action,
+		'provider': provider or '',
+		'gstin': gstin or ''
+	}
+	try:
+		with timer('total'):
+			yield
+	finally:
+		frappe.flags.einvoicing_metric_labels = previous_labels
+
+@contextmanager
+def timer(phase, **labels):
+	start = time.perf_counter()
+	outcome = 'success'
+	try:
+		yield
+	except Exception:
+		outcome = 'error'
+		raise
+	finally:
+		observe(phase, time.perf_counter() - start, outcome=outcome, **labels)
+
+def timed(phase):
+	'''Decorator to time every call of the function as a phase'''
+	def decorator(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			with timer(phase):
+				return fn(*args, **kwargs)
+
+		return wrapper
+
+	return decorator
+
+def set_labels(**labels):
+	'''Updates the labels of the current trace, e.g. with the gstin once it is known'''
+	if frappe.flags.einvoicing_metric_labels is not None:
+		frappe.flags.einvoicing_metric_labels.update(labels)
+
+def get_endpoint(url):
+	return urlparse(url).path
+
+def observe(phase, duration, **labels):
+	values = dict(frappe.flags.einvoicing_metric_labels or {})
+	values.update({key: value for key, value in labels.items() if value is not None})
+	values['phase'] = phase
+	series = '|'.join(str(values.get(label) or '') for label in LABELS)
+
+	bucket = next((str(le) for le in BUCKETS if duration <= le), '+Inf')
+	try:
+		cache = frappe.cache()
+		pipeline = cache.pipeline(transaction=False)
+		key = cache.make_key(METRICS_KEY)
+		# buckets are stored non-cumulative & accumulated on export
+		pipeline.hincrby(key, series + '|' + bucket, 1)
+		pipeline.hincrby(key, series + '|count', 1)
+		pipeline.hincrbyfloat(key, series + '|sum', duration)
+		pipeline.execute()
+	except Exception:
+		# metrics must never fail a request
+		pass
+
+def get_series():
+	'''Returns a dict of labels tuple -> {buckets, count, sum}'''
+	cache = frappe.cache()
+	# raw values, since the hash methods of the cache pickle them
+	pipeline = cache.pipeline()
+	pipeline.hgetall(cache.make_key(METRICS_KEY))
+	values = pipeline.execute()[0]
+
+	series = {}
+	for field, value in values.items():
+		field = frappe.safe_decode(field)
+		labels, _sep, suffix = field.rpartition('|')
+		labels = tuple(labels.split('|'))
+		if len(labels) != len(LABELS):
+			continue
+
+		entry = series.setdefault(labels, {'buckets': {}, 'count': 0, 'sum': 0.0})
+		if suffix == 'count':
+			entry['count'] = int(value)
+		elif suffix == 'sum':
+			entry['sum'] = float(value)
+		else:
+			entry['buckets'][suffix] = int(value)
+
+	return series
+
+def get_cumulative_buckets(buckets):
+	cumulative, count = [], 0
+	for le in [str(le) for le in BUCKETS] + ['+Inf']:
+		count += buckets.get(le, 0)
+		cumulative.append((le, count))
+
+	return cumulative
+
+@frappe.whitelist()
+def get_metrics():
+	'''Returns the metrics in Prometheus text format'''
+	frappe.only_for('System Manager')
+
+	lines = [
+		'# HELP einvoicing_phase_duration_seconds Duration of the e-invoicing phases',
+		'# TYPE einvoicing_phase_duration_seconds histogram'
+	]
+	requests = []
+	for labels, entry in sorted(get_series().items()):
+		label_values = dict(zip(LABELS, labels))
+		label_text = ','.join('{}="{}"'.format(key, escape_label_value(value)) for key, value in label_values.items())
+
+		for le, count in get_cumulative_buckets(entry['buckets']):
+			lines.append('einvoicing_phase_duration_seconds_bucket{{{},le="{}"}} {}'.format(label_text, le, count))
+		lines.append('einvoicing_phase_duration_seconds_sum{{{}}} {}'.format(label_text, entry['sum']))
+		lines.append('einvoicing_phase_duration_seconds_count{{{}}} {}'.format(label_text, entry['count']))
+
+		if label_values['phase'] == 'total':
+			request_labels = ','.join('{}="{}"'.format(key, escape_label_value(label_values[key]))
+				for key in ('action', 'provider', 'gstin', 'outcome'))
+			requests.append('einvoicing_requests_total{{{}}} {}'.format(request_labels, entry['count']))
+
+	lines += [
+		'# HELP einvoicing_requests_total E-invoicing requests made',
+		'# TYPE einvoicing_requests_total counter'
+	] + requests
+
+	frappe.response['type'] = 'txt'
+	frappe.response['doctype'] = 'einvoicing_metrics'
+	frappe.response['result'] = '\n'.join(lines) + '\n'
+
+def escape_label_value(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+@frappe.whitelist()
+def get_metrics_summary():
+	'''Returns count, average & estimated percentiles per phase, endpoint & outcome for the metrics page'''
+	frappe.only_for('System Manager')
+
+	rows = {}
+	for labels, entry in get_series().items():
+		label_values = dict(zip(LABELS, labels))
+		key = (label_values['phase'], label_values['action'], label_values['endpoint'], label_values['outcome'])
+		row = rows.setdefault(key, {'buckets': {}, 'count': 0, 'sum': 0.0})
+		row['count'] += entry['count']
+		row['sum'] += entry['sum']
+		for le, count in entry['buckets'].items():
+			row['buckets'][le] = row['buckets'].get(le, 0) + count
+
+	summary = []
+	for (phase, action, endpoint, outcome), row in sorted(rows.items()):
+		cumulative = get_cumulative_buckets(row['buckets'])
+		summary.append({
+			'phase': phase,
+			'action': action,
+			'endpoint': endpoint,
+			'outcome': outcome,
+			'count': row['count'],
+			'total_time': row['sum'],
+			'average': row['sum'] / row['count'] if row['count'] else 0,
+			'p50': get_percentile(cumulative, row['count'], 0.5),
+			'p95': get_percentile(cumulative, row['count'], 0.95)
+		})
+
+	return summary
+
+def get_percentile(cumulative, count, quantile):
+	'''Returns the upper bound of the bucket containing the quantile, None if it is beyond the last bucket'''
+	for le, bucket_count in cumulative:
+		if count and bucket_count >= count * quantile:
+			return float(le) if le != '+Inf' else None
+
+@frappe.whitelist()
+def reset_metrics():
+	frappe.only_for('System Manager')
+	frappe.cache().delete_value(METRICS_KEY)
@@ -0,0 +1,104 @@
+// Copyright (c) 2021, Frappe and contributors
+// For license information, please see license.txt
+
+frappe.pages['einvoicing-metrics'].on_page_load = function(wrapper) {
+	const page = frappe.ui.make_app_page({
+		parent: wrapper,
+		title: __('E-Invoicing Metrics'),
+		single_column: true
+	});
+
+	wrapper.metrics = new EInvoicingMetrics(page);
+};
+
+frappe.pages['einvoicing-metrics'].on_page_show = function(wrapper) {
+	wrapper.metrics && wrapper.metrics.refresh();
+};
+
+class EInvoicingMetrics {
+	constructor(page) {
+		this.page = page;
+		// counts of the previous refresh, to show the throughput since then
+		this.previous = null;
+		this.$body = $('<div class="frappe-card">').appendTo(page.main);
+
+		page.set_primary_action(__('Refresh'), () => this.refresh(), 'refresh');
+		page.add_menu_item(__('Reset Metrics'), () => {
+			frappe.confirm(__('Clear all the recorded metrics?'), () => {
+				frappe.call('erpnext_gst_compliance.erpnext_gst_compliance.metrics.reset_metrics')
+					.then(() => this.refresh());
+			});
+		});
+		page.add_menu_item(__('Prometheus Metrics'), () => {
+			window.open('/api/method/erpnext_gst_compliance.erpnext_gst_compliance.metrics.get_metrics');
+		});
+
+		// refreshes every 10 seconds while the page is open
+		this.interval = setInterval(() => {
+			if (frappe.get_route_str() === 'einvoicing-metrics') this.refresh();
+		}, 10000);
+	}
+
+	refresh() {
+		frappe.call('erpnext_gst_compliance.erpnext_gst_compliance.metrics.get_metrics_summary')
+			.then(r => this.render(r.message || []));
+	}
+
+	render(rows) {
+		const now = Date.now();
+		const previous = this.previous;
+		this.previous = { time: now, counts: {} };
+
+		if (!rows.length) {
+			this.$body.html(`<div class="text-muted text-center" style="padding: 30px">
+				${__('No e-invoicing requests recorded yet.')}</div>`);
+			return;
+		}
+
+		const seconds = value => value == null ? '> 60 s' : format_duration(value);
+		const html_rows = rows.map(row => {
+			const key = [row.phase, row.action, row.endpoint, row.outcome].join('|');
+			this.previous.counts[key] = row.count;
+
+			let throughput = '-';
+			if (previous && key in previous.counts) {
+				const elapsed = (now - previous.time) / 1000;
+				throughput = ((row.count - previous.counts[key]) / elapsed).toFixed(2) + ' / s';
+			}
+
+			const indicator = row.outcome == 'success' ? 'green' : 'red';
+			return `<tr>
+				<td>${frappe.utils.escape_html(row.phase)}</td>
+				<td>${frappe.utils.escape_html(row.action || '')}</td>
+				<td>${frappe.utils.escape_html(row.endpoint || '')}</td>
+				<td><span class="indicator-pill ${indicator}">${frappe.utils.escape_html(row.outcome)}</span></td>
+				<td class="text-right">${row.count}</td>
+				<td class="text-right">${throughput}</td>
+				<td class="text-right">${format_duration(row.average)}</td>
+				<td class="text-right">${seconds(row.p50)}</td>
+				<td class="text-right">${seconds(row.p95)}</td>
+				<td class="text-right">${format_duration(row.total_time)}</td>
+			</tr>`;
+		});
+
+		this.$body.html(`<table class="table table-bordered" style="margin: 0">
+			<thead><tr>
+				<th>${__('Phase')}</th>
+				<th>${__('Action')}</th>
+				<th>${__('Endpoint')}</th>
+				<th>${__('Outcome')}</th>
+				<th class="text-right">${__('Count')}</th>
+				<th class="text-right">${__('Throughput')}</th>
+				<th class="text-right">${__('Average')}</th>
+				<th class="text-right">${__('p50 (≤)')}</th>
+				<th class="text-right">${__('p95 (≤)')}</th>
+				<th class="text-right">${__('Total Time')}</th>
+			</tr></thead>
+			<tbody>${html_rows.join('')}</tbody>
+		</table>`);
+	}
+}
+
+function format_duration(value) {
+	return value < 1 ? `${(value * 1000).toFixed(1)} ms` : `${value.toFixed(2)} s`;
+}
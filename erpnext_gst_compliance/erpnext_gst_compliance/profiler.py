@@ -0,0 +1,114 @@
+'''Opt-in profiling of the connector entry points, for diagnosing slow requests in production
+
+When enabled in E Invoicing Settings, a sample of the calls is run under cProfile & the SQL queries of every call
+are counted & timed. Calls slower than the threshold get a summary of both attached to their last request log.'''
+
+import io
+import time
+import random
+import frappe
+import pstats
+import cProfile
+from functools import wraps
+from contextlib import contextmanager
+from frappe.utils import cint, flt
+from erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log import queue_request_logs
+
+DEFAULT_THRESHOLD = 10
+PROFILE_LINES = 30
+SLOWEST_QUERIES = 5
+
+def profiled(fn):
+	'''Decorator for the connector entry points, profiles the call if enabled in E Invoicing Settings'''
+	@wraps(fn)
+	def wrapper(*args, **kwargs):
+		settings = frappe.get_cached_doc('E Invoicing Settings')
+		if not cint(settings.profile_slow_requests) or frappe.flags.einvoice_request_logs_buffer is not None:
+			# nested entry points are profiled by the outer one
+			return fn(*args, **kwargs)
+
+		threshold = flt(settings.profiling_threshold) or DEFAULT_THRESHOLD
+		# settings saved before these fields were added have them unset
+		sample_rate = flt(settings.profiling_sample_rate) if settings.profiling_sample_rate is not None else 100
+
+		profile = cProfile.Profile() if random.random() * 100 < sample_rate else None
+		queries = frappe._dict(count=0, time=0.0, slowest=[])
+		# request logs are held back till the call completes, to attach the profile
+		request_logs = frappe.flags.einvoice_request_logs_buffer = []
+		start = time.perf_counter()
+		try:
+			with tracked_queries(queries), profiling(profile):
+				return fn(*args, **kwargs)
+		finally:
+			duration = time.perf_counter() - start
+			frappe.flags.einvoice_request_logs_buffer = None
+			if request_logs and duration > threshold:
+				request_logs[-1].update({
+					'duration': duration,
+					'profile': get_profile_summary(duration, queries, profile)
+				})
+
+			if request_logs:
+				queue_request_logs(request_logs)
+
+	return wrapper
+
+@contextmanager
+def profiling(profile):
+	if profile:
+		try:
+			profile.enable()
+		except ValueError:
+			# another profiler is active
+			profile = None
+
+	try:
+		yield
+	finally:
+		if profile:
+			profile.disable()
+
+@contextmanager
+def tracked_queries(queries):
+	sql = frappe.db.sql
+
+	def tracked_sql(query, *args, **kwargs):
+		start = time.perf_counter()
+		try:
+			return sql(query, *args, **kwargs)
+		finally:
+			duration = time.perf_counter() - start
+			queries.count += 1
+			queries.time += duration
+			queries.slowest.append((duration, str(query).strip()[:500]))
+			if len(queries.slowest) > SLOWEST_QUERIES:
+				queries.slowest.sort(reverse=True)
+				queries.slowest.pop()
+
+	frappe.db.sql = tracked_sql
+	try:
+		yield queries
+	finally:
+		# removing the instance attribute restores the bound method
+		del frappe.db.sql
+
+def get_profile_summary(duration, queries, profile=None):
+	lines = [
+		'Duration: {:.3f} s'.format(duration),
+		'SQL: {} queries in {:.3f} s'.format(queries.count, queries.time),
+		'',
+		'Slowest queries:'
+	]
+	lines += ['{:.3f} s  {}'.format(query_time, query) for query_time, query in sorted(queries.slowest, reverse=True)]
+	lines.append('')
+
+	if not profile:
+		lines.append('Profile: not sampled')
+		return '\n'.join(lines)
+
+	stream = io.StringIO()
+	stats = pstats.Stats(profile, stream=stream)
+	stats.strip_dirs().sort_stats('cumulative').print_stats(PROFILE_LINES)
+	lines.append(stream.getvalue().strip())
+
+	return '\n'.join(lines)
@@ -36,7 +36,27 @@ frappe.query_reports["E-Invoice Summary"] = {
 			"fieldtype": "Select",
 			"fieldname": "status",
 			"label": __("Status"),
-			"options": "\nPending\nGenerated\nCancelled\nFailed"
+			"options": "\nIRN Pending\nIRN Generated\nIRN Cancelled\nE-Way Bill Generated\nE-Way Bill Cancelled"
+		},
+		{
+			"fieldtype": "Select",
+			"fieldname": "group_by",
+			"label": __("Group By"),
+			"options": "\nStatus\nDay\nGSTIN"
+		},
+		{
+			"fieldtype": "Int",
+			"fieldname": "page",
+			"label": __("Page"),
+			"default": 1,
+			"depends_on": "eval: !doc.group_by"
+		},
+		{
+			"fieldtype": "Int",
+			"fieldname": "page_length",
+			"label": __("Page Length"),
+			"default": 500,
+			"depends_on": "eval: !doc.group_by"
 		}
 	],
 
@@ -44,10 +64,9 @@ frappe.query_reports["E-Invoice Summary"] = {
 		value = default_formatter(value, row, column, data);
 
 		if (column.fieldname == "einvoice_status" && value) {
-			if (value == 'Pending') value = `<span class="bold" style="color: var(--text-on-orange)">${value}</span>`;
-			else if (value == 'Generated') value = `<span class="bold" style="color: var(--text-on-green)">${value}</span>`;
-			else if (value == 'Cancelled') value = `<span class="bold" style="color: var(--text-on-red)">${value}</span>`;
-			else if (value == 'Failed') value = `<span class="bold"  style="color: var(--text-on-red)">${value}</span>`;
+			if (value.includes('Pending')) value = `<span class="bold" style="color: var(--text-on-orange)">${value}</span>`;
+			else if (value.includes('Generated')) value = `<span class="bold" style="color: var(--text-on-green)">${value}</span>`;
+			else if (value.includes('Cancelled')) value = `<span class="bold" style="color: var(--text-on-red)">${value}</span>`;
 		}
 
 		return value;
@@ -4,14 +4,25 @@
 from __future__ import unicode_literals
 import frappe
 from frappe import _
+from frappe.utils import cint, flt
+
+STATUSES = ['IRN Pending', 'IRN Generated', 'IRN Cancelled', 'E-Way Bill Generated', 'E-Way Bill Cancelled']
+DEFAULT_PAGE_LENGTH = 500
 
 def execute(filters=None):
+	filters = frappe._dict(filters or {})
 	validate_filters(filters)
 
-	columns = get_columns()
-	data = get_data(filters)
+	if filters.group_by:
+		columns = get_group_by_columns(filters.group_by)
+		data = get_grouped_data(filters)
+	else:
+		columns = get_columns()
+		data = get_data(filters)
+
+	report_summary = get_report_summary(filters)
 
-	return columns, data
+	return columns, data, None, None, report_summary
 
 def validate_filters(filters={}):
 	filters = frappe._dict(filters)
@@ -26,25 +37,115 @@ def validate_filters(filters={}):
 	if filters.from_date > filters.to_date:
 		frappe.throw(_('From Date must be before To Date'), title=_('Invalid Filter'))
 
-def get_data(filters={}):
+def get_query_filters(filters):
 	query_filters = {
+		'company': filters.company,
 		'posting_date': ['between', [filters.from_date, filters.to_date]],
-		'einvoice_status': ['is', 'set'],
-		'company': filters.company
+		'einvoice_status': ['is', 'set']
 	}
 	if filters.customer:
 		query_filters['customer'] = filters.customer
 	if filters.status:
 		query_filters['einvoice_status'] = filters.status
 
+	return query_filters
+
+def get_data(filters={}):
+	page_length = cint(filters.page_length) or DEFAULT_PAGE_LENGTH
+	page = max(cint(filters.page), 1)
+
 	data = frappe.get_all(
 		'Sales Invoice',
-		filters=query_filters,
-		fields=[d.get('fieldname') for d in get_columns()]
+		filters=get_query_filters(filters),
+		fields=[d.get('fieldname') for d in get_columns()],
+		order_by='posting_date desc, name desc',
+		limit_start=(page - 1) * page_length,
+		limit_page_length=page_length
 	)
 
 	return data
 
+def get_grouped_data(filters):
+	group_by_field = get_group_by_field(filters.group_by)
+
+	return frappe.get_all(
+		'Sales Invoice',
+		filters=get_query_filters(filters),
+		fields=[
+			'{} as group_value'.format(group_by_field),
+			'count(name) as invoice_count',
+			'sum(base_grand_total) as base_grand_total'
+		],
+		group_by=group_by_field,
+		order_by='{} asc'.format(group_by_field)
+	)
+
+def get_group_by_field(group_by):
+	return {
+		'Status': 'einvoice_status',
+		'Day': 'posting_date',
+		'GSTIN': 'company_gstin'
+	}[group_by]
+
+def get_report_summary(filters):
+	totals = frappe.get_all(
+		'Sales Invoice',
+		filters=get_query_filters(filters),
+		fields=['einvoice_status', 'count(name) as invoice_count', 'sum(base_grand_total) as base_grand_total'],
+		group_by='einvoice_status'
+	)
+	totals = {d.einvoice_status: d for d in totals}
+	currency = frappe.get_cached_value('Company', filters.company, 'default_currency')
+
+	report_summary = [{
+		'value': sum(d.invoice_count for d in totals.values()),
+		'label': _('Total Invoices'),
+		'datatype': 'Int'
+	}, {
+		'value': sum(flt(d.base_grand_total) for d in totals.values()),
+		'label': _('Grand Total'),
+		'datatype': 'Currency',
+		'currency': currency
+	}]
+
+	for status in STATUSES:
+		if status not in totals:
+			continue
+
+		report_summary.append({
+			'value': totals[status].invoice_count,
+			'label': _(status),
+			'datatype': 'Int',
+			'indicator': 'Red' if 'Cancelled' in status else 'Orange' if status == 'IRN Pending' else 'Green'
+		})
+
+	return report_summary
+
+def get_group_by_columns(group_by):
+	group_by_column = {
+		'Status': {"fieldtype": "Data", "label": _("Status"), "width": 180},
+		'Day': {"fieldtype": "Date", "label": _("Posting Date"), "width": 120},
+		'GSTIN': {"fieldtype": "Data", "label": _("Company GSTIN"), "width": 180}
+	}[group_by]
+	group_by_column["fieldname"] = "group_value"
+
+	return [
+		group_by_column,
+		{
+			"fieldtype": "Int",
+			"fieldname": "invoice_count",
+			"label": _("Invoices"),
+			"width": 100
+		},
+		{
+			"fieldtype": "Currency",
+			"options": "Company:company:default_currency",
+			"fieldname": "base_grand_total",
+			"label": _("Grand Total"),
+			"width": 140
+		}
+	]
+
 def get_columns():
 	return [
 		{
@@ -1,7 +1,11 @@
+import time
 import frappe
-from frappe.utils import cint, add_to_date
+from frappe.utils import cint, flt, add_to_date
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
+BACKFILL_CHUNK_SIZE = 500
+BACKFILL_PROGRESS_KEY = 'einvoice_backfill_progress'
+
 def setup():
 	copy_adequare_credentials()
 	enable_report_and_print_format()
@@ -92,6 +96,12 @@ def setup_custom_fields():
 
 	print('Creating Custom Fields for E-Invoicing...')
 	create_custom_fields(custom_fields, update=True)
+	add_einvoice_indexes()
+
+def add_einvoice_indexes():
+	# for filtering e-invoices of a company by posting date range, with or without a status
+	frappe.db.add_index('Sales Invoice', ['company', 'posting_date', 'einvoice_status'], 'company_posting_date_einvoice_status')
+	frappe.db.add_index('Sales Invoice', ['company', 'einvoice_status', 'posting_date'], 'company_einvoice_status_posting_date')
 
 def copy_adequare_credentials():
 	if frappe.db.exists('E Invoice Settings'):
@@ -135,69 +145,90 @@ def enable_report_and_print_format():
 		)).insert()
 
 def handle_existing_e_invoices():
-	if frappe.get_all('Sales Invoice', {'irn': ['is', 'set']}):
+	if frappe.db.exists('Sales Invoice', {'irn': ['is', 'set']}):
 		try:
 			update_sales_invoices()
-			create_einvoices()
+			enqueue_einvoice_backfill()
 		except Exception:
 			frappe.log_error(title="Backporting Sales Invoices Failed")
 
 def update_sales_invoices():
-	einvoices = frappe.db.sql("""
-		select
-			name, irn, irn_cancelled, ewaybill, eway_bill_cancelled, einvoice_status
-		from
+	print('Updating Sales Invoices...')
+	# precedence of statuses is e-way bill cancelled > e-way bill generated > irn cancelled > irn generated
+	frappe.db.sql("""
+		update
 			`tabSales Invoice`
+		set
+			einvoice_status = case
+				when ifnull(eway_bill_cancelled, 0) = 1 then 'E-Way Bill Cancelled'
+				when ifnull(ewaybill, '') != '' then 'E-Way Bill Generated'
+				when ifnull(irn_cancelled, 0) = 1 then 'IRN Cancelled'
+				else 'IRN Generated'
+			end
 		where
 			ifnull(irn, '') != ''
-	""", as_dict=1)
-
-	if not einvoices:
-		return
-
-	print('Updating Sales Invoices...')
-	for invoice in einvoices:
-		einvoice_status = 'IRN Generated'
-		if cint(invoice.irn_cancelled):
-			einvoice_status = 'IRN Cancelled'
-		if invoice.ewaybill:
-			einvoice_status = 'E-Way Bill Generated'
-		if cint(invoice.eway_bill_cancelled):
-			einvoice_status = 'E-Way Bill Cancelled'
-
-		frappe.db.set_value('Sales Invoice', invoice.name, 'einvoice_status', einvoice_status, update_modified=False)
+	""")
 	frappe.db.commit()
 
-def create_einvoices():
-	draft_einvoices = frappe.db.sql("""
+def get_pending_einvoices():
+	'''Returns draft sales invoices & sales invoices with irns created within 24 hours, without an e-invoice
+
+	Sales invoices with an e-invoice are skipped, so a rerun resumes from where the last run stopped'''
+	return frappe.db.sql_list("""
 		select
-			name, irn, ack_no, ack_date, irn_cancelled, irn_cancel_date,
-			ewaybill, eway_bill_validity, einvoice_status, qrcode_image, docstatus
+			si.name
 		from
-			`tabSales Invoice`
+			`tabSales Invoice` si
 		where
-			ifnull(irn, '') != '' AND docstatus = 0
-	""", as_dict=1)
-
-	draft_einvoices_names = [d.name for d in draft_einvoices]
+			ifnull(si.irn, '') != ''
+			and (si.docstatus = 0 or (si.docstatus = 1 and timestamp(si.ack_date) >= %s))
+			and not exists (select name from `tabE Invoice` ei where ei.invoice = si.name)
+		order by
+			si.name
+	""", add_to_date(None, hours=-24))
+
+def enqueue_einvoice_backfill():
+	'''Creates e-invoices for the pending sales invoices in chunks, spread over the background workers'''
+	invoice_names = get_pending_einvoices()
+	if not invoice_names:
+		return
 
-	# sales invoices with irns created within 24 hours
-	recent_einvoices = frappe.db.sql("""
+	print('Creating {} E-Invoices...'.format(len(invoice_names)))
+	# raw redis hash, since the cache wrapper pickles hash values which can't be incremented
+	pipeline = frappe.cache().pipeline()
+	progress_key = frappe.cache().make_key(BACKFILL_PROGRESS_KEY)
+	pipeline.delete(progress_key)
+	pipeline.hset(progress_key, mapping={'total': len(invoice_names), 'done': 0, 'failed': 0, 'started_at': time.time()})
+	pipeline.execute()
+
+	for i in range(0, len(invoice_names), BACKFILL_CHUNK_SIZE):
+		frappe.enqueue(
+			'erpnext_gst_compliance.erpnext_gst_compliance.setup.create_einvoices',
+			queue='long',
+			timeout=3600,
+			invoice_names=invoice_names[i:i + BACKFILL_CHUNK_SIZE],
+			now=frappe.flags.in_test
+		)
+
+def create_einvoices(invoice_names):
+	invoices = frappe.db.sql("""
 		select
 			name, irn, ack_no, ack_date, irn_cancelled, irn_cancel_date,
 			ewaybill, eway_bill_validity, einvoice_status, qrcode_image, docstatus
 		from
 			`tabSales Invoice`
 		where
-			ifnull(irn, '') != '' AND docstatus != 2 AND
-			timestamp(ack_date) >= %s and name not in %s
-	""", (add_to_date(None, hours=-24), draft_einvoices_names), as_dict=1)
+			name in %s
+	""", [invoice_names], as_dict=1)
 
-	if not draft_einvoices + recent_einvoices:
-		return
+	done, failed = 0, 0
+	for invoice in invoices:
+		if frappe.db.exists('E Invoice', {'invoice': invoice.name}):
+			# already created by an earlier run
+			done += 1
+			continue
 
-	print('Creating E-Invoices...')
-	for invoice in draft_einvoices + recent_einvoices:
+		frappe.db.savepoint('create_einvoice')
 		try:
 			einvoice = frappe.new_doc('E Invoice')
 
@@ -209,8 +240,8 @@ def create_einvoices():
 			einvoice.status = invoice.einvoice_status
 			einvoice.qrcode_path = invoice.qrcode_image
 			einvoice.irn_cancelled = invoice.irn_cancelled
-			einvoice.irn_cancelled_on = invoice.irn_cancel_date
-			einvoice.eway_bill_validity = invoice.eway_bill_validity
+			einvoice.irn_cancel_date = invoice.irn_cancel_date
+			einvoice.ewaybill_validity = invoice.eway_bill_validity
 
 			einvoice.sync_with_sales_invoice()
 
@@ -219,9 +250,39 @@ def create_einvoices():
 			einvoice.save()
 			if invoice.docstatus != 0:
 				einvoice.submit()
+			done += 1
 
 		except Exception:
+			frappe.db.rollback(save_point='create_einvoice')
 			frappe.log_error(title="E-Invoice Creation Failed")
+			failed += 1
+
+	frappe.db.commit()
+	update_backfill_progress(done, failed)
+
+def update_backfill_progress(done, failed):
+	pipeline = frappe.cache().pipeline()
+	progress_key = frappe.cache().make_key(BACKFILL_PROGRESS_KEY)
+	pipeline.hincrby(progress_key, 'done', done)
+	pipeline.hincrby(progress_key, 'failed', failed)
+	pipeline.execute()
+
+	progress = get_backfill_progress()
+	print('E-Invoices created: {done} of {total}, failed: {failed}, {rate} per second'.format(**progress))
+
+def get_backfill_progress():
+	pipeline = frappe.cache().pipeline()
+	pipeline.hgetall(frappe.cache().make_key(BACKFILL_PROGRESS_KEY))
+	progress = pipeline.execute()[0]
+	progress = frappe._dict({frappe.safe_decode(k): frappe.safe_decode(v) for k, v in progress.items()})
+
+	elapsed = time.time() - flt(progress.started_at) if progress.started_at else 0
+	return frappe._dict({
+		'total': cint(progress.total),
+		'done': cint(progress.done),
+		'failed': cint(progress.failed),
+		'rate': flt(cint(progress.done) / elapsed, 2) if elapsed else 0
+	})
 
 def before_test():
 	from frappe.test_runner import make_test_records_for_doctype
@@ -15,8 +15,18 @@ before_tests = [
 ]
 after_install = "erpnext_gst_compliance.erpnext_gst_compliance.setup.setup"
 
+jenv = {
+	"methods": [
+		"get_einvoice_qrcode:erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice.e_invoice.get_einvoice_qrcode"
+	]
+}
+
 doctype_js = {
-	"Sales Invoice": "public/js/sales_invoice.js"
+	"Sales Invoice": ["public/js/eway_bill.js", "public/js/sales_invoice.js"]
+}
+
+doctype_list_js = {
+	"Sales Invoice": ["public/js/eway_bill.js", "public/js/sales_invoice_list.js"]
 }
 
 doc_events = {
@@ -35,6 +45,31 @@ doc_events = {
 	"Company": {
 		"after_insert": "erpnext_gst_compliance.erpnext_gst_compliance.setup.on_company_update",
 		"on_update": "erpnext_gst_compliance.erpnext_gst_compliance.setup.on_company_update"
+	},
+	"GST Settings": {
+		"on_update": "erpnext_gst_compliance.utils.clear_gst_account_types_cache"
+	},
+	"Account": {
+		"on_update": "erpnext_gst_compliance.utils.clear_gst_account_types_cache",
+		"on_trash": "erpnext_gst_compliance.utils.clear_gst_account_types_cache",
+		"after_rename": "erpnext_gst_compliance.utils.clear_gst_account_types_cache"
+	}
+}
+
+scheduler_events = {
+	"all": [
+		"erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log.flush_request_logs"
+	],
+	"hourly": [
+		"erpnext_gst_compliance.adequare_integration.adequare_connector.refresh_auth_token"
+	],
+	"daily_long": [
+		"erpnext_gst_compliance.erpnext_gst_compliance.doctype.e_invoice_request_log.e_invoice_request_log.archive_request_logs"
+	],
+	"cron": {
+		"*/10 * * * *": [
+			"erpnext_gst_compliance.erpnext_gst_compliance.e_invoicing_controller.reconcile_pending_irns"
+		]
 	}
 }
 
@@ -0,0 +1,112 @@
+import time
+import random
+import requests
+from frappe.utils import cint, flt
+from urllib.parse import urlparse
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from erpnext_gst_compliance import serializer
+
+# throttled, or the gateway / service provider is temporarily unavailable
+TRANSIENT_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+BASE_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 8
+
+# keep-alive sessions of this worker process, keyed on (scheme, host, pool size)
+sessions = {}
+
+def get_session(url, pool_size=10):
+	'''Returns a session with a connection pool for the host of the url, reused across requests'''
+	parsed_url = urlparse(url)
+	key = (parsed_url.scheme, parsed_url.netloc, pool_size)
+
+	session = sessions.get(key)
+	if not session:
+		session = requests.Session()
+		# sessions are shared by all sites of the worker, so cookies must not be persisted
+		session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+		session.mount('{}://{}'.format(parsed_url.scheme, parsed_url.netloc), adapter)
+		sessions[key] = session
+
+	return session
+
+def make_request(method, url, headers=None, data=None, pool_size=10, timeout=None, keep_alive=True,
+	max_retries=0, retry_budget=None, rate_limiter=None):
+	'''Makes the request & returns the parsed json response
+
+	Transient failures are retried up to `max_retries` times with exponential backoff & jitter,
+	as long as the retries end within `retry_budget` seconds from the first attempt.
+	Every attempt sends the same headers & body, so request ids are not regenerated on retries.'''
+	session = get_session(url, pool_size)
+
+	headers = dict(headers or {})
+	if not keep_alive:
+		headers['Connection'] = 'close'
+
+	start = time.monotonic()
+	attempt = 0
+	while True:
+		if rate_limiter:
+			rate_limiter.acquire()
+
+		try:
+			response = session.request(method, url, headers=headers, data=data, timeout=timeout)
+			response.raise_for_status()
+			return serializer.loads(response.content)
+		except Exception as e:
+			if attempt >= max_retries or not is_transient_error(e):
+				raise
+
+			delay = get_retry_delay(attempt, e)
+			if retry_budget is not None and time.monotonic() - start + delay > retry_budget:
+				raise
+
+		attempt += 1
+		time.sleep(delay)
+
+def is_transient_error(exc):
+	'''Returns True if the request may succeed when retried as is'''
+	if isinstance(exc, requests.exceptions.SSLError):
+		# certificate errors won't resolve on retrying
+		return False
+
+	if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+		return True
+
+	if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+		return exc.response.status_code in TRANSIENT_STATUS_CODES
+
+	return False
+
+def get_retry_delay(attempt, exc=None):
+	'''Returns seconds to wait before the next attempt, exponential with full jitter'''
+	delay = random.uniform(0, min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * 2 ** attempt))
+
+	response = getattr(exc, 'response', None)
+	retry_after = response.headers.get('Retry-After') if response is not None else None
+	if retry_after and retry_after.isdigit():
+		delay = max(delay, min(int(retry_after), MAX_RETRY_DELAY))
+
+	return delay
+
+def get_connection_settings(settings, retry=True):
+	'''Returns request options from the connection settings of a service provider
+
+	Requests that are not safe to repeat, i.e. whose duplicates the service provider doesn't resolve,
+	must pass `retry=False` so that they are sent only once'''
+	# settings saved before these fields were added have them unset
+	reuse_connections = settings.reuse_connections
+	keep_alive = cint(reuse_connections) if reuse_connections is not None else 1
+	max_retries = settings.max_retries
+	max_retries = cint(max_retries) if max_retries is not None else 3
+	if not retry:
+		max_retries = 0
+
+	return {
+		'pool_size': cint(settings.connection_pool_size) or 10,
+		'timeout': (flt(settings.connect_timeout) or 5, flt(settings.read_timeout) or 60),
+		'keep_alive': bool(keep_alive),
+		'max_retries': max_retries,
+		'retry_budget': flt(settings.retry_budget) or 30
+	}
@@ -0,0 +1,502 @@
+'''Local stand-in for the Adequare & Cleartax e-invoicing APIs
+
+Serves the endpoints used by the connectors with realistic IRN, duplicate IRN (2150),
+already cancelled (9999) & error payloads, with configurable latency, error rate & rate limit.
+Point the connectors to it by setting the host override in site_config.json:
+
+	"einvoice_gsp_host_override": "http://127.0.0.1:8800"
+
+and run it with:
+
+	python -m erpnext_gst_compliance.mock_gsp_server --port 8800 --latency 0.3 --error-rate 0.05 --rate-limit 20
+
+Request counts & latencies served so far are available at /__stats & are reset with /__reset.
+'''
+
+import json
+import time
+import random
+import base64
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ADEQUARE_PREFIX = '/enriched/ei/api'
+CLEARTAX_PREFIX = '/v2/eInvoice'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class MockGSP:
+	'''State & fault configuration of the mock server, shared by all request handler threads'''
+
+	def __init__(self, latency=0, jitter=0, error_rate=0, rate_limit=0, seed=None):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		# max requests per second per gstin, 0 to disable
+		self.rate_limit = rate_limit
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			# irn -> details of generated e-invoices
+			self.irns = {}
+			# (gstin, document type, document no) -> irn
+			self.documents = {}
+			# gstin -> (window start, request count)
+			self.rate_windows = {}
+			self.ack_no = 112110000000000
+			self.ewaybill_no = 321000000000
+			self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'latency': 0.0, 'paths': {}}
+			# (path, requestid header) of every request, to check the request ids reused on retries
+			self.request_ids = []
+			self.failures_to_inject = 0
+			# irns whose details are no longer served, as for irns generated more than 2 days ago
+			self.expired_irns = set()
+
+	def simulate_latency(self):
+		delay = self.latency + self.random.uniform(0, self.jitter) if self.jitter else self.latency
+		if delay > 0:
+			time.sleep(delay)
+
+	def fail_next_requests(self, count):
+		'''Fails the next `count` requests with a server error, irrespective of the error rate'''
+		with self.lock:
+			self.failures_to_inject = count
+
+	def expire_irn_details(self, irn):
+		'''Stops serving the details of the irn, duplicate generation requests still report it'''
+		with self.lock:
+			self.expired_irns.add(irn)
+
+	def should_fail(self):
+		with self.lock:
+			if self.failures_to_inject:
+				self.failures_to_inject -= 1
+				return True
+
+			return self.error_rate and self.random.random() < self.error_rate
+
+	def is_rate_limited(self, gstin):
+		if not self.rate_limit:
+			return False
+
+		with self.lock:
+			now = time.monotonic()
+			window_start, count = self.rate_windows.get(gstin, (now, 0))
+			if now - window_start >= 1:
+				window_start, count = now, 0
+
+			self.rate_windows[gstin] = (window_start, count + 1)
+			return count >= self.rate_limit
+
+	def record(self, path, duration, status):
+		with self.lock:
+			self.stats['requests'] += 1
+			self.stats['latency'] += duration
+			self.stats['paths'][path] = self.stats['paths'].get(path, 0) + 1
+			if status == 429:
+				self.stats['rate_limited'] += 1
+			elif status >= 400:
+				self.stats['errors'] += 1
+
+	def get_stats(self):
+		with self.lock:
+			stats = json.loads(json.dumps(self.stats))
+
+		stats['average_latency'] = stats['latency'] / stats['requests'] if stats['requests'] else 0
+		return stats
+
+	def generate_irn(self, gstin, einvoice):
+		'''Returns (irn details, is duplicate) for the e-invoice payload'''
+		doc_details = einvoice.get('DocDtls') or {}
+		document_key = (gstin, doc_details.get('Typ'), doc_details.get('No'))
+
+		with self.lock:
+			irn = self.documents.get(document_key)
+			if irn:
+				return self.irns[irn], True
+
+			irn = hashlib.sha256('|'.join(str(d) for d in document_key).encode()).hexdigest()
+			self.ack_no += 1
+			ack_date = datetime.now().strftime(DATETIME_FORMAT)
+			item_count = len(einvoice.get('ItemList') or [])
+
+			details = {
+				'AckNo': self.ack_no,
+				'AckDt': ack_date,
+				'Irn': irn,
+				'SignedInvoice': get_signed_token({'Irn': irn, 'AckNo': self.ack_no, 'AckDt': ack_date}),
+				'SignedQRCode': get_signed_token({
+					'SellerGstin': gstin,
+					'BuyerGstin': (einvoice.get('BuyerDtls') or {}).get('Gstin'),
+					'DocNo': doc_details.get('No'),
+					'DocTyp': doc_details.get('Typ'),
+					'DocDt': doc_details.get('Dt'),
+					'TotInvVal': (einvoice.get('ValDtls') or {}).get('TotInvVal'),
+					'ItemCnt': item_count,
+					'Irn': irn,
+					'IrnDt': ack_date
+				}),
+				'Status': 'ACT',
+				'EwbNo': None,
+				'EwbDt': None,
+				'EwbValidTill': None,
+				'Remarks': None
+			}
+			self.irns[irn] = details
+			self.documents[document_key] = irn
+
+			return details, False
+
+	def cancel_irn(self, irn):
+		'''Returns (cancellation details, error code)'''
+		with self.lock:
+			details = self.irns.get(irn)
+			if not details:
+				return None, '2140'
+
+			if details['Status'] == 'CNL':
+				return None, '9999'
+
+			details['Status'] = 'CNL'
+			details['CancelDate'] = datetime.now().strftime(DATETIME_FORMAT)
+
+			return {'Irn': irn, 'CancelDate': details['CancelDate']}, None
+
+	def generate_ewaybill(self, irn):
+		with self.lock:
+			details = self.irns.get(irn)
+			if not details or details['Status'] != 'ACT':
+				return None
+
+			self.ewaybill_no += 1
+			now = datetime.now()
+			details.update({
+				'EwbNo': self.ewaybill_no,
+				'EwbDt': now.strftime(DATETIME_FORMAT),
+				'EwbValidTill': (now + timedelta(days=1)).strftime(DATETIME_FORMAT)
+			})
+
+			return {key: details[key] for key in ['EwbNo', 'EwbDt', 'EwbValidTill']}
+
+	def cancel_ewaybill(self, ewaybill_no):
+		with self.lock:
+			for details in self.irns.values():
+				if details.get('EwbNo') and str(details['EwbNo']) == str(ewaybill_no):
+					details['EwbNo'] = None
+					return {'ewayBillNo': ewaybill_no, 'cancelDate': datetime.now().strftime(DATETIME_FORMAT)}
+
+class MockGSPRequestHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	@property
+	def gsp(self):
+		return self.server.gsp
+
+	def do_GET(self):
+		self.handle_request('GET')
+
+	def do_POST(self):
+		self.handle_request('POST')
+
+	def do_PUT(self):
+		self.handle_request('PUT')
+
+	def handle_request(self, method):
+		start = time.monotonic()
+		url = urlparse(self.path)
+		# adequare sandbox urls are prefixed with /test
+		path = url.path[len('/test'):] if url.path.startswith('/test/') else url.path
+		payload = self.read_payload()
+
+		if path == '/__stats':
+			return self.send_json(200, self.gsp.get_stats())
+		if path == '/__reset':
+			self.gsp.reset()
+			return self.send_json(200, {'success': True})
+
+		self.gsp.simulate_latency()
+		gstin = self.headers.get('gstin') or ''
+		with self.gsp.lock:
+			self.gsp.request_ids.append((path, self.headers.get('requestid')))
+
+		if self.gsp.is_rate_limited(gstin):
+			status, response = 429, {'success': False, 'message': 'Too many requests'}
+		elif self.gsp.should_fail():
+			status, response = self.gsp.random.choice([500, 502, 503]), {'success': False, 'message': 'Service unavailable'}
+		else:
+			status, response = self.route(method, path, parse_qs(url.query), gstin, payload)
+
+		self.gsp.record(path, time.monotonic() - start, status)
+		self.send_json(status, response)
+
+	def route(self, method, path, query, gstin, payload):
+		routes = {
+			('POST', '/gsp/authenticate'): self.adequare_authenticate,
+			('POST', ADEQUARE_PREFIX + '/invoice'): self.adequare_generate_irn,
+			('GET', ADEQUARE_PREFIX + '/invoice/irn'): self.adequare_irn_details,
+			('GET', ADEQUARE_PREFIX + '/invoice/irnbydocdetails'): self.adequare_irn_by_doc_details,
+			('POST', ADEQUARE_PREFIX + '/invoice/cancel'): self.adequare_cancel_irn,
+			('POST', ADEQUARE_PREFIX + '/ewaybill'): self.adequare_generate_ewaybill,
+			('POST', ADEQUARE_PREFIX + '/ewayapi'): self.adequare_cancel_ewaybill,
+			('PUT', CLEARTAX_PREFIX + '/generate'): self.cleartax_generate_irn,
+			('GET', CLEARTAX_PREFIX + '/get'): self.cleartax_irn_details,
+			('PUT', CLEARTAX_PREFIX + '/cancel'): self.cleartax_cancel_irn,
+			('POST', CLEARTAX_PREFIX + '/ewaybill'): self.cleartax_generate_ewaybill,
+			('POST', CLEARTAX_PREFIX + '/ewaybill/cancel'): self.cleartax_cancel_ewaybill
+		}
+		handler = routes.get((method, path))
+		if not handler:
+			return 404, {'success': False, 'message': 'Not found'}
+
+		return 200, handler(gstin, payload, query)
+
+	def adequare_authenticate(self, gstin, payload, query):
+		if not self.headers.get('gspappid') or not self.headers.get('gspappsecret'):
+			return {'error': 'invalid_client', 'error_description': 'Bad client credentials'}
+
+		return {
+			'access_token': get_signed_token({'scope': ['gsp'], 'iat': int(time.time())}),
+			'token_type': 'bearer',
+			'expires_in': 2591999,
+			'scope': 'gsp',
+			'jti': hashlib.md5(str(time.time()).encode()).hexdigest()
+		}
+
+	def adequare_generate_irn(self, gstin, payload, query):
+		if not payload or not payload.get('DocDtls'):
+			return {'success': False, 'message': '5002 : Data Validation Failed'}
+
+		details, is_duplicate = self.gsp.generate_irn(gstin, payload)
+		if is_duplicate:
+			return {
+				'success': False,
+				'message': '2150 : Duplicate IRN',
+				'result': [{
+					'InfCd': 'DUPIRN',
+					'Desc': {key: details[key] for key in ['AckNo', 'AckDt', 'Irn']}
+				}]
+			}
+
+		return {'success': True, 'message': 'IRN generated successfully', 'result': details}
+
+	def adequare_irn_details(self, gstin, payload, query):
+		irn = (query.get('irn') or [''])[0]
+		details = self.gsp.irns.get(irn)
+		if not details or irn in self.gsp.expired_irns:
+			return {'success': False, 'message': '2283 : IRN details cannot be provided as it is generated more than 2 days prior'}
+
+		return {'success': True, 'message': 'IRN details fetched successfully', 'result': details}
+
+	def adequare_irn_by_doc_details(self, gstin, payload, query):
+		document_key = (gstin, (query.get('doctype') or [''])[0], (query.get('docnum') or [''])[0])
+		with self.gsp.lock:
+			irn = self.gsp.documents.get(document_key)
+
+		details = self.gsp.irns.get(irn)
+		if not details:
+			return {'success': False, 'message': '2148 : Requested IRN data is not available'}
+
+		return {'success': True, 'message': 'IRN details fetched successfully', 'result': details}
+
+	def adequare_cancel_irn(self, gstin, payload, query):
+		details, error_code = self.gsp.cancel_irn((payload or {}).get('Irn'))
+		if error_code == '9999':
+			return {'success': False, 'message': '9999 : Invoice is not active'}
+		if error_code:
+			return {'success': False, 'message': '2140 : The IRN is invalid'}
+
+		return {'success': True, 'message': 'E-Invoice is cancelled successfully', 'result': details}
+
+	def adequare_generate_ewaybill(self, gstin, payload, query):
+		details = self.gsp.generate_ewaybill((payload or {}).get('Irn'))
+		if not details:
+			return {'success': False, 'message': '4002 : EwayBill is already generated for this IRN or IRN is not active'}
+
+		return {'success': True, 'message': 'E-Way Bill generated successfully', 'result': details}
+
+	def adequare_cancel_ewaybill(self, gstin, payload, query):
+		details = self.gsp.cancel_ewaybill((payload or {}).get('ewbNo'))
+		if not details:
+			return {'success': False, 'message': '312 : This eway bill is either not generated by you or cancelled'}
+
+		return {'success': True, 'message': 'E-Way bill cancelled successfully', 'result': details}
+
+	def cleartax_generate_irn(self, gstin, payload, query):
+		response = []
+		for entry in payload or []:
+			einvoice = entry.get('transaction') or {}
+			if not einvoice.get('DocDtls'):
+				response.append(dict(get_cleartax_error(gstin, 'IRN_GENERATION_FAILED', '5002', 'Data Validation Failed'),
+					transaction=einvoice))
+				continue
+
+			details, is_duplicate = self.gsp.generate_irn(gstin, einvoice)
+			if is_duplicate:
+				error = get_cleartax_error(gstin, 'IRN_GENERATION_FAILED', '2150', 'Duplicate IRN')
+				error['govt_response']['InfoDtls'] = [{
+					'InfCd': 'DUPIRN',
+					'Desc': {key: details[key] for key in ['AckNo', 'AckDt', 'Irn']}
+				}]
+				response.append(dict(error, transaction=einvoice))
+				continue
+
+			govt_response = dict(details, Success='Y')
+			# the transaction sent is returned with its response
+			response.append({'document_status': 'IRN_GENERATED', 'govt_response': govt_response,
+				'transaction': einvoice, 'gstin': gstin, 'owner_id': None})
+
+		return response
+
+	def cleartax_irn_details(self, gstin, payload, query):
+		irn = (query.get('irn') or [''])[0]
+		details = self.gsp.irns.get(irn)
+		if not details:
+			return get_cleartax_error(gstin, 'IRN_NOT_FOUND', '2283',
+				'IRN details cannot be provided as it is generated more than 2 days prior')
+
+		return {'document_status': 'IRN_GENERATED', 'govt_response': dict(details, Success='Y'),
+			'gstin': gstin, 'owner_id': None}
+
+	def cleartax_cancel_irn(self, gstin, payload, query):
+		response = []
+		for entry in payload or []:
+			details, error_code = self.gsp.cancel_irn(entry.get('irn'))
+			if error_code == '9999':
+				response.append(get_cleartax_error(gstin, 'IRN_CANCELLATION_FAILED', '9999', 'Invoice is not active'))
+			elif error_code:
+				response.append(get_cleartax_error(gstin, 'IRN_CANCELLATION_FAILED', '2140', 'The IRN is invalid'))
+			else:
+				response.append({'document_status': 'IRN_CANCELLED', 'govt_response': dict(details, Success='Y'),
+					'gstin': gstin, 'owner_id': None})
+
+		return response
+
+	def cleartax_generate_ewaybill(self, gstin, payload, query):
+		response = []
+		for entry in payload or []:
+			details = self.gsp.generate_ewaybill(entry.get('Irn'))
+			if not details:
+				response.append(dict(get_cleartax_error(gstin, 'EWB_GENERATION_FAILED', '4002',
+					'EwayBill is already generated for this IRN or IRN is not active'), irn=entry.get('Irn')))
+			else:
+				response.append({'ewb_status': 'GENERATED', 'govt_response': dict(details, Success='Y'),
+					'irn': entry.get('Irn'), 'gstin': gstin, 'owner_id': None})
+
+		return response
+
+	def cleartax_cancel_ewaybill(self, gstin, payload, query):
+		details = self.gsp.cancel_ewaybill((payload or {}).get('ewbNo'))
+		if not details:
+			return [get_cleartax_error(gstin, 'EWB_CANCELLATION_FAILED', '312',
+				'This eway bill is either not generated by you or cancelled')]
+
+		return [{'ewb_status': 'CANCELLED', 'govt_response': dict(details, Success='Y'),
+			'gstin': gstin, 'owner_id': None}]
+
+	def read_payload(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		if not length:
+			return None
+
+		try:
+			return json.loads(self.rfile.read(length))
+		except ValueError:
+			return None
+
+	def send_json(self, status, response):
+		body = json.dumps(response).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		if status == 429:
+			self.send_header('Retry-After', '1')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		if self.server.verbose:
+			super().log_message(format, *args)
+
+def get_cleartax_error(gstin, document_status, error_code, error_message):
+	return {
+		'document_status': document_status,
+		'govt_response': {
+			'Success': 'N',
+			'ErrorDetails': [{
+				'error_code': error_code,
+				'error_message': error_message,
+				'error_source': 'NIC'
+			}]
+		},
+		'gstin': gstin,
+		'owner_id': None
+	}
+
+def get_signed_token(data):
+	'''Returns a JWT shaped string, signature is random since nobody verifies it'''
+	def encode(value):
+		return base64.urlsafe_b64encode(value).rstrip(b'=').decode()
+
+	header = encode(json.dumps({'alg': 'RS256', 'typ': 'JWT'}).encode())
+	payload = encode(json.dumps({'data': json.dumps(data), 'iss': 'NIC'}).encode())
+	signature = encode(random.getrandbits(2048).to_bytes(256, 'big'))
+
+	return '.'.join([header, payload, signature])
+
+def make_server(host='127.0.0.1', port=0, verbose=False, **config):
+	server = ThreadingHTTPServer((host, port), MockGSPRequestHandler)
+	server.daemon_threads = True
+	server.gsp = MockGSP(**config)
+	server.verbose = verbose
+	server.url = 'http://{}:{}'.format(*server.server_address[:2])
+
+	return server
+
+def start_server(host='127.0.0.1', port=0, verbose=False, **config):
+	'''Starts the mock server in a daemon thread & returns it, `server.url` is the host override to use'''
+	server = make_server(host, port, verbose, **config)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+
+	return server
+
+@contextmanager
+def running_server(**config):
+	'''Runs the mock server for the duration of the block, e.g. in tests'''
+	server = start_server(**config)
+	try:
+		yield server
+	finally:
+		server.shutdown()
+		server.server_close()
+
+def main():
+	parser = argparse.ArgumentParser(description='Local stand-in for the Adequare & Cleartax e-invoicing APIs')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8800)
+	parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+	parser.add_argument('--jitter', type=float, default=0, help='max random seconds added over the latency')
+	parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with 5xx')
+	parser.add_argument('--rate-limit', type=int, default=0, help='max requests per second per gstin')
+	parser.add_argument('--seed', type=int, help='seed for reproducible latency & errors')
+	parser.add_argument('--verbose', action='store_true', help='log every request')
+	args = parser.parse_args()
+
+	server = make_server(args.host, args.port, args.verbose, latency=args.latency, jitter=args.jitter,
+		error_rate=args.error_rate, rate_limit=args.rate_limit, seed=args.seed)
+
+	print('Mock GSP server listening on {}'.format(server.url))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.server_close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,4 @@
+from erpnext_gst_compliance.erpnext_gst_compliance.setup import add_einvoice_indexes
+
+def execute():
+	add_einvoice_indexes()
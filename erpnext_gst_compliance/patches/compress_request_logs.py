@@ -0,0 +1,26 @@
+import frappe
+from erpnext_gst_compliance import serializer
+
+BATCH_SIZE = 1000
+
+def execute():
+	'''Compresses the data & response of the existing request logs, in batches'''
+	last_name = ''
+	while True:
+		request_logs = frappe.db.sql("""
+			select name, data, response from `tabE Invoice Request Log`
+			where name > %s order by name limit %s
+		""", (last_name, BATCH_SIZE), as_dict=1)
+
+		if not request_logs:
+			break
+
+		for log in request_logs:
+			data, response = serializer.compress(log.data), serializer.compress(log.response)
+			if data != log.data or response != log.response:
+				frappe.db.sql("""
+					update `tabE Invoice Request Log` set data = %s, response = %s where name = %s
+				""", (data, response, log.name))
+
+		last_name = request_logs[-1].name
+		frappe.db.commit()
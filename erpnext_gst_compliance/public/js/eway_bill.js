@@ -0,0 +1,64 @@
+frappe.provide('erpnext_gst_compliance');
+
+// transport details of the e-way bill dialogs, in the sales invoice form & list view
+erpnext_gst_compliance.get_eway_bill_fields = () => {
+	return [
+		{
+			'fieldname': 'transporter',
+			'label': 'Transporter',
+			'fieldtype': 'Link',
+			'options': 'Supplier'
+		},
+		{
+			'fieldname': 'transporter_gstin',
+			'label': 'GST Transporter ID',
+			'fieldtype': 'Data',
+			'fetch_from': 'transporter.gst_transporter_id'
+		},
+		{
+			'fieldname': 'transport_document_no',
+			'label': 'Transport Receipt No',
+			'fieldtype': 'Data'
+		},
+		{
+			'fieldname': 'vehicle_no',
+			'label': 'Vehicle No',
+			'fieldtype': 'Data'
+		},
+		{
+			'fieldname': 'distance',
+			'label': 'Distance (in km)',
+			'fieldtype': 'Float'
+		},
+		{
+			'fieldname': 'transporter_col_break',
+			'fieldtype': 'Column Break',
+		},
+		{
+			'fieldname': 'transporter_name',
+			'label': 'Transporter Name',
+			'fieldtype': 'Data',
+			'fetch_from': 'transporter.name'
+		},
+		{
+			'fieldname': 'mode_of_transport',
+			'label': 'Mode of Transport',
+			'fieldtype': 'Select',
+			'options': `\nRoad\nAir\nRail\nShip`
+		},
+		{
+			'fieldname': 'transport_document_date',
+			'label': 'Transport Receipt Date',
+			'fieldtype': 'Date',
+			'mandatory_depends_on': 'eval: doc.mode_of_transport == "Road"'
+		},
+		{
+			'fieldname': 'vehicle_type',
+			'label': 'GST Vehicle Type',
+			'fieldtype': 'Select',
+			'options': `\nRegular\nOver Dimensional Cargo (ODC)`,
+			'depends_on': 'eval:(doc.mode_of_transport === "Road")',
+			'default': ''
+		}
+	];
+};
@@ -1,4 +1,11 @@
 frappe.ui.form.on('Sales Invoice', {
+	setup(frm) {
+		frappe.realtime.on('einvoicing_request_progress', (request) => {
+			if (request.sales_invoice !== frm.doc.name) return;
+			show_request_progress(frm, request);
+		});
+	},
+
 	async refresh(frm) {
 		if (frm.is_dirty()) return;
 
@@ -25,7 +32,7 @@ frappe.ui.form.on('Sales Invoice', {
 				frappe.call({
 					method: e_invoicing_controller + '.generate_irn',
 					args: { sales_invoice: frm.doc },
-					callback: () => frm.reload_doc(),
+					callback: (r) => handle_einvoicing_response(frm, r),
 					error: () => frm.reload_doc(),
 					freeze: true
 				});
@@ -52,8 +59,8 @@ frappe.ui.form.on('Sales Invoice', {
 								remark: data.remark
 							},
 							freeze: true,
-							callback: () => {
-								frm.reload_doc();
+							callback: (r) => {
+								handle_einvoicing_response(frm, r);
 								d.hide();
 							},
 							error: () => d.hide()
@@ -72,7 +79,7 @@ frappe.ui.form.on('Sales Invoice', {
 				const d = new frappe.ui.Dialog({
 					title: __('Generate E-Way Bill'),
 					size: "large",
-					fields: get_eway_bill_fields(frm),
+					fields: erpnext_gst_compliance.get_eway_bill_fields(),
 					primary_action: function() {
 						const data = d.get_values();
 						frappe.call({
@@ -178,6 +185,54 @@ const get_einvoice_eligibility = async (doc) => {
 	return invoice_eligible;
 }
 
+const handle_einvoicing_response = (frm, r) => {
+	const request = r && r.message;
+	if (request && request.request_id) {
+		// request is queued, track it until it is processed
+		track_request(frm, request.request_id);
+	}
+	frm.reload_doc();
+}
+
+const track_request = (frm, request_id) => {
+	// realtime updates are preferred, polling is a fallback when socketio is unavailable
+	const poll = setInterval(async () => {
+		const { message: request } = await frappe.call({
+			method: 'erpnext_gst_compliance.erpnext_gst_compliance.e_invoicing_controller.get_request_status',
+			args: { request_id }
+		});
+		if (!request || ['Completed', 'Failed'].includes(request.status)) {
+			clearInterval(poll);
+		}
+		if (request) show_request_progress(frm, request);
+	}, 3000);
+}
+
+const show_request_progress = (frm, request) => {
+	frm.processed_einvoicing_requests = frm.processed_einvoicing_requests || [];
+	if (frm.processed_einvoicing_requests.includes(request.request_id)) return;
+
+	if (request.status == 'Completed') {
+		frm.processed_einvoicing_requests.push(request.request_id);
+		frappe.show_alert({ message: __('E-Invoicing Request Completed.'), indicator: 'green' });
+		frm.reload_doc();
+	} else if (request.status == 'Failed') {
+		frm.processed_einvoicing_requests.push(request.request_id);
+		frappe.msgprint({
+			title: __('E-Invoicing Request Failed'),
+			message: (request.errors || []).join('<br>'),
+			indicator: 'red'
+		});
+		frm.reload_doc();
+	} else {
+		const progress = request.progress || __(request.status);
+		if (frm.einvoicing_request_progress == progress) return;
+
+		frm.einvoicing_request_progress = progress;
+		frappe.show_alert({ message: progress, indicator: 'blue' });
+	}
+}
+
 const get_irn_cancellation_fields = () => {
 	return [
 		{
@@ -202,66 +257,4 @@ const raise_form_is_dirty_error = () => {
 		message: __('You must save the document before making e-invoicing request.'),
 		title: __('Unsaved Document')
 	});
-}
-
-const get_eway_bill_fields = () => {
-	return [
-		{
-			'fieldname': 'transporter',
-			'label': 'Transporter',
-			'fieldtype': 'Link',
-			'options': 'Supplier'
-		},
-		{
-			'fieldname': 'transporter_gstin',
-			'label': 'GST Transporter ID',
-			'fieldtype': 'Data',
-			'fetch_from': 'transporter.gst_transporter_id'
-		},
-		{
-			'fieldname': 'transport_document_no',
-			'label': 'Transport Receipt No',
-			'fieldtype': 'Data'
-		},
-		{
-			'fieldname': 'vehicle_no',
-			'label': 'Vehicle No',
-			'fieldtype': 'Data'
-		},
-		{
-			'fieldname': 'distance',
-			'label': 'Distance (in km)',
-			'fieldtype': 'Float'
-		},
-		{
-			'fieldname': 'transporter_col_break',
-			'fieldtype': 'Column Break',
-		},
-		{
-			'fieldname': 'transporter_name',
-			'label': 'Transporter Name',
-			'fieldtype': 'Data',
-			'fetch_from': 'transporter.name'
-		},
-		{
-			'fieldname': 'mode_of_transport',
-			'label': 'Mode of Transport',
-			'fieldtype': 'Select',
-			'options': `\nRoad\nAir\nRail\nShip`
-		},
-		{
-			'fieldname': 'transport_document_date',
-			'label': 'Transport Receipt Date',
-			'fieldtype': 'Date',
-			'mandatory_depends_on': 'eval: doc.mode_of_transport == "Road"'
-		},
-		{
-			'fieldname': 'vehicle_type',
-			'label': 'GST Vehicle Type',
-			'fieldtype': 'Select',
-			'options': `\nRegular\nOver Dimensional Cargo (ODC)`,
-			'depends_on': 'eval:(doc.mode_of_transport === "Road")',
-			'default': ''
-		}
-	];
-};
\ No newline at end of file
+}
\ No newline at end of file
@@ -0,0 +1,106 @@
+// extends the list view settings of erpnext
+frappe.listview_settings['Sales Invoice'] = frappe.listview_settings['Sales Invoice'] || {};
+const erpnext_sales_invoice_onload = frappe.listview_settings['Sales Invoice'].onload;
+
+frappe.listview_settings['Sales Invoice'].onload = function(listview) {
+	erpnext_sales_invoice_onload && erpnext_sales_invoice_onload(listview);
+
+	listview.page.add_actions_menu_item(__('Generate E-Way Bills'), () => {
+		const sales_invoices = listview.get_checked_items(true);
+		if (!sales_invoices.length) {
+			frappe.throw(__('Please select the Sales Invoices to generate e-way bills for.'));
+		}
+
+		const d = new frappe.ui.Dialog({
+			title: __('Generate E-Way Bills for {0} Sales Invoices', [sales_invoices.length]),
+			size: "large",
+			fields: erpnext_gst_compliance.get_eway_bill_fields(),
+			primary_action: function() {
+				const data = d.get_values();
+				frappe.call({
+					method: 'erpnext_gst_compliance.erpnext_gst_compliance.e_invoicing_controller.generate_eway_bill_bulk',
+					args: {
+						sales_invoices: sales_invoices,
+						...data
+					},
+					freeze: true,
+					freeze_message: __('Generating E-Way Bills'),
+					callback: (r) => {
+						d.hide();
+						const request = r.message || {};
+						if (request.request_id) {
+							// large batches are processed in background
+							track_bulk_request(listview, request.request_id);
+							return;
+						}
+						listview.refresh();
+						show_eway_bill_errors(request);
+					},
+					error: () => d.hide()
+				});
+			},
+			primary_action_label: __('Submit')
+		});
+		d.show();
+	}, false);
+};
+
+const track_bulk_request = (listview, request_id) => {
+	let processed = false;
+	const on_progress = (request) => {
+		if (processed || !request || request.request_id !== request_id) return;
+
+		if (request.status == 'Completed') {
+			processed = true;
+			listview.refresh();
+			const results = request.results || {};
+			const generated = Object.keys(results).filter(name => results[name].success).length;
+			frappe.show_alert({
+				message: __('E-Way Bill Generated for {0} of {1} Sales Invoices.', [generated, Object.keys(results).length]),
+				indicator: 'green'
+			});
+			show_eway_bill_errors(results);
+		} else if (request.status == 'Failed') {
+			processed = true;
+			frappe.msgprint({
+				title: __('E-Way Bill Generation Failed'),
+				message: (request.errors || []).join('<br>'),
+				indicator: 'red'
+			});
+		}
+	};
+
+	frappe.realtime.on('einvoicing_request_progress', on_progress);
+	// realtime updates are preferred, polling is a fallback when socketio is unavailable
+	const poll = setInterval(async () => {
+		const { message: request } = await frappe.call({
+			method: 'erpnext_gst_compliance.erpnext_gst_compliance.e_invoicing_controller.get_request_status',
+			args: { request_id }
+		});
+		on_progress(request);
+		if (processed || !request) {
+			clearInterval(poll);
+			frappe.realtime.off('einvoicing_request_progress', on_progress);
+		}
+	}, 5000);
+};
+
+const show_eway_bill_errors = (results) => {
+	const failed = Object.keys(results).filter(name => !results[name].success);
+	if (!failed.length) return;
+
+	const rows = failed.map(name => `<tr>
+		<td>${frappe.utils.get_form_link('Sales Invoice', name, true)}</td>
+		<td>${results[name].errors.map(e => frappe.utils.escape_html(e)).join('<br>')}</td>
+	</tr>`);
+
+	frappe.msgprint({
+		title: __('E-Way Bill Generation Failed for {0} Sales Invoices', [failed.length]),
+		message: `<table class="table table-bordered">
+			<thead><tr><th>${__('Sales Invoice')}</th><th>${__('Errors')}</th></tr></thead>
+			<tbody>${rows.join('')}</tbody>
+		</table>`,
+		indicator: 'red',
+		wide: true
+	});
+};
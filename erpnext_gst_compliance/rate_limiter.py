@@ -0,0 +1,92 @@
+import time
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+
+DEFAULT_REQUESTS_PER_SECOND = 5
+DEFAULT_BURST_SIZE = 10
+DEFAULT_MAX_WAIT = 60
+
+# token bucket, refilled at rate per second up to burst tokens
+# a token is reserved even if it is not available yet, so that waiting requests are served in order
+# returns {acquired, seconds to wait before making the request}
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens < 1 then
+	wait = (1 - tokens) / rate
+end
+
+if wait > max_wait then
+	return {0, tostring(wait)}
+end
+
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens - 1), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst + 1) / rate) + math.ceil(max_wait) + 1)
+
+return {1, tostring(wait)}
+'''
+
+class RateLimitExceeded(frappe.ValidationError):
+	pass
+
+class RateLimiter:
+	'''Requests per second limit shared by all workers, per service provider & GSTIN
+
+	GSPs throttle on GSTIN & client id, which is the same for every site using them,
+	so the bucket key is not prefixed with the site name'''
+
+	def __init__(self, provider, gstin, requests_per_second, burst_size, max_wait):
+		self.gstin = gstin
+		self.key = 'einvoicing_rate_limit|{}|{}'.format(frappe.scrub(provider), gstin)
+		self.requests_per_second = requests_per_second
+		self.burst_size = max(burst_size, 1)
+		self.max_wait = max_wait
+		# resolved here, since the limiter may be used from threads without a site context
+		self.cache = frappe.cache()
+
+	@classmethod
+	def from_settings(cls, settings, gstin):
+		return cls(settings.doctype, gstin, **get_rate_limit_settings(settings))
+
+	def acquire(self):
+		'''Waits till a request can be made without exceeding the rate limit'''
+		if not self.requests_per_second:
+			return
+
+		try:
+			acquired, wait = self.cache.eval(TOKEN_BUCKET_SCRIPT, 1, self.key,
+				self.requests_per_second, self.burst_size, time.time(), self.max_wait)
+		except Exception:
+			# redis is unavailable, requests are not limited
+			return
+
+		if not cint(acquired):
+			raise RateLimitExceeded(_('Too many requests for GSTIN {}. Please try again after some time.')
+				.format(self.gstin))
+
+		wait = float(wait)
+		if wait > 0:
+			time.sleep(wait)
+
+def get_rate_limit_settings(settings):
+	'''Returns the rate limit options from the settings of a service provider'''
+	# settings saved before these fields were added have them unset
+	requests_per_second = settings.rate_limit
+	burst_size = settings.rate_limit_burst_size
+	max_wait = settings.rate_limit_max_wait
+
+	return {
+		'requests_per_second': flt(requests_per_second) if requests_per_second is not None else DEFAULT_REQUESTS_PER_SECOND,
+		'burst_size': cint(burst_size) if burst_size is not None else DEFAULT_BURST_SIZE,
+		'max_wait': flt(max_wait) if max_wait is not None else DEFAULT_MAX_WAIT
+	}
@@ -0,0 +1,48 @@
+import json
+import zlib
+import base64
+
+# prefix of the values stored compressed, json never starts with it
+COMPRESSION_MARKER = 'zlib:'
+
+try:
+	# optional, several times faster than json when installed
+	import orjson
+except ImportError:
+	orjson = None
+
+def dumps(value):
+	'''Returns compact json of the value as bytes, to be sent as request body & stored in logs as is'''
+	if orjson:
+		return orjson.dumps(value)
+
+	return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def dumps_str(value):
+	return dumps(value).decode('utf-8')
+
+def loads(value):
+	if orjson:
+		return orjson.loads(value)
+
+	if isinstance(value, (bytes, bytearray)):
+		value = value.decode('utf-8')
+
+	return json.loads(value)
+
+def compress(value):
+	'''Returns the text zlib compressed & base85 encoded with a marker prefix, or as is if that isn't smaller'''
+	if not value or is_compressed(value):
+		return value
+
+	compressed = COMPRESSION_MARKER + base64.b85encode(zlib.compress(value.encode('utf-8'))).decode('ascii')
+	return compressed if len(compressed) < len(value) else value
+
+def decompress(value):
+	if not is_compressed(value):
+		return value
+
+	return zlib.decompress(base64.b85decode(value[len(COMPRESSION_MARKER):])).decode('utf-8')
+
+def is_compressed(value):
+	return isinstance(value, str) and value.startswith(COMPRESSION_MARKER)
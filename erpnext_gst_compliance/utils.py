@@ -3,6 +3,9 @@ import json
 import frappe
 import traceback
 from frappe import _
+from types import MappingProxyType
+from erpnext.regional.india.utils import get_gst_accounts
+from erpnext_gst_compliance.http_pool import is_transient_error
 
 class HandledException(frappe.ValidationError): pass
 
@@ -17,18 +20,23 @@ def log_exception(fn):
 			# exception has been logged
 			# so just continue raising HandledException to stop futher logging
 			raise
-		except Exception:
+		except Exception as e:
 			log_error()
-			show_request_failed_error()
+			show_request_failed_error(transient=is_transient_error(e))
 
 		return return_value
 
 	return wrapper
 
-def show_request_failed_error():
+def show_request_failed_error(transient=False):
 	frappe.clear_messages()
-	message = _('There was an error while making the request.') + ' '
-	message += _('Please try once again and if the issue persists, please contact ERPNext Support.')
+	if transient:
+		# still failing after the retries
+		message = _('The service provider is not responding at the moment.') + ' '
+		message += _('Please try again after some time.')
+	else:
+		message = _('There was an error while making the request.') + ' '
+		message += _('Please try once again and if the issue persists, please contact ERPNext Support.')
 	frappe.throw(message, title=_('Request Failed'), exc=HandledException)
 
 def log_error():
@@ -49,6 +57,35 @@ def log_error():
 	)
 	frappe.db.commit()
 
+def get_exception_messages(exc):
+	'''Returns the list of messages thrown with an exception'''
+	frappe.clear_messages()
+	message = exc.args[0] if exc.args else str(exc)
+	if isinstance(message, (list, tuple)):
+		return list(message)
+
+	return [message]
+
+def get_gst_account_types(company):
+	'''Returns a read-only map of GST account head -> tax type (igst, cgst, sgst or cess) of the company
+
+	The map is cached until GST Settings or any Account is updated'''
+	account_types = frappe.cache().hget('gst_account_types', company)
+	if account_types is None:
+		account_types = {}
+		gst_accounts = get_gst_accounts(company)
+		for tax_type in ['igst', 'cgst', 'sgst', 'cess']:
+			for account in gst_accounts.get(f'{tax_type}_account') or []:
+				if account:
+					account_types.setdefault(account, tax_type)
+
+		frappe.cache().hset('gst_account_types', company, account_types)
+
+	return MappingProxyType(account_types)
+
+def clear_gst_account_types_cache(doc=None, method=None, *args):
+	frappe.cache().delete_key('gst_account_types')
+
 def safe_load_json(message):
 	try:
 		json_message = json.loads(message)